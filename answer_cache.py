@@ -0,0 +1,146 @@
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_question(question: str) -> str:
+    """Lower-cases, collapses whitespace and drops surrounding punctuation."""
+    return re.sub(r"\s+", " ", question.lower()).strip(" \t?!.,;:'\"")
+
+
+class AnswerCache:
+    def __init__(self, threshold: float = 0.95, ttl_seconds: float = 86400, max_entries: int = 1000,
+                 path: str = None):
+        """
+        Two-level cache of final answers in front of retrieval + LLM.
+
+        Level one is an exact match on the normalized question and needs no embedding.
+        Level two compares the query embedding with the embeddings of cached questions
+        and returns the closest answer when the cosine similarity is at least threshold.
+        Every entry remembers the index version it was answered from; entries from any
+        other version are treated as misses and dropped, so a rebuild invalidates them.
+
+        Args:
+            threshold (float): Minimum cosine similarity for a semantic hit
+            ttl_seconds (float): Entries older than this are expired (0 disables)
+            max_entries (int): Least recently used entries are evicted beyond this
+            path (str): Optional JSON file the cache is loaded from and saved to
+        """
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.path = path
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # normalized question -> entry, least recently used first
+        self._matrix = None
+        self._matrix_keys = []
+        self._lock = threading.Lock()
+        if path:
+            self._load()
+            atexit.register(self.save)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            for entry in json.load(f):
+                self._entries[entry["key"]] = entry
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            entries = list(self._entries.values())
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def _valid(self, entry: dict, index_version) -> bool:
+        if entry["index_version"] != index_version:
+            return False
+        return not self.ttl_seconds or time.time() - entry["created"] <= self.ttl_seconds
+
+    def _drop(self, key: str):
+        self._entries.pop(key, None)
+        self._matrix = None
+
+    def get_exact(self, question: str, index_version):
+        """Returns the cached entry for this exact (normalized) question, or None."""
+        key = normalize_question(question)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not self._valid(entry, index_version):
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return entry
+
+    def get_similar(self, query_vector: list, index_version):
+        """Returns the entry whose question embedding is most similar to query_vector, if above threshold."""
+        with self._lock:
+            if not self._entries:
+                self.misses += 1
+                return None
+            if self._matrix is None:
+                self._matrix_keys = list(self._entries.keys())
+                self._matrix = np.asarray([self._entries[key]["vector"] for key in self._matrix_keys],
+                                          dtype=np.float32)
+            query = np.asarray(query_vector, dtype=np.float32)
+            similarities = self._matrix @ (query / (np.linalg.norm(query) or 1.0))
+            for position in np.argsort(-similarities):
+                if similarities[position] < self.threshold:
+                    break
+                key = self._matrix_keys[position]
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if not self._valid(entry, index_version):
+                    self._drop(key)
+                    continue
+                self._entries.move_to_end(key)
+                self.semantic_hits += 1
+                return entry
+            self.misses += 1
+            return None
+
+    def put(self, question: str, query_vector: list, answer: str, sources: str, index_version):
+        vector = np.asarray(query_vector, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        key = normalize_question(question)
+        with self._lock:
+            self._entries[key] = {
+                "key": key,
+                "question": question,
+                "vector": vector.tolist(),
+                "answer": answer,
+                "sources": sources,
+                "index_version": index_version,
+                "created": time.time(),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def stats(self) -> dict:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+        }
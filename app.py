@@ -1,6 +1,7 @@
 from util import *
 
-from generate_data_store import *
-log("info", f"rag started")
-generate_data_store()
+from generate_data_store import run_pipeline
 
+if __name__ == "__main__":
+    log("info", f"rag started")
+    run_pipeline()
@@ -0,0 +1,361 @@
+"""
+Reproducible ingestion and retrieval benchmark over the bundled transcripts.
+
+For every corpus scale (1 = the transcripts in data/local, N = N perturbed copies of
+them) it measures parse, chunk, embed and index throughput, the index size on disk,
+p50/p95/p99 query latency and recall@k of the Chroma (HNSW) index against exact
+brute-force search, the chunker's redundancy and source hit@k (whether exact search
+finds the chunk covering a passage sampled from the transcripts, comparable across
+chunkers), the same for two-stage episode-then-chunk search at several
+episode counts and for the memory-mapped quantized store (vector_store.py), and writes
+everything to one JSON file.
+
+    python bench_retrieval.py --scales 1,10                  # offline, hashing embedder
+    python bench_retrieval.py --embedder all-MiniLM-L6-v2    # small local model
+    python bench_retrieval.py --chunker sentence-token       # token/sentence chunker (chunking.py)
+    python bench_retrieval.py --compare old.json new.json    # diff two runs
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from ingest_pipeline import parse_transcript, make_splitter
+from retrieval import ChromaSearcher, EpisodeIndex, TwoStageSearcher
+
+DEFAULT_DATA_PATH = os.path.join("data", "local")
+RESULTS_DIR = "bench_results"
+
+
+def percentiles(samples_ms: list) -> dict:
+    if not samples_ms:
+        return {}
+    values = np.asarray(samples_ms)
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "mean": float(values.mean()),
+    }
+
+
+def dir_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+
+def build_corpus(source_dir: str, target_dir: str, scale: int, seed: int = 0) -> list:
+    """
+    Writes scale copies of every transcript into target_dir. Copy 0 is the original;
+    the others rotate the sentence order and drop ~10% of words, so no two copies
+    embed identically. Returns the written paths.
+    """
+    rng = random.Random(seed)
+    os.makedirs(target_dir, exist_ok=True)
+    paths = []
+    for source in sorted(glob.glob(os.path.join(source_dir, "*.txt"))):
+        with open(source, "r") as f:
+            data = json.load(f)
+        sentences = re.split(r"(?<=[.!?])\s+", data.get("text", ""))
+        for copy in range(scale):
+            variant = dict(data)
+            if copy:
+                shift = rng.randrange(max(len(sentences), 1))
+                rotated = sentences[shift:] + sentences[:shift]
+                variant["text"] = " ".join(
+                    " ".join(word for word in sentence.split() if rng.random() > 0.1) for sentence in rotated)
+                variant["Episode Name"] = f"{data.get('Episode Name', '')} (copy {copy})"
+            path = os.path.join(target_dir, f"{copy:04d}_{os.path.basename(source)}")
+            with open(path, "w") as f:
+                json.dump(variant, f)
+            paths.append(path)
+    return paths
+
+
+def sample_queries(chunks: list, count: int, seed: int = 0) -> list:
+    """Queries are the first sentence-ish span of randomly chosen chunks."""
+    rng = random.Random(seed)
+    picked = rng.sample(chunks, min(count, len(chunks)))
+    return [" ".join(chunk[0].split()[:12]) for chunk in picked]
+
+
+def sample_source_queries(parsed: list, count: int, seed: int = 0, words: int = 12) -> list:
+    """
+    (query, source, character offset) of word runs taken at random positions of the
+    transcripts. Unlike sample_queries they do not depend on the chunker.
+    """
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        text, metadata = rng.choice(parsed)
+        spans = [match.span() for match in re.finditer(r"\S+", text)]
+        if not spans:
+            continue
+        i = rng.randrange(max(len(spans) - words, 1))
+        queries.append((text[spans[i][0]:spans[min(i + words, len(spans)) - 1][1]], metadata["source"], spans[i][0]))
+    return queries
+
+
+def brute_force_topk(matrix: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """Exact top k row indices by L2 distance (Chroma's default space)."""
+    distances = (np.sum(queries ** 2, axis=1)[:, None] - 2 * queries @ matrix.T
+                 + np.sum(matrix ** 2, axis=1)[None, :])
+    top = np.argpartition(distances, min(k, matrix.shape[0] - 1), axis=1)[:, :k]
+    order = np.take_along_axis(distances, top, axis=1).argsort(axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def run_scale(paths: list, embeddings, settings: dict, index_dir: str, k: int, query_count: int,
+              batch_size: int, episode_counts: list = (), store_variants: list = ()) -> dict:
+    import chromadb
+
+    result = {"files": len(paths)}
+
+    start_time = time.perf_counter()
+    parsed = [parse_transcript(path) for path in paths]
+    parse_seconds = time.perf_counter() - start_time
+
+    splitter = make_splitter(settings)
+    start_time = time.perf_counter()
+    chunks = []
+    for text, metadata in parsed:
+        chunks.extend((doc.page_content, doc.metadata) for doc in splitter.create_documents([text], [metadata]))
+    chunk_seconds = time.perf_counter() - start_time
+    source_queries = sample_source_queries(parsed, query_count)
+    text_chars = sum(len(text) for text, _ in parsed)
+    del parsed
+    result["chunks"] = len(chunks)
+    result["chunk_redundancy"] = sum(len(text) for text, _ in chunks) / max(text_chars, 1)
+
+    start_time = time.perf_counter()
+    vectors = []
+    for i in range(0, len(chunks), batch_size):
+        vectors.extend(embeddings.embed_documents([text for text, _ in chunks[i:i + batch_size]]))
+    embed_seconds = time.perf_counter() - start_time
+    matrix = np.asarray(vectors, dtype=np.float32)
+    del vectors
+
+    client = chromadb.PersistentClient(path=index_dir)
+    collection = client.create_collection("bench")
+    max_batch = client.get_max_batch_size()
+    start_time = time.perf_counter()
+    for i in range(0, len(chunks), max_batch):
+        batch = chunks[i:i + max_batch]
+        collection.add(
+            ids=[str(j) for j in range(i, i + len(batch))],
+            embeddings=matrix[i:i + len(batch)].tolist(),
+            documents=[text for text, _ in batch],
+            metadatas=[metadata for _, metadata in batch],
+        )
+    index_seconds = time.perf_counter() - start_time
+    result["index_bytes"] = dir_size(index_dir)
+
+    result["throughput"] = {
+        "parse_files_per_s": len(paths) / max(parse_seconds, 1e-9),
+        "chunk_chunks_per_s": len(chunks) / max(chunk_seconds, 1e-9),
+        "embed_chunks_per_s": len(chunks) / max(embed_seconds, 1e-9),
+        "index_chunks_per_s": len(chunks) / max(index_seconds, 1e-9),
+    }
+    result["seconds"] = {"parse": parse_seconds, "chunk": chunk_seconds, "embed": embed_seconds,
+                         "index": index_seconds}
+
+    queries = sample_queries(chunks, query_count)
+    searcher = ChromaSearcher(collection)
+    embed_ms, search_ms, total_ms, found = [], [], [], []
+    query_vectors = []
+    for query in queries:
+        start_time = time.perf_counter()
+        vector = embeddings.embed_query(query)
+        embedded_time = time.perf_counter()
+        hits = searcher.search([vector], k)[0]
+        done_time = time.perf_counter()
+        embed_ms.append((embedded_time - start_time) * 1000)
+        search_ms.append((done_time - embedded_time) * 1000)
+        total_ms.append((done_time - start_time) * 1000)
+        found.append([int(hit["id"]) for hit in hits])
+        query_vectors.append(vector)
+    result["latency_ms"] = {"query_embed": percentiles(embed_ms), "vector_search": percentiles(search_ms),
+                            "total": percentiles(total_ms)}
+
+    exact = brute_force_topk(matrix, np.asarray(query_vectors, dtype=np.float32), k)
+    recalls = [len(set(ann) & set(truth.tolist())) / k for ann, truth in zip(found, exact)]
+    result[f"recall_at_{k}"] = float(np.mean(recalls)) if recalls else None
+
+    # Chunking quality: does exact search return the chunk that holds the sampled passage?
+    source_vectors = np.asarray([embeddings.embed_query(query) for query, _, _ in source_queries], dtype=np.float32)
+    hits = []
+    for (_, source, offset), row in zip(source_queries, brute_force_topk(matrix, source_vectors, k)):
+        hits.append(any(chunks[j][1]["source"] == source and chunks[j][1].get("start_index", 0) <= offset
+                        < chunks[j][1].get("start_index", 0) + len(chunks[j][0]) for j in row))
+    result[f"source_hit_at_{k}"] = float(np.mean(hits)) if hits else None
+
+    # Two-stage: best-matching episode centroids, then an in-memory scan of those episodes' chunks
+    episode_index = EpisodeIndex.from_embeddings(matrix, [metadata["source"] for _, metadata in chunks],
+                                                 ids=[str(i) for i in range(len(chunks))])
+    result["episodes"] = len(episode_index.keys)
+    result["two_stage"] = {}
+    for episodes in episode_counts:
+        two_stage = TwoStageSearcher(searcher, episode_index, episodes)
+        search_ms, found = [], []
+        for vector in query_vectors:
+            start_time = time.perf_counter()
+            hits = two_stage.search([vector], k)[0]
+            search_ms.append((time.perf_counter() - start_time) * 1000)
+            found.append([int(hit["id"]) for hit in hits])
+        recalls = [len(set(ann) & set(truth.tolist())) / k for ann, truth in zip(found, exact)]
+        result["two_stage"][str(episodes)] = {"vector_search_ms": percentiles(search_ms),
+                                              f"recall_at_{k}": float(np.mean(recalls)) if recalls else None}
+
+    # Memory-mapped quantized store built from the same chunks
+    from vector_store import MmapVectorStore, MmapSearcher
+    result["mmap"] = {}
+    for variant in store_variants:
+        dtype, index = variant.split("-")
+        store_dir = os.path.join(index_dir, f"store_{variant}")
+        start_time = time.perf_counter()
+        MmapVectorStore.build(store_dir, [str(i) for i in range(len(chunks))], matrix,
+                              [text for text, _ in chunks], [metadata for _, metadata in chunks], dtype=dtype, index=index)
+        build_seconds = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        store_searcher = MmapSearcher(MmapVectorStore(store_dir))
+        load_ms = (time.perf_counter() - start_time) * 1000
+        search_ms, found = [], []
+        for vector in query_vectors:
+            start_time = time.perf_counter()
+            hits = store_searcher.search([vector], k)[0]
+            search_ms.append((time.perf_counter() - start_time) * 1000)
+            found.append([int(hit["id"]) for hit in hits])
+        recalls = [len(set(ann) & set(truth.tolist())) / k for ann, truth in zip(found, exact)]
+        result["mmap"][variant] = {"vector_search_ms": percentiles(search_ms), "load_ms": load_ms,
+                                   "build_seconds": build_seconds,
+                                   # float16 stores scan their float32 vectors (see MmapVectorStore._approximate)
+                                   "scanned_bytes": os.path.getsize(os.path.join(
+                                       store_dir, "vectors.q.npy" if dtype == "int8" else "vectors.f32.npy")),
+                                   "store_bytes": dir_size(store_dir),
+                                   f"recall_at_{k}": float(np.mean(recalls)) if recalls else None}
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(baseline_path: str, current_path: str):
+    """Prints the relative change of every numeric metric between two result files."""
+    with open(baseline_path, "r") as f:
+        baseline = {run["scale"]: run for run in json.load(f)["runs"]}
+    with open(current_path, "r") as f:
+        current = {run["scale"]: run for run in json.load(f)["runs"]}
+
+    def flatten(prefix, value, out):
+        if isinstance(value, dict):
+            for key, inner in value.items():
+                flatten(f"{prefix}.{key}" if prefix else key, inner, out)
+        elif isinstance(value, (int, float)):
+            out[prefix] = value
+        return out
+
+    for scale in sorted(set(baseline) & set(current)):
+        old, new = flatten("", baseline[scale], {}), flatten("", current[scale], {})
+        print(f"scale x{scale}")
+        for key in sorted(set(old) & set(new)):
+            change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+            print(f"  {key:40s} {old[key]:14.3f} -> {new[key]:14.3f}  ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", default=DEFAULT_DATA_PATH, help="Folder with the source transcripts.")
+    parser.add_argument("--scales", default="1,10", help="Comma separated corpus multipliers, up to 100.")
+    parser.add_argument("--embedder", default="HASH",
+                        help='"HASH" for the deterministic offline embedder, or a local sentence-transformers model.')
+    parser.add_argument("--k", type=int, default=6)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=256, help="Chunks per embedding call.")
+    parser.add_argument("--episodes", default="4,8,16",
+                        help="Comma separated episode counts (M) to evaluate two-stage search at; empty to skip.")
+    parser.add_argument("--stores", default="int8-brute,float16-brute,int8-ivf",
+                        help="Comma separated <dtype>-<index> variants of the mmap vector store; empty to skip.")
+    parser.add_argument("--chunker", choices=["recursive", "sentence-token"], default="recursive")
+    parser.add_argument("--chunk-size", type=int, default=300,
+                        help="Characters per chunk, or tokens with --chunker sentence-token.")
+    parser.add_argument("--chunk-overlap", type=int, default=100,
+                        help="Overlap in characters, or tokens with --chunker sentence-token.")
+    parser.add_argument("--out", help="Result file (default: bench_results/retrieval-<time>.json).")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated corpora and indexes.")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="Compare two result files and exit.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # Keep the embedding cache out of the measurements
+    os.environ["RAG_EMBED_CACHE"] = "off"
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+    from rag_embeddings import get_embeddings
+    embeddings = get_embeddings(args.embedder)
+    settings = {"chunker": "SentenceTokenSplitter" if args.chunker == "sentence-token" else "RecursiveCharacterTextSplitter",
+                "chunk_size": args.chunk_size, "chunk_overlap": args.chunk_overlap, "embedding_model": args.embedder}
+
+    workdir = tempfile.mkdtemp(prefix="rag_bench_")
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.platform(),
+            "cpus": os.cpu_count(),
+            "embedder": args.embedder,
+            "k": args.k,
+            "queries": args.queries,
+            "settings": settings,
+        },
+        "runs": [],
+    }
+    try:
+        for scale in [int(value) for value in args.scales.split(",")]:
+            paths = build_corpus(args.data, os.path.join(workdir, f"corpus_x{scale}"), scale)
+            run = run_scale(paths, embeddings, settings, os.path.join(workdir, f"index_x{scale}"),
+                            args.k, args.queries, args.batch_size,
+                            [int(value) for value in args.episodes.split(",") if value],
+                            [value for value in args.stores.split(",") if value])
+            run["scale"] = scale
+            report["runs"].append(run)
+            print(f"x{scale}: {run['files']} files, {run['chunks']} chunks "
+                  f"(redundancy {run['chunk_redundancy']:.2f}x, source hit@{args.k} {run[f'source_hit_at_{args.k}']:.3f}), "
+                  f"index {run['index_bytes'] / 1e6:.1f} MB, "
+                  f"p95 {run['latency_ms']['total']['p95']:.2f} ms, recall@{args.k} {run[f'recall_at_{args.k}']:.3f}")
+            for episodes, two_stage in run["two_stage"].items():
+                print(f"  two-stage M={episodes}: search p95 {two_stage['vector_search_ms']['p95']:.2f} ms "
+                      f"(flat {run['latency_ms']['vector_search']['p95']:.2f} ms), "
+                      f"recall@{args.k} {two_stage[f'recall_at_{args.k}']:.3f}")
+            for variant, store in run["mmap"].items():
+                print(f"  mmap {variant}: search p95 {store['vector_search_ms']['p95']:.3f} ms, "
+                      f"load {store['load_ms']:.1f} ms, scanned matrix {store['scanned_bytes'] / 1e6:.1f} MB, "
+                      f"recall@{args.k} {store[f'recall_at_{args.k}']:.3f}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    out_path = args.out or os.path.join(RESULTS_DIR, f"retrieval-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Import-time benchmark for the modules every entry point loads.
+
+Each module is imported in a fresh interpreter with `python -X importtime`; the best of
+--runs cumulative import times is compared with its budget in startup_budget.json, and
+the heavy dependencies listed there must not be imported at all. Exits with status 1
+when a budget is exceeded or a forbidden module shows up, so it can gate CI.
+
+    python bench_startup.py                 # check against the budgets
+    python bench_startup.py --update        # re-record budgets from this machine
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BUDGET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_budget.json")
+
+
+def measure_import(module: str, runs: int) -> tuple:
+    """Returns (best cumulative import time in ms, set of top-level modules imported)."""
+    best_us = None
+    imported = set()
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True, text=True, cwd=os.path.dirname(BUDGET_PATH),
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+        cumulative_us = None
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = [part.strip() for part in line[len("import time:"):].split("|")]
+            if not cumulative.isdigit():
+                continue
+            imported.add(name.split(".")[0])
+            if name == module:
+                cumulative_us = int(cumulative)
+        if cumulative_us is not None and (best_us is None or cumulative_us < best_us):
+            best_us = cumulative_us
+    return (best_us or 0) / 1000, imported
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per module; the best run counts.")
+    parser.add_argument("--update", action="store_true", help="Write the measured times (plus headroom) as the new budgets.")
+    parser.add_argument("--headroom", type=float, default=1.5, help="Budget multiplier used with --update.")
+    parser.add_argument("--json", help="Also write the measurements to this file.")
+    args = parser.parse_args()
+
+    with open(BUDGET_PATH, "r") as f:
+        budget = json.load(f)
+
+    failures = []
+    report = {}
+    for module, limits in budget["modules"].items():
+        elapsed_ms, imported = measure_import(module, args.runs)
+        leaked = sorted(set(budget["forbidden_imports"]) & imported)
+        report[module] = {"import_ms": round(elapsed_ms, 2), "budget_ms": limits["budget_ms"], "forbidden": leaked}
+        status = "ok"
+        if leaked:
+            failures.append(f"{module} imports {', '.join(leaked)}")
+            status = "FORBIDDEN"
+        elif elapsed_ms > limits["budget_ms"] and not args.update:
+            failures.append(f"{module} took {elapsed_ms:.1f} ms, budget {limits['budget_ms']} ms")
+            status = "OVER BUDGET"
+        print(f"{module:24s} {elapsed_ms:8.1f} ms  (budget {limits['budget_ms']} ms)  {status}")
+        if args.update:
+            limits["budget_ms"] = round(max(elapsed_ms * args.headroom, 1.0), 1)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.update:
+        with open(BUDGET_PATH, "w") as f:
+            json.dump(budget, f, indent=2)
+            f.write("\n")
+        print(f"Budgets written to {BUDGET_PATH}")
+    if failures:
+        print("\n".join(["Startup budget exceeded:"] + failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
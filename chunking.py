@@ -0,0 +1,253 @@
+"""
+Token-aware, sentence-boundary chunking for ingestion.
+
+RecursiveCharacterTextSplitter cuts 300-character chunks with 100 characters of
+overlap: about a third of the embedded text is overlap, and a chunk is far shorter than
+the embedding model's input window (384 tokens for all-mpnet-base-v2), so the corpus
+turns into many more vectors than needed. SentenceTokenSplitter instead packs whole
+transcript sentences into chunks of up to chunk_tokens tokens of the embedding model's
+own tokenizer and carries at most overlap_tokens tokens of trailing sentences into the
+next chunk.
+
+Selected with RAG_CHUNKER=sentence-token (RAG_CHUNK_TOKENS, RAG_CHUNK_OVERLAP_TOKENS);
+changing it forces a full rebuild. Compare chunkers on the transcripts with
+
+    python chunking.py --data data
+
+which prints chunk count, redundancy (embedded tokens / transcript tokens) and the chunk
+size distribution in embedding tokens for both.
+"""
+import argparse
+import copy
+import glob
+import os
+import re
+
+import numpy as np
+
+from util import *
+
+# A sentence runs up to terminal punctuation (plus closing quotes/brackets) followed by whitespace, or the end
+SENTENCE_RE = re.compile(r"\S.*?(?:[.!?…]+[\"')\]]*(?=\s)|$)", re.S)
+WORD_RE = re.compile(r"\S+")
+
+
+def load_hf_tokenizer(model_name: str):
+    """The HuggingFace tokenizer of a sentence-transformers model, or None when it cannot be loaded."""
+    try:
+        from transformers import AutoTokenizer
+    except ImportError:
+        return None
+    # sentence-transformers resolves bare names like all-mpnet-base-v2 under its own organization
+    names = [model_name] if "/" in model_name or os.path.isdir(model_name) \
+        else [model_name, f"sentence-transformers/{model_name}"]
+    for name in names:
+        try:
+            return AutoTokenizer.from_pretrained(name)
+        except Exception:
+            continue
+    return None
+
+
+class EmbeddingTokenizer:
+    def __init__(self, model_name: str):
+        """
+        Counts text in the embedding model's tokens, without special tokens. HuggingFace
+        models use their own tokenizer, OPENAI uses tiktoken (context_builder.Tokenizer).
+        When neither can be loaded (HASH, or offline without the model files) it falls
+        back to whitespace words scaled by 4/3, like context_builder.Tokenizer.
+        """
+        self.model_name = model_name
+        self._hf_tokenizer = None
+        self._tokenizer = None
+        if model_name == "OPENAI":
+            from context_builder import get_tokenizer
+            self._tokenizer = get_tokenizer("text-embedding-ada-002")
+        elif model_name and model_name != "HASH":
+            self._hf_tokenizer = load_hf_tokenizer(model_name)
+            if self._hf_tokenizer is None:
+                log("warning", f"No tokenizer for {model_name}; estimating chunk sizes from word counts")
+
+    def counts(self, texts: list) -> list:
+        if not texts:
+            return []
+        if self._hf_tokenizer is not None:
+            # One batched call; verbose=False silences the warning about texts longer than the model input
+            return [len(ids) for ids in self._hf_tokenizer(texts, add_special_tokens=False, verbose=False)["input_ids"]]
+        if self._tokenizer is not None:
+            return [self._tokenizer.count(text) for text in texts]
+        return [(len(text.split()) * 4 + 2) // 3 for text in texts]
+
+    def count(self, text: str) -> int:
+        return self.counts([text])[0]
+
+
+_embedding_tokenizers = {}
+
+
+def get_embedding_tokenizer(model_name: str) -> EmbeddingTokenizer:
+    if model_name not in _embedding_tokenizers:
+        _embedding_tokenizers[model_name] = EmbeddingTokenizer(model_name)
+    return _embedding_tokenizers[model_name]
+
+
+def sentence_spans(text: str) -> list:
+    """(start, end) character offsets of the sentences of text."""
+    return [match.span() for match in SENTENCE_RE.finditer(text)]
+
+
+class SentenceTokenSplitter:
+    def __init__(self, tokenizer: EmbeddingTokenizer, chunk_tokens: int = 256, overlap_tokens: int = 32,
+                 add_start_index: bool = True):
+        """
+        Packs consecutive sentences into chunks of at most chunk_tokens tokens. A sentence
+        longer than that on its own (unpunctuated transcripts) is cut at word boundaries.
+        The next chunk repeats the trailing sentences of the previous one that fit in
+        overlap_tokens, so a sentence is never cut in half by the overlap.
+
+        Chunks are exact slices of the transcript, so start_index and len(text) give their
+        character range as with the LangChain splitters (context_builder.merge_spans relies on it).
+
+        Args:
+            tokenizer (EmbeddingTokenizer): Counts tokens the way the embedding model does
+            chunk_tokens (int): Maximum tokens per chunk
+            overlap_tokens (int): Maximum tokens repeated from the end of the previous chunk
+            add_start_index (bool): Put the chunk's character offset in metadata["start_index"]
+        """
+        if overlap_tokens >= chunk_tokens:
+            raise ValueError(f"overlap_tokens ({overlap_tokens}) must be smaller than chunk_tokens ({chunk_tokens})")
+        self.tokenizer = tokenizer
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.add_start_index = add_start_index
+
+    def _units(self, text: str) -> list:
+        """(start, end, tokens) of the sentences, with over-long sentences cut into word runs."""
+        spans = sentence_spans(text)
+        counts = self.tokenizer.counts([text[start:end] for start, end in spans])
+        units = []
+        for (start, end), tokens in zip(spans, counts):
+            if tokens <= self.chunk_tokens:
+                units.append((start, end, tokens))
+                continue
+            words = [match.span() for match in WORD_RE.finditer(text, start, end)]
+            # Aim a little below the limit; pieces that still come out too long are cut again
+            per_piece = max(1, len(words) * self.chunk_tokens * 9 // (tokens * 10))
+            pieces = [(words[i][0], words[min(i + per_piece, len(words)) - 1][1])
+                      for i in range(0, len(words), per_piece)]
+            for (piece_start, piece_end), piece_tokens in zip(
+                    pieces, self.tokenizer.counts([text[s:e] for s, e in pieces])):
+                if piece_tokens > self.chunk_tokens and piece_end - piece_start < end - start:
+                    units.extend((piece_start + s, piece_start + e, t)
+                                 for s, e, t in self._units(text[piece_start:piece_end]))
+                else:
+                    units.append((piece_start, piece_end, piece_tokens))
+        return units
+
+    def split_spans(self, text: str) -> list:
+        """(start, end, tokens) of each chunk of text; tokens sums the chunk's sentences."""
+        units = self._units(text)
+        chunks = []
+        first = 0
+        while first < len(units):
+            last = first
+            tokens = units[first][2]
+            while last + 1 < len(units) and tokens + units[last + 1][2] <= self.chunk_tokens:
+                last += 1
+                tokens += units[last][2]
+            chunks.append((units[first][0], units[last][1], tokens))
+            if last + 1 >= len(units):
+                break
+            # Start the next chunk with the trailing sentences that fit in the overlap, always moving forward
+            next_first = last + 1
+            overlap = 0
+            while next_first - 1 > first and overlap + units[next_first - 1][2] <= self.overlap_tokens:
+                next_first -= 1
+                overlap += units[next_first][2]
+            first = next_first
+        return chunks
+
+    def split_text(self, text: str) -> list:
+        return [text[start:end] for start, end, _ in self.split_spans(text)]
+
+    def create_documents(self, texts: list, metadatas: list = None) -> list:
+        from langchain.schema import Document
+        documents = []
+        for i, text in enumerate(texts):
+            metadata = metadatas[i] if metadatas else {}
+            for start, end, _ in self.split_spans(text):
+                chunk_metadata = copy.deepcopy(metadata)
+                if self.add_start_index:
+                    chunk_metadata["start_index"] = start
+                documents.append(Document(page_content=text[start:end], metadata=chunk_metadata))
+        return documents
+
+    def split_documents(self, documents: list) -> list:
+        return self.create_documents([doc.page_content for doc in documents], [doc.metadata for doc in documents])
+
+
+class ChunkStats:
+    def __init__(self):
+        """Chunk count, redundancy and size distribution of a chunker's output, in embedding tokens."""
+        self.documents = 0
+        self.text_tokens = 0
+        self.sizes = []
+
+    def add(self, text_tokens: int, chunk_tokens: list):
+        self.documents += 1
+        self.text_tokens += text_tokens
+        self.sizes.extend(chunk_tokens)
+
+    def to_dict(self) -> dict:
+        sizes = np.asarray(self.sizes or [0])
+        return {
+            "documents": self.documents,
+            "chunks": len(self.sizes),
+            "text_tokens": self.text_tokens,
+            "chunk_tokens": int(sizes.sum()),
+            # Embedded tokens per transcript token; 1.0 means no overlap
+            "redundancy": float(sizes.sum() / self.text_tokens) if self.text_tokens else 0.0,
+            "size": {"min": int(sizes.min()), "p50": float(np.percentile(sizes, 50)),
+                     "p95": float(np.percentile(sizes, 95)), "max": int(sizes.max()), "mean": float(sizes.mean())},
+        }
+
+    def summary(self) -> str:
+        stats = self.to_dict()
+        size = stats["size"]
+        return (f"{stats['documents']} documents, {stats['chunks']} chunks, {stats['chunk_tokens']} tokens embedded, "
+                f"redundancy {stats['redundancy']:.2f}x, chunk tokens min {size['min']} p50 {size['p50']:.0f} "
+                f"p95 {size['p95']:.0f} max {size['max']}")
+
+
+def measure_chunker(splitter, tokenizer: EmbeddingTokenizer, texts: list) -> ChunkStats:
+    stats = ChunkStats()
+    for text in texts:
+        stats.add(tokenizer.count(text), tokenizer.counts(splitter.split_text(text)))
+    return stats
+
+
+def main():
+    from ingest_pipeline import parse_transcript, make_splitter
+    parser = argparse.ArgumentParser(description="Compare the recursive and sentence-token chunkers on the transcripts.")
+    parser.add_argument("--data", default="data", help="Folder with the transcripts.")
+    parser.add_argument("--embedding-model", default=get_rag_embedding())
+    parser.add_argument("--chunk-size", type=int, default=300, help="Characters per chunk of the recursive chunker.")
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    parser.add_argument("--chunk-tokens", type=int, default=get_chunk_tokens())
+    parser.add_argument("--overlap-tokens", type=int, default=get_chunk_overlap_tokens())
+    args = parser.parse_args()
+
+    texts = [parse_transcript(path)[0] for path in sorted(glob.glob(os.path.join(args.data, "*.txt")))]
+    tokenizer = get_embedding_tokenizer(args.embedding_model)
+    settings = {
+        "recursive": {"chunker": "RecursiveCharacterTextSplitter", "chunk_size": args.chunk_size,
+                      "chunk_overlap": args.chunk_overlap, "embedding_model": args.embedding_model},
+        "sentence-token": {"chunker": "SentenceTokenSplitter", "chunk_size": args.chunk_tokens,
+                           "chunk_overlap": args.overlap_tokens, "embedding_model": args.embedding_model},
+    }
+    for name, chunker_settings in settings.items():
+        print(f"{name:<15} {measure_chunker(make_splitter(chunker_settings), tokenizer, texts).summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import hashlib
+import re
+from collections import OrderedDict
+
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+# Spans separated by at most this many characters are joined into one
+MERGE_GAP = 1
+# A span is only truncated into the remaining budget if at least this many tokens are left
+MIN_TRUNCATED_TOKENS = 32
+
+_tokenizers = {}
+
+
+class Tokenizer:
+    def __init__(self, model_name: str = "gpt-4"):
+        """
+        Counts and truncates text in the chat model's tokens with tiktoken. If the
+        encoding cannot be loaded (e.g. offline without a tiktoken cache) it falls back
+        to whitespace words scaled by 4/3, which is close for English prose.
+        """
+        try:
+            import tiktoken
+            self._encoding = tiktoken.encoding_for_model(model_name)
+        except Exception:
+            self._encoding = None
+
+    def count(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        return (len(text.split()) * 4 + 2) // 3
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        if self._encoding is not None:
+            return self._encoding.decode(self._encoding.encode(text)[:max_tokens])
+        return " ".join(text.split()[:max_tokens * 3 // 4])
+
+
+def get_tokenizer(model_name: str = "gpt-4") -> Tokenizer:
+    if model_name not in _tokenizers:
+        _tokenizers[model_name] = Tokenizer(model_name)
+    return _tokenizers[model_name]
+
+
+def merge_spans(hits: list) -> list:
+    """
+    Merges hits from one transcript whose character ranges overlap or touch, using the
+    start_index metadata written by the splitter. Returns spans ordered by position,
+    each with its text, start, end and best score.
+    """
+    spans = []
+    for hit in sorted(hits, key=lambda hit: hit["metadata"].get("start_index", 0)):
+        start = hit["metadata"].get("start_index", 0)
+        end = start + len(hit["text"])
+        if spans and start <= spans[-1]["end"] + MERGE_GAP:
+            span = spans[-1]
+            if end > span["end"]:
+                overlap = span["end"] - start
+                tail = hit["text"][overlap:] if overlap >= 0 else " " + hit["text"]
+                span["text"] += tail
+                span["end"] = end
+            span["score"] = max(span["score"], hit["score"])
+        else:
+            spans.append({"text": hit["text"], "start": start, "end": end, "score": hit["score"],
+                          "episode_name": hit["episode_name"]})
+    return spans
+
+
+def build_context(hits: list, token_budget: int = 1500, max_chunks_per_episode: int = 3,
+                  model_name: str = "gpt-4") -> dict:
+    """
+    Turns ranked retrieval hits into the prompt context.
+
+    Keeps at most max_chunks_per_episode hits per transcript, merges overlapping and
+    adjacent chunks of the same transcript into single spans, drops spans whose text
+    was already included (e.g. re-runs of an episode), and packs spans best-first until
+    token_budget tokens are used, truncating the last one that only partly fits.
+
+    Returns:
+        dict with the context "text", the "spans" used, and "tokens" before and after packing.
+    """
+    tokenizer = get_tokenizer(model_name)
+    by_source = OrderedDict()
+    for hit in hits:
+        source = hit["metadata"].get("source") or hit["episode_name"]
+        group = by_source.setdefault(source, [])
+        if len(group) < max_chunks_per_episode:
+            group.append(hit)
+
+    spans = [span for group in by_source.values() for span in merge_spans(group)]
+    spans.sort(key=lambda span: span["score"], reverse=True)
+
+    seen = set()
+    packed = []
+    used_tokens = 0
+    raw_tokens = sum(tokenizer.count(hit["text"]) for hit in hits)
+    separator_tokens = tokenizer.count(CONTEXT_SEPARATOR)
+    for span in spans:
+        digest = hashlib.sha1(re.sub(r"\s+", " ", span["text"]).strip().lower().encode("utf-8")).digest()
+        if digest in seen:
+            continue
+        seen.add(digest)
+        remaining = token_budget - used_tokens - (separator_tokens if packed else 0)
+        if remaining <= 0:
+            break
+        tokens = tokenizer.count(span["text"])
+        if tokens > remaining:
+            if remaining < MIN_TRUNCATED_TOKENS:
+                continue
+            span = dict(span, text=tokenizer.truncate(span["text"], remaining))
+            tokens = remaining
+        packed.append(span)
+        used_tokens += tokens + (separator_tokens if len(packed) > 1 else 0)
+
+    return {
+        "text": CONTEXT_SEPARATOR.join(span["text"] for span in packed),
+        "spans": packed,
+        "tokens": {"retrieved": raw_tokens, "context": used_tokens},
+    }
@@ -0,0 +1,96 @@
+from collections import deque
+
+from context_builder import get_tokenizer
+
+SUMMARY_PROMPT = """
+Progressively summarize the conversation below, adding to the previous summary and
+returning a new summary of at most {max_words} words. Keep names of podcasts and episodes.
+
+Previous summary:
+{summary}
+
+New lines of conversation:
+{lines}
+
+New summary:
+"""
+
+
+class ConversationMemory:
+    def __init__(self, token_budget: int = 1000, llm=None, summary_tokens: int = 200, model_name: str = "gpt-4"):
+        """
+        Chat history for the REPL that only stores what was said: the user's questions and
+        the answers, never the retrieved context that went into the prompt for them.
+
+        The most recent turns are kept verbatim while they fit in token_budget. Older turns
+        are dropped, or, when llm is given, folded into a rolling summary of at most
+        summary_tokens tokens, so the history part of every prompt stays bounded no matter
+        how long the session runs.
+
+        Args:
+            token_budget (int): Tokens of verbatim turns to keep
+            llm: Chat model used to summarize evicted turns (None drops them)
+            summary_tokens (int): Upper bound on the rolling summary
+            model_name (str): Model whose tokenizer is used to count tokens
+        """
+        self.token_budget = token_budget
+        self.llm = llm
+        self.summary_tokens = summary_tokens
+        self.tokenizer = get_tokenizer(model_name)
+        self.summary = ""
+        self.turns = deque()
+        self._tokens = 0
+
+    def add(self, question: str, answer: str):
+        tokens = self.tokenizer.count(format_turn(question, answer))
+        self.turns.append({"question": question, "answer": answer, "tokens": tokens})
+        self._tokens += tokens
+        evicted = []
+        while self.turns and self._tokens > self.token_budget:
+            turn = self.turns.popleft()
+            self._tokens -= turn["tokens"]
+            evicted.append(turn)
+        if evicted and self.llm is not None:
+            self._summarize(evicted)
+
+    def _summarize(self, turns: list):
+        lines = "\n".join(format_turn(turn["question"], turn["answer"]) for turn in turns)
+        prompt = SUMMARY_PROMPT.format(max_words=self.summary_tokens * 3 // 4, summary=self.summary or "(none)",
+                                       lines=lines)
+        summary = self.llm.invoke(prompt).content.strip()
+        # The model is asked to stay short; the budget is enforced here regardless
+        self.summary = self.tokenizer.truncate(summary, self.summary_tokens)
+
+    def render(self) -> str:
+        """The history to put in the next prompt: the rolling summary followed by the recent turns."""
+        parts = []
+        if self.summary:
+            parts.append(f"Summary of the earlier conversation: {self.summary}")
+        parts.extend(format_turn(turn["question"], turn["answer"]) for turn in self.turns)
+        return "\n".join(parts)
+
+    def tokens(self) -> int:
+        """Tokens of history currently kept (summary included)."""
+        return self._tokens + (self.tokenizer.count(self.summary) if self.summary else 0)
+
+    def to_dict(self) -> dict:
+        return {"summary": self.summary, "turns": list(self.turns)}
+
+    def load(self, state: dict):
+        """Restores what to_dict() returned (the llm and budgets stay those of this instance)."""
+        self.summary = state.get("summary", "")
+        self.turns = deque(state.get("turns", []))
+        self._tokens = sum(turn["tokens"] for turn in self.turns)
+
+    def size(self) -> int:
+        """Approximate bytes of text held, used by the session store's memory cap."""
+        return len(self.summary) + sum(len(turn["question"]) + len(turn["answer"]) for turn in self.turns)
+
+    def clear(self):
+        self.summary = ""
+        self.turns.clear()
+        self._tokens = 0
+
+
+def format_turn(question: str, answer: str) -> str:
+    return f"Human: {question}\nAI: {answer}"
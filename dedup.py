@@ -0,0 +1,267 @@
+"""
+Near-duplicate and boilerplate suppression at ingestion, with MinHash signatures (mmh3
+shingle hashes under numpy permutations) and LSH banding.
+
+With RAG_DEDUP=on, generate_data_store puts every transcript through a Deduplicator
+before its chunks are embedded:
+
+- an episode whose transcript near-duplicates an indexed one (re-runs, throwbacks) is
+  skipped whole and recorded in the manifest as duplicate_of that episode;
+- a chunk that near-duplicates an indexed chunk is not embedded again; its file
+  references the indexed copy instead (shared_chunk_ids in the manifest);
+- once copies of a chunk turn up in boilerplate_min different episodes (sponsor reads,
+  intros) it is boilerplate: the shared copy is deleted from the index and later
+  copies are dropped. Its signature then belongs to no file, so it stays boilerplate
+  when the episode it was first indexed from changes or goes away.
+
+Signatures live in DEDUP_INDEX_FILE next to the Chroma files, so incremental runs
+compare new transcripts with everything already indexed.
+"""
+import os
+import re
+from collections import defaultdict
+
+import mmh3
+import numpy as np
+
+DEDUP_INDEX_FILE = "dedup_index.npz"
+# Shingles are word n-grams: short for ~50-word chunks, longer for whole transcripts
+CHUNK_SHINGLE = 3
+EPISODE_SHINGLE = 5
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint32(0xFFFFFFFF)
+# Separates the files referencing a chunk when they are saved as one string
+REFS_SEPARATOR = "\x1f"
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 64, seed: int = 1):
+        """MinHash signatures of num_perm 32-bit values; the same seed gives comparable signatures across runs."""
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 31, num_perm, dtype=np.uint64)
+
+    def shingle_hashes(self, text: str, size: int) -> np.ndarray:
+        tokens = re.findall(r"\w+", text.lower())
+        # Texts shorter than one shingle are hashed whole, so every text has a signature
+        shingles = {" ".join(tokens[i:i + size]) for i in range(max(len(tokens) - size + 1, 1))}
+        return np.fromiter((mmh3.hash(shingle, signed=False) for shingle in shingles), dtype=np.uint64,
+                           count=len(shingles))
+
+    def _permute(self, hashes: np.ndarray) -> np.ndarray:
+        # a * h + b stays below 2**64 because a, b < 2**31 and h < 2**32
+        return ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % MERSENNE_PRIME & MAX_HASH).astype(np.uint32)
+
+    def signature(self, text: str, size: int = EPISODE_SHINGLE) -> np.ndarray:
+        return self._permute(self.shingle_hashes(text, size)).min(axis=1)
+
+    def signatures(self, texts: list, size: int = CHUNK_SHINGLE) -> np.ndarray:
+        """(len(texts), num_perm) signatures with one permutation pass over all shingles."""
+        if not texts:
+            return np.zeros((0, self.num_perm), dtype=np.uint32)
+        hashes = [self.shingle_hashes(text, size) for text in texts]
+        offsets = np.cumsum([0] + [len(h) for h in hashes[:-1]])
+        return np.minimum.reduceat(self._permute(np.concatenate(hashes)), offsets, axis=1).T
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two signatures."""
+    return float(np.mean(a == b))
+
+
+class LSHIndex:
+    def __init__(self, bands: int = 16):
+        """
+        Banded LSH over MinHash signatures: keys sharing all rows of any band are
+        candidates. 16 bands of 4 rows find pairs above ~0.8 similarity almost surely
+        while rarely pairing texts below ~0.4.
+        """
+        self.bands = bands
+        self.buckets = [defaultdict(set) for _ in range(bands)]
+
+    def _band_keys(self, signature: np.ndarray) -> list:
+        return [band.tobytes() for band in np.array_split(signature, self.bands)]
+
+    def add(self, key: str, signature: np.ndarray):
+        for buckets, band in zip(self.buckets, self._band_keys(signature)):
+            buckets[band].add(key)
+
+    def remove(self, key: str, signature: np.ndarray):
+        for buckets, band in zip(self.buckets, self._band_keys(signature)):
+            keys = buckets.get(band)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del buckets[band]
+
+    def candidates(self, signature: np.ndarray) -> set:
+        found = set()
+        for buckets, band in zip(self.buckets, self._band_keys(signature)):
+            found |= buckets.get(band, set())
+        return found
+
+
+class DedupIndex:
+    def __init__(self, num_perm: int = 64, bands: int = 16):
+        """Signatures of the indexed chunks and episodes, with an LSH index over each."""
+        self.num_perm = num_perm
+        self.bands = bands
+        # chunk id -> {"file", "signature", "refs" (other files reusing the chunk), "boilerplate"};
+        # boilerplate entries have no file or refs
+        self.chunks = {}
+        self.episodes = {}  # file name -> signature
+        self.chunk_lsh = LSHIndex(bands)
+        self.episode_lsh = LSHIndex(bands)
+
+    def best_match(self, lsh: LSHIndex, signatures, signature: np.ndarray, threshold: float, exclude: str = None):
+        best, best_score = None, threshold
+        for key in lsh.candidates(signature):
+            if key == exclude:
+                continue
+            score = similarity(signatures(key), signature)
+            if score >= best_score:
+                best, best_score = key, score
+        return best
+
+    def find_episode(self, name: str, signature: np.ndarray, threshold: float):
+        return self.best_match(self.episode_lsh, self.episodes.get, signature, threshold, exclude=name)
+
+    def add_episode(self, name: str, signature: np.ndarray):
+        self.episodes[name] = signature
+        self.episode_lsh.add(name, signature)
+
+    def find_chunk(self, signature: np.ndarray, threshold: float):
+        return self.best_match(self.chunk_lsh, lambda key: self.chunks[key]["signature"], signature, threshold)
+
+    def add_chunk(self, chunk_id: str, name: str, signature: np.ndarray, refs: set = None, boilerplate: bool = False):
+        self.chunks[chunk_id] = {"file": name, "signature": signature, "refs": refs or set(),
+                                 "boilerplate": boilerplate}
+        self.chunk_lsh.add(chunk_id, signature)
+
+    def remove_file(self, name: str):
+        """
+        Forgets a file's episode signature, the chunks it owns and its references to
+        other files' chunks. Boilerplate signatures are kept.
+        """
+        signature = self.episodes.pop(name, None)
+        if signature is not None:
+            self.episode_lsh.remove(name, signature)
+        for chunk_id in [chunk_id for chunk_id, entry in self.chunks.items()
+                         if entry["file"] == name and not entry["boilerplate"]]:
+            self.chunk_lsh.remove(chunk_id, self.chunks.pop(chunk_id)["signature"])
+        for entry in self.chunks.values():
+            entry["refs"].discard(name)
+
+    def is_boilerplate(self, chunk_id: str) -> bool:
+        entry = self.chunks.get(chunk_id)
+        return entry is not None and entry["boilerplate"]
+
+    def save(self, path: str):
+        chunk_ids = list(self.chunks)
+        episode_names = list(self.episodes)
+        tmp_path = path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            num_perm=self.num_perm,
+            bands=self.bands,
+            chunk_ids=np.array(chunk_ids, dtype=str),
+            chunk_files=np.array([self.chunks[key]["file"] for key in chunk_ids], dtype=str),
+            chunk_refs=np.array([REFS_SEPARATOR.join(sorted(self.chunks[key]["refs"])) for key in chunk_ids], dtype=str),
+            chunk_boilerplate=np.array([self.chunks[key]["boilerplate"] for key in chunk_ids], dtype=bool),
+            chunk_signatures=np.array([self.chunks[key]["signature"] for key in chunk_ids],
+                                      dtype=np.uint32).reshape(len(chunk_ids), self.num_perm),
+            episode_names=np.array(episode_names, dtype=str),
+            episode_signatures=np.array([self.episodes[name] for name in episode_names],
+                                        dtype=np.uint32).reshape(len(episode_names), self.num_perm),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, num_perm: int = 64, bands: int = 16):
+        """The index saved at path, or an empty one when there is none or it was built with other parameters."""
+        if not os.path.exists(path):
+            return cls(num_perm, bands)
+        data = np.load(path)
+        if int(data["num_perm"]) != num_perm or int(data["bands"]) != bands:
+            return cls(num_perm, bands)
+        index = cls(num_perm, bands)
+        for chunk_id, name, refs, boilerplate, signature in zip(data["chunk_ids"], data["chunk_files"],
+                                                               data["chunk_refs"], data["chunk_boilerplate"],
+                                                               data["chunk_signatures"]):
+            index.add_chunk(str(chunk_id), str(name), signature, set(filter(None, str(refs).split(REFS_SEPARATOR))),
+                            bool(boilerplate))
+        for name, signature in zip(data["episode_names"], data["episode_signatures"]):
+            index.add_episode(str(name), signature)
+        return index
+
+
+class Deduplicator:
+    def __init__(self, index: DedupIndex, id_func, threshold: float = 0.8, episode_threshold: float = 0.9,
+                 boilerplate_min: int = 3):
+        """
+        Decides, transcript by transcript and chunk by chunk, what still needs embedding.
+
+        Args:
+            index (DedupIndex): Signatures of what is already indexed; updated as chunks are accepted
+            id_func: Chunk Document -> chunk id (generate_data_store.make_chunk_id)
+            threshold (float): Similarity from which a chunk is a near-duplicate
+            episode_threshold (float): Similarity from which a whole transcript is a near-duplicate
+            boilerplate_min (int): Distinct episodes containing a chunk that make it boilerplate
+        """
+        self.index = index
+        self.id_func = id_func
+        self.threshold = threshold
+        self.episode_threshold = episode_threshold
+        self.boilerplate_min = boilerplate_min
+        self.duplicate_of = {}  # file -> episode it duplicates
+        self.shared = defaultdict(list)  # file -> ids of other files' chunks it reuses
+        self.stats = {"episodes_skipped": 0, "chunks_shared": 0, "boilerplate_dropped": 0, "boilerplate_chunks": 0}
+        self._new_boilerplate = []
+
+    def accept_episode(self, result: dict) -> bool:
+        """False for a transcript that near-duplicates an indexed episode; its chunks are then skipped."""
+        name = os.path.basename(result["path"])
+        match = self.index.find_episode(name, result["episode_signature"], self.episode_threshold)
+        if match is not None:
+            self.duplicate_of[name] = match
+            self.stats["episodes_skipped"] += 1
+            return False
+        self.index.add_episode(name, result["episode_signature"])
+        return True
+
+    def accept_chunk(self, chunk, signature: np.ndarray) -> bool:
+        """True when the chunk has to be embedded, False when an indexed copy is reused or it is boilerplate."""
+        name = os.path.basename(chunk.metadata["source"])
+        match = self.index.find_chunk(signature, self.threshold)
+        if match is None:
+            self.index.add_chunk(self.id_func(chunk), name, signature)
+            return True
+        entry = self.index.chunks[match]
+        if entry["boilerplate"]:
+            self.stats["boilerplate_dropped"] += 1
+            return False
+        if name != entry["file"]:
+            entry["refs"].add(name)
+        if len(entry["refs"]) + 1 >= self.boilerplate_min:
+            entry.update(boilerplate=True, file="", refs=set())
+            self._new_boilerplate.append(match)
+            self.stats["boilerplate_chunks"] += 1
+            self.stats["boilerplate_dropped"] += 1
+            return False
+        self.shared[name].append(match)
+        self.stats["chunks_shared"] += 1
+        return False
+
+    def pop_boilerplate(self) -> list:
+        """Ids of indexed chunks that became boilerplate since the last call; delete them from the index."""
+        ids, self._new_boilerplate = self._new_boilerplate, []
+        return ids
+
+    def shared_chunk_ids(self, name: str, previous: list = ()) -> list:
+        """The chunks a file reuses (from this run plus previous), without those that turned into boilerplate."""
+        return sorted({chunk_id for chunk_id in list(previous) + self.shared.get(name, [])
+                       if chunk_id in self.index.chunks and not self.index.is_boilerplate(chunk_id)})
+
+    def summary(self) -> str:
+        return ", ".join(f"{key.replace('_', ' ')} {value}" for key, value in self.stats.items())
@@ -0,0 +1,268 @@
+import atexit
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Each key index record is a 16 byte text digest followed by its int32 slot
+KEY_DIGEST_BYTES = 16
+KEY_RECORD = np.dtype([("digest", f"S{KEY_DIGEST_BYTES}"), ("slot", "<i4")])
+INITIAL_CAPACITY = 1024
+
+
+def normalize_text(text: str) -> str:
+    """Collapses whitespace so chunks that only differ in spacing share a cache entry."""
+    return " ".join(text.split())
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir: str, model_name: str, max_bytes: int = 512 * 1024 * 1024):
+        """
+        On-disk, content-addressed store of embedding vectors for one model.
+
+        Vectors live in a memory-mapped float32 matrix (vectors.f32); the key index
+        (keys.bin) maps a digest of (model name, kind, normalized text) to a row and is
+        kept in least-recently-used order so the oldest rows are reused once the cache
+        reaches max_bytes.
+
+        Ingestion and query processes can share a cache directory. slots.bin holds the
+        digest of the entry in every row and is what a row is checked against on each
+        read, so a row another process evicted and reused reads as a miss rather than
+        as the wrong embedding. Reads and writes hold an fcntl lock on the directory's
+        lock file (shared and exclusive), and a matrix grown by another process is
+        remapped before use.
+
+        Args:
+            cache_dir (str): Root directory of the cache, one subfolder per model
+            model_name (str): Embedding model name, part of every key
+            max_bytes (int): Upper bound on the size of the vector matrix
+        """
+        self.model_name = model_name
+        self.path = os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._slots = OrderedDict()  # digest -> slot, least recently used first
+        self._free_slots = []
+        self._dim = None
+        self._capacity = 0
+        self._vectors = None
+        self._slot_keys = None  # (capacity, KEY_DIGEST_BYTES) digest of the entry in each row, zeros when free
+        self._dirty = False
+        os.makedirs(self.path, exist_ok=True)
+        self._lock_file = open(os.path.join(self.path, "lock"), "a+")
+        with self._locked(exclusive=True):
+            self._load()
+        atexit.register(self.flush)
+
+    @property
+    def _meta_path(self):
+        return os.path.join(self.path, "meta.json")
+
+    @property
+    def _keys_path(self):
+        return os.path.join(self.path, "keys.bin")
+
+    @property
+    def _vectors_path(self):
+        return os.path.join(self.path, "vectors.f32")
+
+    @property
+    def _slot_keys_path(self):
+        return os.path.join(self.path, "slots.bin")
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        """Holds the thread lock and the cross-process file lock; flock alone does not exclude threads."""
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        if not os.path.exists(self._meta_path):
+            return
+        with open(self._meta_path, "r") as f:
+            meta = json.load(f)
+        if meta.get("model_name") != self.model_name:
+            return
+        self._dim = meta["dim"]
+        records = np.fromfile(self._keys_path, dtype=KEY_RECORD) if os.path.exists(self._keys_path) else []
+        # numpy strips trailing NUL bytes from the S16 digests
+        recorded = [(bytes(record["digest"]).ljust(KEY_DIGEST_BYTES, b"\0"), int(record["slot"])) for record in records]
+        # Caches written before slots.bin existed get it from the key index
+        adopt = not os.path.exists(self._slot_keys_path)
+        self._map(max(meta["capacity"], self._file_capacity()))
+        if adopt:
+            for digest, slot in recorded:
+                self._slot_keys[slot] = np.frombuffer(digest, dtype=np.uint8)
+        # Rows filled by other processes since keys.bin was written count as least recently used
+        recorded_slots = {slot for _, slot in recorded}
+        for slot in np.flatnonzero(self._slot_keys.any(axis=1)):
+            if slot not in recorded_slots:
+                self._slots[self._slot_keys[slot].tobytes()] = int(slot)
+        for digest, slot in recorded:
+            if slot < self._capacity and self._slot_keys[slot].tobytes() == digest:
+                self._slots[digest] = slot
+
+    def _file_capacity(self) -> int:
+        return os.path.getsize(self._vectors_path) // (self._dim * 4) if os.path.exists(self._vectors_path) else 0
+
+    def _map(self, capacity: int):
+        """Maps (and extends when needed) the vector and slot key files to capacity rows."""
+        for path, row_bytes in ((self._vectors_path, self._dim * 4), (self._slot_keys_path, KEY_DIGEST_BYTES)):
+            with open(path, "ab") as f:
+                if f.tell() < capacity * row_bytes:
+                    f.truncate(capacity * row_bytes)
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._slot_keys.flush()
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self._dim))
+        self._slot_keys = np.memmap(self._slot_keys_path, dtype=np.uint8, mode="r+",
+                                    shape=(capacity, KEY_DIGEST_BYTES))
+        free = np.flatnonzero(~self._slot_keys[self._capacity:].any(axis=1)) + self._capacity
+        self._free_slots = free[::-1].tolist() + self._free_slots
+        self._capacity = capacity
+
+    def _sync(self):
+        """Picks up a cache another process created or grew; called with the file lock held."""
+        if self._dim is None:
+            self._load()
+        elif self._file_capacity() > self._capacity:
+            self._map(self._file_capacity())
+
+    def key(self, text: str, kind: str = "document") -> bytes:
+        digest = hashlib.blake2b(digest_size=KEY_DIGEST_BYTES)
+        digest.update(f"{self.model_name}\0{kind}\0{normalize_text(text)}".encode("utf-8"))
+        return digest.digest()
+
+    def get(self, key: bytes):
+        """Returns the cached vector for key as a list, or None on a miss."""
+        with self._locked(exclusive=False):
+            self._sync()
+            slot = self._slots.get(key)
+            if slot is not None and self._slot_keys[slot].tobytes() != key:
+                # Evicted by another process sharing the cache
+                del self._slots[key]
+                slot = None
+            if slot is None:
+                self.misses += 1
+                return None
+            self._slots.move_to_end(key)
+            self.hits += 1
+            return self._vectors[slot].tolist()
+
+    def put(self, key: bytes, vector: list):
+        with self._locked(exclusive=True):
+            self._sync()
+            if self._dim is None:
+                self._dim = len(vector)
+            slot = self._slots.get(key)
+            if slot is None or self._slot_keys[slot].tobytes() != key:
+                slot = self._allocate_slot()
+            self._slots[key] = slot
+            self._slots.move_to_end(key)
+            self._vectors[slot] = np.asarray(vector, dtype=np.float32)
+            self._slot_keys[slot] = np.frombuffer(key, dtype=np.uint8)
+            self._dirty = True
+
+    def _allocate_slot(self) -> int:
+        max_entries = max(1, self.max_bytes // (self._dim * 4))
+        while True:
+            if not self._free_slots and self._capacity < max_entries:
+                self._grow(min(max(self._capacity * 2, INITIAL_CAPACITY), max_entries))
+            if not self._free_slots:
+                break
+            slot = self._free_slots.pop()
+            # Another process may have filled it since
+            if not self._slot_keys[slot].any():
+                return slot
+        # Full: reuse the row of the least recently used entry
+        _, slot = self._slots.popitem(last=False)
+        self.evictions += 1
+        return slot
+
+    def _grow(self, capacity: int):
+        self._map(capacity)
+        # Other processes need the dimension to map the matrix before the first flush
+        self._write_meta()
+
+    def _write_meta(self):
+        with open(self._meta_path, "w") as f:
+            json.dump({"model_name": self.model_name, "dim": self._dim, "capacity": self._capacity}, f)
+
+    def flush(self):
+        """Writes the vectors and the key index to disk if anything changed."""
+        with self._locked(exclusive=True):
+            if not self._dirty:
+                return
+            self._vectors.flush()
+            self._slot_keys.flush()
+            # Entries other processes evicted meanwhile are left out
+            records = np.array([(digest, slot) for digest, slot in self._slots.items()
+                                if self._slot_keys[slot].tobytes() == digest], dtype=KEY_RECORD)
+            tmp_path = self._keys_path + ".tmp"
+            records.tofile(tmp_path)
+            os.replace(tmp_path, self._keys_path)
+            self._write_meta()
+            self._dirty = False
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._slots),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        """
+        Drop-in LangChain Embeddings that answers from an EmbeddingCache and only
+        sends cache misses to the wrapped model.
+
+        Args:
+            embeddings (Embeddings): The model to call on a cache miss
+            cache (EmbeddingCache): Cache for the same model
+        """
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self.cache.key(text) for text in texts]
+        vectors = [self.cache.get(key) for key in keys]
+        # Embed each distinct missing text once, even if it repeats in the batch
+        missing = OrderedDict()
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[i], texts[i])
+        if missing:
+            computed = self.embeddings.embed_documents(list(missing.values()))
+            fresh = dict(zip(missing.keys(), computed))
+            for key, vector in fresh.items():
+                self.cache.put(key, vector)
+            vectors = [vector if vector is not None else fresh[keys[i]] for i, vector in enumerate(vectors)]
+            self.cache.flush()
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self.cache.key(text, kind="query")
+        vector = self.cache.get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put(key, vector)
+        return vector
@@ -0,0 +1,205 @@
+"""
+One summary per transcript, computed at ingestion and served without retrieval.
+
+generate_data_store summarizes every transcript whose hash is not in the store yet, so
+re-runs only pay for new or changed episodes. RagEngine answers summary-style questions
+("what is this episode about", "summarize <episode name>") straight from the store.
+"""
+import json
+import os
+import re
+import threading
+
+from util import *
+
+SUMMARY_PROMPT = """
+Summarize the following podcast episode transcript in at most {max_words} words.
+Say what the episode is about, who is speaking and the main points made.
+
+Podcast Name: {podcast_name}
+Episode Name: {episode_name}
+
+{text}
+"""
+# Questions asking for an overview of something rather than a specific fact; find() also
+# requires that something to be an episode and nothing more (SUMMARY_WORDS)
+SUMMARY_QUESTION = re.compile(
+    r"\b(summar(y|ies|ize|ise)|recap|overview|tl;?dr|gist)\b"
+    r"|\bwhat('s| is| was)\b.*\babout\b",
+    re.IGNORECASE,
+)
+# Summary questions that refer to an episode already under discussion
+THIS_EPISODE = re.compile(r"\b(this|that|the|last)\s+(episode|podcast|show)\b", re.IGNORECASE)
+# Words a whole-episode summary question may have besides the episode's name. Any other word
+# asks about something in the episode ("an overview of what the guest said about inflation")
+# and goes through retrieval instead.
+SUMMARY_WORDS = frozenset("""
+a about an brief can could dr episode for give gist i is it just last me of on overview please podcast
+quick recap s short show summarise summarize summary that the this tl tldr us was what whats you
+""".split())
+# Fraction of an episode name's words that must appear in a question to refer to it
+NAME_MATCH = 0.8
+
+
+class StubSummarizer:
+    name = "stub"
+
+    def __init__(self, max_words: int = 80):
+        """Offline summarizer for tests: the opening sentences of the transcript, deterministic."""
+        self.max_words = max_words
+
+    def summarize(self, text: str, metadata: dict) -> str:
+        words = []
+        for sentence in re.split(r"(?<=[.!?])\s+", text.strip()):
+            if words and len(words) + len(sentence.split()) > self.max_words:
+                break
+            words.extend(sentence.split())
+        return f"{metadata.get('episode_name', '')}: {' '.join(words[:self.max_words])}"
+
+
+class LLMSummarizer:
+    def __init__(self, llm_name: str = None, max_words: int = 250, input_tokens: int = 6000):
+        """
+        Summarizes with the chat model named by RAG_LLM. Transcripts longer than
+        input_tokens are cut there, so one episode is always one LLM call.
+        """
+        from rag_engine import get_llm
+        from context_builder import get_tokenizer
+        self.name = llm_name or get_rag_llm()
+        self.llm = get_llm(self.name)
+        self.tokenizer = get_tokenizer(self.name)
+        self.max_words = max_words
+        self.input_tokens = input_tokens
+
+    def summarize(self, text: str, metadata: dict) -> str:
+        prompt = SUMMARY_PROMPT.format(max_words=self.max_words, podcast_name=metadata.get("podcast_name", ""),
+                                       episode_name=metadata.get("episode_name", ""),
+                                       text=self.tokenizer.truncate(text, self.input_tokens))
+        return self.llm.invoke(prompt).content.strip()
+
+
+def get_summarizer(name: str = None):
+    """Summarizer for RAG_SUMMARIZER: "stub", "llm" (the RAG_LLM chat model), or None when "off"."""
+    name = name or get_summarizer_name()
+    if name == "off":
+        return None
+    if name == "stub":
+        return StubSummarizer()
+    if name == "llm":
+        return LLMSummarizer(max_words=get_summary_max_words(), input_tokens=get_summary_input_tokens())
+    raise ValueError(f"Unsupported summarizer: {name}")
+
+
+class EpisodeSummaryStore:
+    def __init__(self, path: str):
+        """
+        Episode summaries in one JSON file, keyed by the transcript's sha256 so they
+        survive index rebuilds and are recomputed only when a transcript changes.
+        Each entry also carries the episode metadata and the summarizer that wrote it.
+        """
+        self.path = path
+        self.entries = {}
+        self._mtime = None
+        self._names = []
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """Re-reads the file if it changed since the last read."""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+            self._mtime = mtime
+            self._index_names()
+
+    def _index_names(self):
+        """(normalized episode name, digest) pairs that find() matches questions against."""
+        self._names = [(normalize_name(entry["episode_name"]), digest)
+                       for digest, entry in self.entries.items() if entry.get("episode_name")]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def has(self, digest: str, summarizer: str) -> bool:
+        entry = self.entries.get(digest)
+        return entry is not None and entry.get("summarizer") == summarizer
+
+    def put(self, digest: str, summary: str, metadata: dict, summarizer: str):
+        self.entries[digest] = {
+            "summary": summary,
+            "episode_name": metadata.get("episode_name", ""),
+            "podcast_name": metadata.get("podcast_name", ""),
+            "episode_link": metadata.get("episode_link", ""),
+            "summarizer": summarizer,
+        }
+        self._index_names()
+
+    def prune(self, keep: set) -> int:
+        """Drops summaries of transcripts that are no longer ingested; returns how many."""
+        stale = [digest for digest in self.entries if digest not in keep]
+        for digest in stale:
+            del self.entries[digest]
+        if stale:
+            self._index_names()
+        return len(stale)
+
+    def find(self, question: str, recent_episodes: list = ()):
+        """
+        The entry for the episode a summary question refers to: one whose name appears in
+        the question, else, for "this episode" questions, the most recent of
+        recent_episodes (episode names, newest last) that has a summary. None when the
+        question is not a whole-episode summary question, i.e. has words other than the
+        episode's name and SUMMARY_WORDS.
+        """
+        if not self.entries or not SUMMARY_QUESTION.search(question):
+            return None
+        words = set(normalize_name(question).split())
+        best, best_name, best_score = None, "", NAME_MATCH
+        for name, digest in self._names:
+            name_words = [word for word in name.split() if len(word) > 2] or name.split()
+            score = sum(word in words for word in name_words) / len(name_words) if name_words else 0
+            if score >= best_score:
+                best, best_name, best_score = digest, name, score
+        if best is not None:
+            return self.entries[best] if words <= SUMMARY_WORDS | set(best_name.split()) else None
+        if not THIS_EPISODE.search(question) or not words <= SUMMARY_WORDS:
+            return None
+        for episode_name in reversed(list(recent_episodes)):
+            for name, digest in self._names:
+                if name == normalize_name(episode_name):
+                    return self.entries[digest]
+        return None
+
+
+def normalize_name(text: str) -> str:
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def summarize_transcripts(store: EpisodeSummaryStore, summarizer, paths: dict, hashes: dict) -> int:
+    """
+    Summarizes the transcripts (file name -> path, file name -> sha256) that have no
+    summary from this summarizer yet, prunes summaries of removed transcripts and
+    saves the store. Returns the number of summaries written.
+    """
+    from ingest_pipeline import parse_transcript
+    written = 0
+    for name, path in paths.items():
+        if store.has(hashes[name], summarizer.name):
+            continue
+        text, metadata = parse_transcript(path)
+        store.put(hashes[name], summarizer.summarize(text, metadata), metadata, summarizer.name)
+        written += 1
+    pruned = store.prune(set(hashes.values()))
+    if written or pruned:
+        store.save()
+    return written
@@ -1,16 +1,15 @@
-# from langchain.document_loaders import DirectoryLoader
-from langchain_community.document_loaders import DirectoryLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.schema import Document
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.document_loaders import JSONLoader
-
-from sentence_transformers import SentenceTransformer
-from langchain_chroma import Chroma 
-from langchain_huggingface import HuggingFaceEmbeddings
-import openai 
+# LangChain, sentence-transformers and Chroma are imported inside the functions that use
+# them, so importing this module stays cheap (see bench_startup.py)
+from __future__ import annotations
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from langchain.schema import Document
+    from langchain_chroma import Chroma
 
 import shutil
+import hashlib
+import itertools
+import glob
 from operator import itemgetter
 
 from pprint import pprint
@@ -18,8 +17,11 @@ from dotenv import load_dotenv
 load_dotenv()
 import os
 import time
+import argparse
 import textwrap
 from util import *
+from ingest_pipeline import iter_chunk_batches, make_splitter, StageStats
+import metrics
 import json
 
 
@@ -29,24 +31,362 @@ load_dotenv()
 
 CHROMA_PATH = "chroma"
 DATA_PATH = os.getenv("RAG_LOCAL_DATA_PATH")
+# Manifest of what is currently indexed, kept next to the Chroma files
+MANIFEST_PATH = os.path.join(CHROMA_PATH, "ingest_manifest.json")
+# Characters, for RecursiveCharacterTextSplitter; RAG_CHUNKER=sentence-token sizes chunks in tokens instead
+CHUNK_SIZE = 300
+CHUNK_OVERLAP = 100
+# Coarse per-episode index for two-stage retrieval (see retrieval.EpisodeIndex)
+EPISODE_INDEX_PATH = os.path.join(CHROMA_PATH, "episode_index.npz")
+# MmapVectorStore export of the index, written when RAG_VECTOR_STORE=mmap
+VECTOR_STORE_PATH = os.path.join(CHROMA_PATH, "vector_store")
+# MinHash signatures of the indexed chunks and episodes, written when RAG_DEDUP=on (see dedup.py)
+DEDUP_INDEX_PATH = os.path.join(CHROMA_PATH, "dedup_index.npz")
+DEDUP_NUM_PERM = 64
+DEDUP_BANDS = 16
+# Chroma rejects very large add/delete calls, so index in slices of this size
+INDEX_BATCH_SIZE = 1000
 embedding_model = get_rag_embedding()
-download_s3_bucket_flat( DATA_PATH, "transcriptions")
 def main():
-    generate_data_store()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--full", action="store_true", help="Wipe the index and re-embed every transcript.")
+    parser.add_argument("--skip-sync", action="store_true", help="Index what is in DATA_PATH without syncing from S3.")
+    parser.add_argument("--publish", action="store_true",
+                        help="Publish the finished index as a snapshot for query nodes (see index_snapshot.py).")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile CPU and memory per stage into RAG_PROFILE_DIR (also RAG_PROFILE=on).")
+    args = parser.parse_args()
+    profiler = None
+    if args.profile or profile_enabled():
+        from profiling import start_profiler
+        profiler = start_profiler("ingest")
+    try:
+        run_pipeline(full_rebuild=args.full, sync=not args.skip_sync, publish=args.publish)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+    if metrics.enabled() and get_metrics_path():
+        metrics.dump_json(get_metrics_path())
+        log("info", f"Metrics written to {get_metrics_path()}")
+
 
+def run_pipeline(full_rebuild: bool = False, sync: bool = True, publish: bool = False):
+    """
+    Entry point for a full ingestion run: sync transcripts from S3, update the index,
+    optionally publish it. Transcripts are chunked and embedded as the sync lands them,
+    while the rest is still downloading.
+    """
+    if sync:
+        start_time = time.perf_counter()
+        s3_sync = make_s3_sync(DATA_PATH, "transcriptions")
+        pending = [name for name in s3_sync.prepare() if name.endswith(".txt")]
+        generate_data_store(full_rebuild=full_rebuild, incoming=timed_sync(s3_sync.sync(), start_time),
+                            pending=pending)
+    else:
+        generate_data_store(full_rebuild=full_rebuild)
+    if publish:
+        from index_snapshot import publish_snapshot
+        publish_snapshot(CHROMA_PATH, summary_path=get_summary_path())
 
-def generate_data_store():
-    documents = load_documents()
-    chunks = split_text(documents)
-    save_to_chroma(chunks)
 
+def timed_sync(paths, start_time: float):
+    """Passes the synced paths through and records the whole sync as the s3_sync stage once it is done."""
+    yield from paths
+    metrics.record_span("s3_sync", time.perf_counter() - start_time, start_time)
+
+
+def generate_data_store(full_rebuild: bool = False, incoming=None, pending: list = ()):
+    """
+    Brings the Chroma index in line with the transcripts in DATA_PATH.
+
+    Only new or changed transcripts are chunked and embedded; chunks of changed
+    and removed transcripts are deleted by their stable ids. A full rebuild is
+    done when asked for, when there is no index yet, or when the chunker or
+    embedding settings differ from the ones the index was built with.
+
+    With RAG_DEDUP=on, near-duplicate episodes and chunks are not embedded again and
+    boilerplate is dropped (see dedup.py); files depending on a changed or removed
+    file through a shared chunk are re-indexed along with it.
+
+    pending and incoming come from an S3 sync that is still running (see run_pipeline):
+    pending names the transcripts being downloaded, which count as changed, and
+    incoming yields their paths as they land, so they are chunked as they arrive.
+    """
+    settings = get_ingest_settings()
+    manifest = load_manifest()
+    if full_rebuild or not os.path.exists(CHROMA_PATH) or manifest.get("settings") != settings:
+        log("info", f"Full rebuild of {CHROMA_PATH}")
+        if os.path.exists(CHROMA_PATH):
+            shutil.rmtree(CHROMA_PATH)
+        manifest = {"version": manifest.get("version", 0), "settings": settings, "files": {}}
+
+    current_files = {os.path.basename(path): path for path in list_transcript_files()}
+    pending = set(pending)
+    current_files.update((name, os.path.join(DATA_PATH, name)) for name in pending)
+    # Hashes of the pending transcripts are taken when they arrive
+    current_hashes = {name: file_sha256(path) for name, path in current_files.items() if name not in pending}
+    indexed = manifest["files"]
+    changed = [name for name, digest in current_hashes.items()
+               if indexed.get(name, {}).get("sha256") != digest] + sorted(pending)
+    removed = [name for name in indexed if name not in current_files]
+    dedup = None
+    if settings.get("dedup"):
+        dedup = open_dedup(settings["dedup"])
+        add_dependents(indexed, changed, removed)
+    log("info", f"{len(changed)} new or changed ({len(pending)} downloading) and {len(removed)} removed "
+                f"transcripts out of {len(current_files)}")
+    if not changed and not removed:
+        # Nothing to download either; finishing the sync saves what it adopted into its manifest
+        for _ in incoming or ():
+            pass
+        with metrics.span("summarize"):
+            update_summaries(current_files, current_hashes)
+        if get_vector_store_name() == "mmap" and not vector_store_current(manifest.get("version", 0)):
+            # Missing, or exported from an earlier index (RAG_VECTOR_STORE was chroma meanwhile)
+            save_vector_store(open_chroma(), manifest.get("version", 0))
+        return
+
+    db = open_chroma()
+    stale_ids = [chunk_id for name in changed + removed
+                 for chunk_id in indexed.get(name, {}).get("chunk_ids", [])]
+    delete_from_chroma(db, stale_ids)
+    for name in removed:
+        del indexed[name]
+    if dedup is not None:
+        for name in changed + removed:
+            dedup.index.remove_file(name)
+
+    if changed:
+        for name in changed:
+            indexed[name] = {"sha256": current_hashes.get(name), "chunk_ids": []}
+        log("info", f"*** Start Parse/Chunk/Embed of {len(changed)} transcripts ***")
+        paths = itertools.chain((current_files[name] for name in changed if name not in pending),
+                                arrivals(incoming or (), pending, current_hashes, indexed))
+        for chunks, ids in index_transcripts(db, paths, settings, dedup):
+            for chunk, chunk_id in zip(chunks, ids):
+                indexed[os.path.basename(chunk.metadata["source"])]["chunk_ids"].append(chunk_id)
+        for name in pending - current_hashes.keys():
+            # Failed to download: forget it, so the next run indexes it again
+            log("warning", f"{name} was not downloaded; it will be indexed on the next run")
+            del indexed[name]
+            del current_files[name]
+    with metrics.span("summarize"):
+        update_summaries(current_files, current_hashes)
+    if dedup is not None:
+        save_dedup(dedup, indexed)
+    with metrics.span("episode_index"):
+        save_episode_index(db)
+    manifest["version"] = manifest.get("version", 0) + 1
+    if get_vector_store_name() == "mmap":
+        with metrics.span("vector_store_export"):
+            save_vector_store(db, manifest["version"])
+    save_manifest(manifest)
+
+
+def arrivals(incoming, pending: set, hashes: dict, indexed: dict):
+    """The paths of the pending transcripts as the sync lands them, with their hashes recorded."""
+    for path in incoming:
+        name = os.path.basename(path)
+        if name in pending:
+            hashes[name] = indexed[name]["sha256"] = file_sha256(path)
+            yield path
+
+
+def index_transcripts(db: Chroma, paths, settings: dict, dedup=None):
+    """
+    Streams the transcripts (any iterable of paths, consumed as the workers free up)
+    through the parse/chunk process pool into Chroma one bounded batch at a time,
+    yielding (chunks, ids) for each batch once it is stored. With a
+    dedup.Deduplicator only chunks that are not near-duplicates are stored.
+    """
+    stats = StageStats()
+    # Profiling only sees this process, so a profiled run parses and chunks in-process
+    workers = 1 if metrics.profiling() else get_ingest_workers()
+    for chunks in iter_chunk_batches(paths, settings, batch_size=get_ingest_batch_size(),
+                                     workers=workers, stats=stats, dedup=dedup):
+        ids = [make_chunk_id(chunk) for chunk in chunks]
+        start_time = time.perf_counter()
+        save_to_chroma(chunks, ids, db)
+        if dedup is not None:
+            # Chunks that just turned out to be boilerplate, possibly stored in an earlier batch or run
+            delete_from_chroma(db, dedup.pop_boilerplate(), "boilerplate")
+        stats.seconds["embed+index"] += time.perf_counter() - start_time
+        yield chunks, ids
+    log("info", f"Ingestion throughput: {stats.summary()}")
+    if dedup is not None:
+        delete_from_chroma(db, dedup.pop_boilerplate(), "boilerplate")
+        log("info", f"Dedup: {dedup.summary()}")
+        for key, value in dedup.stats.items():
+            metrics.inc("rag_dedup_total", value, outcome=key)
+    from embedding_cache import CachedEmbeddings
+    if isinstance(db.embeddings, CachedEmbeddings):
+        log("info", f"Embedding cache: {db.embeddings.cache.stats()}")
+
+
+def open_dedup(dedup_settings: dict):
+    """Deduplicator over the signatures of what is already indexed (empty after a full rebuild)."""
+    from dedup import DedupIndex, Deduplicator
+    index = DedupIndex.load(DEDUP_INDEX_PATH, dedup_settings["num_perm"], dedup_settings["bands"])
+    return Deduplicator(index, make_chunk_id, threshold=dedup_settings["threshold"],
+                        episode_threshold=dedup_settings["episode_threshold"],
+                        boilerplate_min=dedup_settings["boilerplate_min"])
+
+
+def add_dependents(indexed: dict, changed: list, removed: list):
+    """
+    Adds to changed the files that reuse a chunk of (shared_chunk_ids) or duplicate
+    (duplicate_of) a changed or removed file, transitively: their content is only in
+    the index through the file that goes away.
+    """
+    affected = set(changed) | set(removed)
+    stale = {chunk_id for name in affected for chunk_id in indexed.get(name, {}).get("chunk_ids", [])}
+    while True:
+        dependents = [name for name, entry in indexed.items() if name not in affected and (
+            entry.get("duplicate_of") in affected or stale.intersection(entry.get("shared_chunk_ids", ())))]
+        if not dependents:
+            return
+        for name in dependents:
+            changed.append(name)
+            affected.add(name)
+            stale.update(indexed[name]["chunk_ids"])
+
+
+def save_dedup(dedup, indexed: dict):
+    """
+    Records duplicates and shared chunks in the manifest entries, drops the chunks that
+    became boilerplate (and were deleted from Chroma) from them and saves the signatures.
+    """
+    for name, entry in indexed.items():
+        entry["chunk_ids"] = [chunk_id for chunk_id in entry["chunk_ids"] if not dedup.index.is_boilerplate(chunk_id)]
+        if name in dedup.duplicate_of:
+            entry["duplicate_of"] = dedup.duplicate_of[name]
+        shared = dedup.shared_chunk_ids(name, entry.get("shared_chunk_ids", []))
+        if shared:
+            entry["shared_chunk_ids"] = shared
+        else:
+            entry.pop("shared_chunk_ids", None)
+    dedup.index.save(DEDUP_INDEX_PATH)
+
+
+def save_episode_index(db: Chroma):
+    """Rebuilds the episode index from the stored chunk embeddings, so RAG_RETRIEVAL can switch to two-stage any time."""
+    from retrieval import EpisodeIndex
+    start_time = time.perf_counter()
+    episode_index = EpisodeIndex.from_collection(db._collection)
+    episode_index.save(EPISODE_INDEX_PATH)
+    log("info", f"Saved {len(episode_index.keys)} episodes ({len(episode_index.chunk_ids)} chunks) to "
+                f"{EPISODE_INDEX_PATH}. Took {time.perf_counter() - start_time} seconds")
+
+
+def vector_store_current(version: int) -> bool:
+    """Whether the exported store matches the index at manifest version and the RAG_VECTOR_* settings."""
+    from vector_store import read_layout
+    layout = read_layout(VECTOR_STORE_PATH)
+    return layout is not None and layout.get("version") == version and \
+        layout.get("dtype") == get_vector_store_dtype() and layout.get("index") == get_vector_store_index()
+
+
+def save_vector_store(db: Chroma, version: int):
+    """
+    Exports the chunks just saved to Chroma into the memory-mapped store searched with
+    RAG_VECTOR_STORE=mmap, tagged with the manifest version of the index.
+    """
+    from vector_store import MmapVectorStore
+    start_time = time.perf_counter()
+    MmapVectorStore.build_from_collection(VECTOR_STORE_PATH, db._collection, dtype=get_vector_store_dtype(),
+                                          index=get_vector_store_index(), version=version)
+    log("info", f"Exported {db._collection.count()} chunks to {VECTOR_STORE_PATH}. "
+                f"Took {time.perf_counter() - start_time} seconds")
+
+
+def update_summaries(paths: dict, hashes: dict):
+    """Summarizes new or changed transcripts into the episode summary store (RAG_SUMMARIZER, off by default)."""
+    from episode_summaries import EpisodeSummaryStore, get_summarizer, summarize_transcripts
+    summarizer = get_summarizer()
+    if summarizer is None:
+        return
+    start_time = time.perf_counter()
+    written = summarize_transcripts(EpisodeSummaryStore(get_summary_path()), summarizer, paths, hashes)
+    log("info", f"Summarized {written} transcripts with {summarizer.name}. "
+                f"Took {time.perf_counter() - start_time} seconds")
+
+
+def get_ingest_settings() -> dict:
+    """Settings that change the produced chunks or vectors; any difference forces a full rebuild."""
+    settings = {
+        "chunker": "RecursiveCharacterTextSplitter",
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "embedding_model": embedding_model,
+    }
+    if get_chunker() == "sentence-token":
+        settings.update(chunker="SentenceTokenSplitter", chunk_size=get_chunk_tokens(),
+                        chunk_overlap=get_chunk_overlap_tokens())
+    # Quantized/ONNX backends produce slightly different vectors than torch
+    if embedding_model != "OPENAI" and get_embedding_backend_name() != "torch":
+        settings["embedding_backend"] = get_embedding_backend_name()
+    # HNSW parameters from tune_hnsw.py. Chroma cannot change them on an existing collection, so a new
+    # configuration rebuilds the index (vectors then mostly come from the embedding cache)
+    hnsw_config = load_hnsw_config()
+    if hnsw_config:
+        settings["hnsw"] = hnsw_config
+    if dedup_enabled():
+        settings["dedup"] = {
+            "num_perm": DEDUP_NUM_PERM,
+            "bands": DEDUP_BANDS,
+            "threshold": get_dedup_threshold(),
+            "episode_threshold": get_dedup_episode_threshold(),
+            "boilerplate_min": get_dedup_boilerplate_min(),
+        }
+    return settings
+
+
+def load_hnsw_config() -> dict:
+    """Collection metadata written by tune_hnsw.py --apply, or {} for Chroma's defaults."""
+    if not os.path.exists(get_hnsw_config_path()):
+        return {}
+    with open(get_hnsw_config_path(), "r") as f:
+        return json.load(f)
+
+
+def load_manifest() -> dict:
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict):
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def list_transcript_files() -> list:
+    return sorted(glob.glob(os.path.join(DATA_PATH, "*.txt")))
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def make_chunk_id(chunk: Document) -> str:
+    """Stable id for a chunk: transcript file, offset in the transcript and a hash of the text."""
+    name = os.path.basename(chunk.metadata["source"])
+    text_hash = hashlib.sha1(chunk.page_content.encode("utf-8")).hexdigest()[:16]
+    return f"{name}:{chunk.metadata.get('start_index', 0)}:{text_hash}"
 
 
-import json
-from langchain.docstore.document import Document
 
 def load_json_from_string(json_string):
     """Loads JSON data from a string (assuming it's a single JSON object or JSON Lines)."""
+    from langchain.docstore.document import Document
     documents = []
     try:
         # Attempt to load as a single JSON object first
@@ -113,31 +453,37 @@ def load_json_from_string(json_string):
 
     return documents
 # Function to extract metadata
-def extract_metadata(json_data, _):
+def extract_metadata(json_data, metadata):
     return {
         "page_content": json_data.get("text", ""),  # Extract transcript text
+        "source": metadata.get("source", ""),  # Transcript file, used for stable chunk ids
         "episode_name": json_data.get("Episode Name", ""),
         "podcast_name": json_data.get("Podcast Name", ""),
         "episode_link": json_data.get("Episode Link", ""),
         "duration": json_data.get("duration", ""),
     }
-def load_documents():
+def load_documents(paths: list = None):
+    from langchain_community.document_loaders import DirectoryLoader, JSONLoader
     log("info", f"Loading Documents  ")
     start_time = time.perf_counter() 
-    
-    # Use DirectoryLoader to load JSON transcripts
-    loader = DirectoryLoader(
-        DATA_PATH,
-        glob="*.txt",  # JSON files stored with .txt extension
-        loader_cls=JSONLoader,
-        loader_kwargs={
-            "jq_schema": ".",  # Load entire JSON structure
-            "text_content": False,  # Use "text" field as the main content
-            "metadata_func": extract_metadata,
-            },
-        
-    )
-    documents = loader.load()
+    loader_kwargs = {
+        "jq_schema": ".",  # Load entire JSON structure
+        "text_content": False,  # Use "text" field as the main content
+        "metadata_func": extract_metadata,
+    }
+    if paths is None:
+        # Use DirectoryLoader to load JSON transcripts
+        loader = DirectoryLoader(
+            DATA_PATH,
+            glob="*.txt",  # JSON files stored with .txt extension
+            loader_cls=JSONLoader,
+            loader_kwargs=loader_kwargs,
+        )
+        documents = loader.load()
+    else:
+        documents = []
+        for path in paths:
+            documents.extend(JSONLoader(path, **loader_kwargs).load())
     for doc in documents:
         doc.page_content = doc.metadata.pop("page_content", "")  # Move text from metadata to content
 
@@ -151,12 +497,7 @@ def load_documents():
 def split_text(documents: list[Document]):
     log("info", f"*** Start Chunking ***")
     start_time = time.perf_counter() 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=300,
-        chunk_overlap=100,
-        length_function=len,
-        add_start_index=True,
-    )
+    text_splitter = make_splitter(get_ingest_settings())
     chunks = text_splitter.split_documents(documents)
     end_time = time.perf_counter() 
     elapsed_time = end_time - start_time 
@@ -165,31 +506,47 @@ def split_text(documents: list[Document]):
     return chunks
 
 def load_sentence_transformer():
+    from sentence_transformers import SentenceTransformer
     # You can choose any pre-trained model from Sentence-Transformers
     return SentenceTransformer(embedding_model)  # or 'distilbert-base-nli-stsb-mean-tokens'
 
-def save_to_chroma(chunks: list[Document]):
+def open_chroma() -> Chroma:
+    from langchain_chroma import Chroma
+    from rag_embeddings import get_embeddings
+    return Chroma(
+        embedding_function=get_embeddings(embedding_model),
+        persist_directory=CHROMA_PATH,
+        # Only applied when the collection is created, i.e. on a (full) rebuild
+        collection_metadata=load_hnsw_config() or None,
+    )
+
+
+def delete_from_chroma(db: Chroma, ids: list, reason: str = "stale"):
+    for i in range(0, len(ids), INDEX_BATCH_SIZE):
+        db.delete(ids=ids[i:i + INDEX_BATCH_SIZE])
+    if ids:
+        log("info", f"Deleted {len(ids)} {reason} chunks from {CHROMA_PATH}")
+
+
+def save_to_chroma(chunks: list[Document], ids: list = None, db: Chroma = None):
+    """Embeds the chunks and upserts them under the given ids (stable ids from make_chunk_id by default)."""
     log("info", f"*** Start Embedding  ***")
     start_time = time.perf_counter() 
-    # Clear out the database first.
-    if os.path.exists(CHROMA_PATH):
-        shutil.rmtree(CHROMA_PATH)
+    if db is None:
+        db = open_chroma()
+    if ids is None:
+        ids = [make_chunk_id(chunk) for chunk in chunks]
 
-    # Create a new DB from the documents.
-    
-    if embedding_model != "OPENAI":
-        model = load_sentence_transformer()
-        embeddings = HuggingFaceEmbeddings(model_name=embedding_model)
-    else:
-        embeddings = OpenAIEmbeddings()
-    
-
-    # Get embeddings for the documents
-    db = Chroma.from_documents(
-        documents=chunks, 
-        embedding=embeddings,
-        persist_directory=CHROMA_PATH
-    )
+    # Embed and write separately (what add_documents does in one call) so each stage is timed on its own
+    for i in range(0, len(chunks), INDEX_BATCH_SIZE):
+        batch = chunks[i:i + INDEX_BATCH_SIZE]
+        texts = [chunk.page_content for chunk in batch]
+        with metrics.span("embed"):
+            embeddings = db.embeddings.embed_documents(texts)
+        with metrics.span("index_write"):
+            db._collection.upsert(ids=ids[i:i + INDEX_BATCH_SIZE], embeddings=embeddings,
+                                  metadatas=[chunk.metadata for chunk in batch], documents=texts)
+    metrics.inc("rag_chunks_indexed_total", len(chunks))
     end_time = time.perf_counter() 
     elapsed_time = end_time - start_time 
     log("info", f"Saved {len(chunks)} chunks to {CHROMA_PATH}. Took {elapsed_time} seconds")
@@ -0,0 +1,276 @@
+"""
+Build-once index snapshots: the ingestion box packs the finished Chroma directory into a
+versioned, checksummed tar.gz and publishes it to S3, and query nodes poll for new
+snapshots, verify them and hot-swap their RagEngine onto the new index.
+
+Layout under RAG_SNAPSHOT_PREFIX in the bucket:
+
+    <prefix>/<snapshot id>/index.tar.gz
+    <prefix>/<snapshot id>/snapshot.json    # id, index version, sha256, bytes, created
+    <prefix>/LATEST.json                    # snapshot.json of the live snapshot, written last
+
+Query nodes keep the unpacked snapshots in RAG_SNAPSHOT_DIR/<snapshot id>, with the id of
+the live one in RAG_SNAPSHOT_DIR/CURRENT so a restart serves it without downloading.
+Rolling back is rewriting LATEST.json with an older snapshot.json.
+
+    python index_snapshot.py publish        # after generate_data_store.py
+    python index_snapshot.py pull           # fetch LATEST into RAG_SNAPSHOT_DIR once
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+
+from util import *
+
+ARCHIVE_NAME = "index.tar.gz"
+META_NAME = "snapshot.json"
+LATEST_KEY = "LATEST.json"
+CURRENT_FILE = "CURRENT"
+# Episode summaries travel inside the snapshot, so query nodes need no summarizer either
+SUMMARY_FILE = "episode_summaries.json"
+MANIFEST_FILE = "ingest_manifest.json"
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_index_version(chroma_path: str) -> int:
+    try:
+        with open(os.path.join(chroma_path, MANIFEST_FILE), "r") as f:
+            return json.load(f).get("version", 0)
+    except OSError:
+        return 0
+
+
+def pack_snapshot(chroma_path: str, archive_path: str, summary_path: str = None) -> dict:
+    """
+    Writes chroma_path (and the episode summaries, when summary_path exists) to a tar.gz
+    at archive_path and returns its snapshot.json entry. Run it once ingestion finished;
+    Chroma must not be writing while the files are read.
+    """
+    version = read_index_version(chroma_path)
+    snapshot_id = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-v{version}"
+    start_time = time.perf_counter()
+    with tarfile.open(archive_path, "w:gz", compresslevel=6) as tar:
+        for name in sorted(os.listdir(chroma_path)):
+            if name.endswith((".tmp", ".part")):
+                continue
+            tar.add(os.path.join(chroma_path, name), arcname=name)
+        if summary_path and os.path.exists(summary_path):
+            tar.add(summary_path, arcname=SUMMARY_FILE)
+    return {
+        "id": snapshot_id,
+        "version": version,
+        "sha256": sha256_file(archive_path),
+        "bytes": os.path.getsize(archive_path),
+        "created": time.time(),
+        "pack_seconds": time.perf_counter() - start_time,
+    }
+
+
+def unpack_snapshot(archive_path: str, meta: dict, target_dir: str):
+    """Verifies the archive against meta["sha256"] and unpacks it into target_dir, which appears atomically."""
+    digest = sha256_file(archive_path)
+    if digest != meta["sha256"]:
+        raise ValueError(f"Checksum mismatch for snapshot {meta['id']}: expected {meta['sha256']}, got {digest}")
+    tmp_dir = target_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    with tarfile.open(archive_path, "r:gz") as tar:
+        tar.extractall(tmp_dir, filter="data")
+    with open(os.path.join(tmp_dir, META_NAME), "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_dir, target_dir)
+
+
+def get_snapshot_uploader(s3_client=None):
+    from s3Connect import S3Uploader
+    return S3Uploader(get_bucket_name(), prefix=get_snapshot_prefix(), s3_client=s3_client)
+
+
+def publish_snapshot(chroma_path: str, uploader=None, summary_path: str = None) -> dict:
+    """
+    Packs chroma_path and uploads it as a new snapshot through S3Uploader. LATEST.json is
+    only written after the archive and its snapshot.json are uploaded, so pollers never
+    see a partial snapshot. Returns the snapshot's metadata.
+    """
+    uploader = uploader or get_snapshot_uploader()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        archive_path = os.path.join(tmp_dir, ARCHIVE_NAME)
+        meta = pack_snapshot(chroma_path, archive_path, summary_path)
+        result = uploader.upload_file_timed(archive_path, f"{meta['id']}/{ARCHIVE_NAME}")
+    if not result["ok"]:
+        raise RuntimeError(f"Uploading snapshot {meta['id']} failed: {result['error']}")
+    meta["upload_seconds"] = result["seconds"]
+    if not uploader.upload_json(meta, f"{meta['id']}/{META_NAME}") or not uploader.upload_json(meta, LATEST_KEY):
+        raise RuntimeError(f"Publishing snapshot {meta['id']} failed")
+    log("info", f"Published snapshot {meta['id']} ({meta['bytes']} bytes): pack {meta['pack_seconds']:.1f}s, "
+                f"upload {meta['upload_seconds']:.1f}s")
+    return meta
+
+
+def close_chroma(path: str):
+    """Stops the Chroma system cached for a persist directory, so a deleted snapshot releases its files."""
+    from chromadb.api.shared_system_client import SharedSystemClient
+    system = SharedSystemClient._identifier_to_system.pop(path, None)
+    if system is not None:
+        system.stop()
+
+
+class SnapshotPuller:
+    def __init__(self, local_root: str, uploader=None, keep: int = 2):
+        """
+        Downloads, verifies and unpacks published snapshots into local_root.
+
+        Args:
+            local_root (str): Directory holding one sub-directory per snapshot
+            uploader: S3Uploader rooted at the snapshot prefix (default: get_snapshot_uploader())
+            keep (int): Snapshots kept on disk, the live one included. The previous one stays
+                so requests still running on it when the engine swaps can finish.
+        """
+        self.local_root = local_root
+        self.uploader = uploader or get_snapshot_uploader()
+        self.keep = max(keep, 2)
+        os.makedirs(local_root, exist_ok=True)
+
+    def current(self):
+        """(snapshot id, path) of the live local snapshot, or (None, None)."""
+        try:
+            with open(os.path.join(self.local_root, CURRENT_FILE), "r") as f:
+                snapshot_id = f.read().strip()
+        except OSError:
+            return None, None
+        path = os.path.join(self.local_root, snapshot_id)
+        return (snapshot_id, path) if os.path.isdir(path) else (None, None)
+
+    def _set_current(self, snapshot_id: str):
+        current_path = os.path.join(self.local_root, CURRENT_FILE)
+        with open(current_path + ".tmp", "w") as f:
+            f.write(snapshot_id)
+        os.replace(current_path + ".tmp", current_path)
+
+    def pull(self):
+        """
+        Fetches the snapshot LATEST.json points at unless it is already live. Returns
+        (path, meta) of the unpacked snapshot, or None when there is nothing new. The
+        snapshot only becomes live with commit(), once it is serving; until then every
+        pull returns it again (without downloading it twice).
+        """
+        meta = self.uploader.read_json(LATEST_KEY)
+        if meta is None or meta["id"] == self.current()[0]:
+            return None
+        start_time = time.perf_counter()
+        target_dir = os.path.join(self.local_root, meta["id"])
+        if not os.path.isdir(target_dir):
+            archive_path = os.path.join(self.local_root, meta["id"] + ".tar.gz")
+            result = self.uploader.download_file(f"{meta['id']}/{ARCHIVE_NAME}", archive_path)
+            if not result["ok"]:
+                raise RuntimeError(f"Downloading snapshot {meta['id']} failed: {result['error']}")
+            try:
+                unpack_snapshot(archive_path, meta, target_dir)
+            finally:
+                os.remove(archive_path)
+        log("info", f"Pulled snapshot {meta['id']} ({meta['bytes']} bytes) into {target_dir}. "
+                    f"Took {time.perf_counter() - start_time} seconds")
+        return target_dir, meta
+
+    def commit(self, snapshot_id: str):
+        """Records a pulled snapshot as the live one (CURRENT) and prunes old ones."""
+        self._set_current(snapshot_id)
+        self.prune()
+
+    def prune(self):
+        """Deletes all but the newest keep snapshot directories; the live one is never deleted."""
+        current_id = self.current()[0]
+        snapshots = sorted((name for name in os.listdir(self.local_root)
+                            if os.path.isdir(os.path.join(self.local_root, name)) and not name.endswith(".tmp")),
+                           key=lambda name: os.path.getmtime(os.path.join(self.local_root, name)), reverse=True)
+        for name in snapshots[self.keep:]:
+            if name == current_id:
+                continue
+            path = os.path.join(self.local_root, name)
+            close_chroma(path)
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class SnapshotPoller:
+    def __init__(self, puller: SnapshotPuller, on_ready, interval: float = 60):
+        """
+        Background thread that calls puller.pull() every interval seconds and hands each
+        new snapshot to on_ready(path, meta), e.g. RagEngine.swap_index; the snapshot is
+        committed as live only once on_ready returned. Failures, of the download or of
+        the swap, are logged and retried on the next round; the live index keeps serving
+        meanwhile.
+        """
+        self.puller = puller
+        self.on_ready = on_ready
+        self.interval = interval
+        self.swaps = 0
+        self.errors = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="snapshot-poller", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.poll()
+
+    def poll(self) -> bool:
+        """One pull-and-swap round; returns True when a new snapshot went live."""
+        try:
+            pulled = self.puller.pull()
+            if pulled is None:
+                return False
+            self.on_ready(*pulled)
+            self.puller.commit(pulled[1]["id"])
+            self.swaps += 1
+            return True
+        except Exception as e:
+            self.errors += 1
+            log("error", f"Snapshot poll failed: {e}")
+            return False
+
+    def stats(self) -> dict:
+        return {"current": self.puller.current()[0], "swaps": self.swaps, "errors": self.errors}
+
+
+def get_snapshot_puller(s3_client=None) -> SnapshotPuller:
+    """SnapshotPuller configured from RAG_SNAPSHOT_*."""
+    return SnapshotPuller(get_snapshot_dir(), get_snapshot_uploader(s3_client), keep=get_snapshot_keep())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["publish", "pull"])
+    parser.add_argument("--chroma-path", default="chroma")
+    args = parser.parse_args()
+    if args.command == "publish":
+        meta = publish_snapshot(args.chroma_path, summary_path=get_summary_path())
+        print(json.dumps(meta, indent=2))
+    else:
+        puller = get_snapshot_puller()
+        pulled = puller.pull()
+        if pulled:
+            puller.commit(pulled[1]["id"])
+        print(f"Pulled {pulled[1]['id']} into {pulled[0]}" if pulled else "Already up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Streaming parse -> chunk stage of the ingestion pipeline.
+
+Transcripts are parsed and chunked in a process pool, a bounded number of files at a
+time, and handed back as batches of LangChain Documents. Peak memory therefore depends
+on the batch size and the number of files in flight, not on the size of the corpus.
+"""
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import metrics
+
+try:
+    import orjson
+
+    def _loads(raw: bytes):
+        return orjson.loads(raw)
+except ImportError:
+    def _loads(raw: bytes):
+        return json.loads(raw)
+
+# Splitter (and, with dedup settings, MinHasher) built once per worker process by _init_worker
+_splitter = None
+_hasher = None
+
+
+def parse_transcript(path: str) -> tuple:
+    """Reads one transcript file (a JSON object stored as .txt) into (text, metadata)."""
+    with open(path, "rb") as f:
+        data = _loads(f.read())
+    metadata = {
+        "source": path,
+        "episode_name": data.get("Episode Name", ""),
+        "podcast_name": data.get("Podcast Name", ""),
+        "episode_link": data.get("Episode Link", ""),
+        "duration": data.get("duration", ""),
+    }
+    return data.get("text", "") or "", metadata
+
+
+def make_splitter(settings: dict):
+    """The chunker named by settings["chunker"]; chunk sizes are in characters, or tokens for SentenceTokenSplitter."""
+    if settings["chunker"] == "SentenceTokenSplitter":
+        from chunking import SentenceTokenSplitter, get_embedding_tokenizer
+        return SentenceTokenSplitter(get_embedding_tokenizer(settings["embedding_model"]),
+                                     chunk_tokens=settings["chunk_size"], overlap_tokens=settings["chunk_overlap"])
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(
+        chunk_size=settings["chunk_size"],
+        chunk_overlap=settings["chunk_overlap"],
+        length_function=len,
+        add_start_index=True,
+    )
+
+
+def _init_worker(settings: dict):
+    global _splitter, _hasher
+    _splitter = make_splitter(settings)
+    if settings.get("dedup"):
+        from dedup import MinHasher
+        _hasher = MinHasher(settings["dedup"]["num_perm"])
+    else:
+        _hasher = None
+
+
+def chunk_transcript(path: str) -> dict:
+    """
+    Parses and chunks one transcript. Runs in a worker process, so it returns plain
+    (text, metadata) pairs plus its own timings rather than Document objects. With
+    dedup settings it also returns the MinHash signatures of the transcript and of
+    every chunk, so the hashing runs in parallel too.
+    """
+    start_time = time.perf_counter()
+    # Only profiled when run in-process (a profiled ingestion uses one worker)
+    with metrics.profile("parse"):
+        text, metadata = parse_transcript(path)
+    parsed_time = time.perf_counter()
+    with metrics.profile("chunk"):
+        chunks = [(doc.page_content, doc.metadata) for doc in _splitter.create_documents([text], [metadata])]
+    result = {
+        "path": path,
+        "chunks": chunks,
+        "text_chars": len(text),
+        "parse_seconds": parsed_time - start_time,
+        "chunk_seconds": time.perf_counter() - parsed_time,
+    }
+    if _hasher is not None:
+        from dedup import EPISODE_SHINGLE, CHUNK_SHINGLE
+        hashed_time = time.perf_counter()
+        result["episode_signature"] = _hasher.signature(text, EPISODE_SHINGLE)
+        result["signatures"] = _hasher.signatures([chunk_text for chunk_text, _ in chunks], CHUNK_SHINGLE)
+        result["minhash_seconds"] = time.perf_counter() - hashed_time
+    return result
+
+
+class StageStats:
+    def __init__(self):
+        """Accumulated work and busy time per pipeline stage, for throughput logging."""
+        self.files = 0
+        self.chunks = 0
+        self.text_chars = 0
+        self.chunk_sizes = []  # characters per chunk
+        self.seconds = {"parse": 0.0, "chunk": 0.0, "embed+index": 0.0}
+        self.start_time = time.perf_counter()
+
+    def add_file(self, result: dict):
+        self.files += 1
+        self.chunks += len(result["chunks"])
+        self.text_chars += result["text_chars"]
+        self.chunk_sizes.extend(len(text) for text, _ in result["chunks"])
+        self.seconds["parse"] += result["parse_seconds"]
+        self.seconds["chunk"] += result["chunk_seconds"]
+        # Timed in the worker process, recorded here where the metrics live
+        metrics.record_span("parse", result["parse_seconds"])
+        metrics.record_span("chunk", result["chunk_seconds"])
+        if "minhash_seconds" in result:
+            metrics.record_span("minhash", result["minhash_seconds"])
+
+    def summary(self) -> str:
+        wall = time.perf_counter() - self.start_time
+        parse = self.seconds["parse"] or 1e-9
+        chunk = self.seconds["chunk"] or 1e-9
+        index = self.seconds["embed+index"] or 1e-9
+        return (f"{self.files} files, {self.chunks} chunks in {wall:.2f} s wall | "
+                f"parse {self.files / parse:.1f} files/s (worker time {parse:.2f} s) | "
+                f"chunk {self.chunks / chunk:.1f} chunks/s (worker time {chunk:.2f} s) | "
+                f"embed+index {self.chunks / index:.1f} chunks/s ({index:.2f} s) | "
+                f"overall {self.files / wall:.2f} files/s, {self.chunks / wall:.1f} chunks/s | {self.chunk_summary()}")
+
+    def chunk_summary(self) -> str:
+        """Redundancy (chunk characters per transcript character) and chunk size distribution."""
+        if not self.chunk_sizes:
+            return "no chunks"
+        sizes = sorted(self.chunk_sizes)
+        return (f"redundancy {sum(sizes) / max(self.text_chars, 1):.2f}x, chunk chars min {sizes[0]} "
+                f"p50 {sizes[len(sizes) // 2]} p95 {sizes[min(len(sizes) * 95 // 100, len(sizes) - 1)]} max {sizes[-1]}")
+
+
+def _iter_results(paths: list, settings: dict, workers: int):
+    """Yields chunk_transcript results with at most 2 * workers files in flight."""
+    if workers <= 1:
+        _init_worker(settings)
+        for path in paths:
+            yield chunk_transcript(path)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(settings,)) as executor:
+        pending = set()
+        remaining = iter(paths)
+        for path in remaining:
+            pending.add(executor.submit(chunk_transcript, path))
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                next_path = next(remaining, None)
+                if next_path is not None:
+                    pending.add(executor.submit(chunk_transcript, next_path))
+
+
+def iter_chunk_batches(paths: list, settings: dict, batch_size: int = 512, workers: int = None, stats: StageStats = None,
+                       dedup=None):
+    """
+    Parses and chunks the transcripts in a process pool and yields lists of at most
+    batch_size chunk Documents, as soon as enough chunks are ready.
+
+    Args:
+        paths (iterable): Transcript files to process, consumed lazily, e.g. as an S3 sync lands them
+        settings (dict): Chunker settings (see generate_data_store.get_ingest_settings)
+        batch_size (int): Chunks per yielded batch
+        workers (int): Worker processes (default: CPU count; 1 runs in-process)
+        stats (StageStats): Collects per-stage counts and timings if given
+        dedup (dedup.Deduplicator): Drops near-duplicate episodes and chunks before they are batched
+            (requires settings["dedup"])
+    """
+    from langchain.schema import Document
+    workers = workers or os.cpu_count() or 1
+    if hasattr(paths, "__len__"):
+        workers = min(workers, max(len(paths), 1))
+    batch = []
+    for result in _iter_results(paths, settings, workers):
+        if stats is not None:
+            stats.add_file(result)
+        if dedup is not None and not dedup.accept_episode(result):
+            continue
+        for i, (text, metadata) in enumerate(result["chunks"]):
+            chunk = Document(page_content=text, metadata=metadata)
+            if dedup is not None and not dedup.accept_chunk(chunk, result["signatures"][i]):
+                continue
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,359 @@
+"""
+Counters, histograms and per-request trace spans for the ingestion and query hot paths.
+
+Off unless RAG_METRICS=on (or enable() is called): every helper then returns after one
+flag check and span() hands back a shared no-op context manager, so instrumented code
+pays next to nothing. When on, span(stage) observes the stage's duration in the
+rag_stage_seconds histogram and, inside trace(), appends it to the current request's
+trace, so a slow answer shows which stage it spent its time in.
+
+Stages: s3_sync, parse, chunk, embed, index_write, query_embed, vector_search,
+context_build, llm.
+
+    with metrics.trace("answer") as request_trace:
+        with metrics.span("query_embed"):
+            ...
+    print(request_trace.summary())
+
+Export with to_prometheus() (query_server's /metrics) or to_dict()/dump_json().
+
+span() is also where profiling.Profiler hooks in: while one is installed (RAG_PROFILE),
+every span and profile() block runs under cProfile and tracemalloc.
+"""
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+from util import metrics_enabled, get_metrics_trace_keep
+
+# Seconds; spans run from sub-millisecond searches to minute-long ingestion batches
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+STAGE_METRIC = "rag_stage_seconds"
+REQUEST_METRIC = "rag_request_seconds"
+
+_enabled = metrics_enabled()
+_profiler = None
+_current_trace = contextvars.ContextVar("rag_trace", default=None)
+
+
+def enable(on: bool = True):
+    global _enabled
+    _enabled = on
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def profiling() -> bool:
+    return _profiler is not None
+
+
+def set_profiler(profiler):
+    """Installs (or with None removes) a profiling.Profiler wrapped around every span."""
+    global _profiler
+    _profiler = profiler
+
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str = ""):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}  # label key -> total
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def to_prometheus(self) -> list:
+        return [f"{self.name}{format_labels(key)} {value}" for key, value in sorted(self.values.items())]
+
+    def to_dict(self) -> dict:
+        return {format_labels(key) or "total": value for key, value in sorted(self.values.items())}
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str = "", buckets: tuple = DEFAULT_BUCKETS):
+        """Fixed-bucket histogram per label set, with sum and count, as Prometheus expects."""
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.values = {}  # label key -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def to_prometheus(self) -> list:
+        lines = []
+        for key, counts in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(key, (('le', bound),))} {cumulative}")
+            cumulative += counts[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{format_labels(key, (('le', '+Inf'),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+    def to_dict(self) -> dict:
+        result = {}
+        for key, counts in sorted(self.values.items()):
+            count = sum(counts[:-1])
+            result[format_labels(key) or "total"] = {
+                "count": count,
+                "sum": counts[-1],
+                "mean": counts[-1] / count if count else 0.0,
+                "p50": self._quantile(counts, 0.5),
+                "p95": self._quantile(counts, 0.95),
+            }
+        return result
+
+    def _quantile(self, counts: list, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile (the last finite bound for the overflow bucket)."""
+        total = sum(counts[:-1])
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return self.buckets[-1]
+
+
+class Registry:
+    def __init__(self, trace_keep: int = 100):
+        self.metrics = {}
+        self.traces = deque(maxlen=trace_keep)  # most recent finished traces
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, help_text: str):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.setdefault(name, cls(name, help_text))
+        return metric
+
+    def counter(self, name: str, help_text: str = "") -> Counter:
+        return self._get(Counter, name, help_text)
+
+    def histogram(self, name: str, help_text: str = "") -> Histogram:
+        return self._get(Histogram, name, help_text)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            if metric.help_text:
+                lines.append(f"# HELP {name} {metric.help_text}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.to_prometheus())
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> dict:
+        return {
+            "metrics": {name: {"type": metric.kind, "values": metric.to_dict()}
+                        for name, metric in sorted(self.metrics.items())},
+            "traces": list(self.traces),
+        }
+
+    def reset(self):
+        with self._lock:
+            self.metrics.clear()
+            self.traces.clear()
+
+
+REGISTRY = Registry(get_metrics_trace_keep())
+REGISTRY.histogram(STAGE_METRIC, "Time spent per pipeline stage")
+REGISTRY.histogram(REQUEST_METRIC, "End-to-end time per traced request")
+
+
+def inc(name: str, value: float = 1, **labels):
+    if _enabled:
+        REGISTRY.counter(name).inc(value, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    if _enabled:
+        REGISTRY.histogram(name).observe(value, **labels)
+
+
+def record_span(stage: str, seconds: float, start: float = None):
+    """Records a stage timed elsewhere (e.g. in a worker process) like a finished span()."""
+    if not _enabled:
+        return
+    REGISTRY.histogram(STAGE_METRIC).observe(seconds, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds, start)
+
+
+class Span:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record_span(self.stage, time.perf_counter() - self.start, self.start)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def span(stage: str):
+    """Context manager timing one stage (no-op when metrics and profiling are off)."""
+    if _profiler is not None:
+        return _profiler.span(stage, Span(stage) if _enabled else NOOP_SPAN)
+    return Span(stage) if _enabled else NOOP_SPAN
+
+
+def profile(stage: str):
+    """
+    Profiles a block without recording it as a metric, for stages timed some other way
+    (parse and chunk report their own timings) or whole query turns.
+    """
+    if _profiler is not None:
+        return _profiler.span(stage, NOOP_SPAN)
+    return NOOP_SPAN
+
+
+def timed(stage: str):
+    """Decorator form of span()."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled and _profiler is None:
+                return func(*args, **kwargs)
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Trace:
+    def __init__(self, name: str):
+        """The spans of one request, in the order they finished, with offsets from the request start."""
+        self.name = name
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        self.spans = []
+        self.seconds = None
+        self.attributes = {}
+        self._token = None
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float, start: float = None):
+        offset = (start if start is not None else time.perf_counter() - seconds) - self.start
+        with self._lock:
+            self.spans.append({"stage": stage, "offset_ms": offset * 1000, "ms": seconds * 1000})
+
+    def set(self, key: str, value):
+        """Attaches an attribute to the request, e.g. which cache answered it."""
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self._token = _current_trace.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_trace.reset(self._token)
+        self.seconds = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        REGISTRY.histogram(REQUEST_METRIC).observe(self.seconds, request=self.name)
+        REGISTRY.traces.append(self.to_dict())
+        return False
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "started_at": self.started_at,
+                "ms": self.seconds * 1000 if self.seconds is not None else None,
+                "attributes": self.attributes, "spans": list(self.spans)}
+
+    def summary(self) -> str:
+        """One line per request, e.g. "query_embed 12.1ms | vector_search 3.4ms | llm 812.0ms"."""
+        return " | ".join(f"{span['stage']} {span['ms']:.1f}ms" for span in self.spans)
+
+
+class _NoopTrace(_NoopSpan):
+    __slots__ = ()
+
+    def set(self, key: str, value):
+        pass
+
+    def to_dict(self):
+        return None
+
+    def summary(self) -> str:
+        return ""
+
+
+NOOP_TRACE = _NoopTrace()
+
+
+def trace(name: str):
+    """Context manager collecting the spans of one request (no-op when metrics are off)."""
+    return Trace(name) if _enabled else NOOP_TRACE
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def to_prometheus() -> str:
+    return REGISTRY.to_prometheus()
+
+
+def to_dict() -> dict:
+    return REGISTRY.to_dict()
+
+
+def dump_json(path: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(to_dict(), f, indent=2)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,305 @@
+"""
+Opt-in CPU and memory profiling of the pipeline stages.
+
+With RAG_PROFILE=on (or --profile on generate_data_store.py and query.py) every
+metrics.span() stage and every query turn runs under cProfile and tracemalloc. Each
+stage's profile is exclusive: while a nested stage runs, its parent's profiler is
+paused. When the run ends, RAG_PROFILE_DIR/<run id>/ gets these files:
+
+    <stage>.prof    pstats dump of the stage, for pstats/snakeviz
+    <stage>.txt     top functions by cumulative time
+    report.json     per stage: calls, wall seconds, top functions, peak and retained
+                    allocations and, with RAG_PROFILE_SITES=on, the allocation sites
+                    that grew the most
+
+Allocation sites need two tracemalloc snapshots and a diff. Once the embedding model
+is loaded, that takes seconds, so only the first call of each stage is sampled.
+
+Compare two runs to spot regressions; the command exits with status 1 when a stage got
+slower (or its peak memory grew) by more than --fail-above percent:
+
+    python profiling.py diff profiles/<old run>/report.json profiles/<new run>/report.json
+
+tracemalloc is process wide, so with concurrent requests the memory numbers of
+overlapping stages include each other's allocations.
+"""
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from util import *
+
+TOP_FUNCTIONS = 25
+TOP_SITES = 15
+# Sites are reported by line, so one frame per allocation is enough and keeps tracing cheap
+TRACE_FRAMES = 1
+# Allocations made by the profiler itself are not the pipeline's
+IGNORED_FILES = (tracemalloc.__file__, __file__, pstats.__file__, cProfile.__file__)
+
+
+class StageProfile:
+    def __init__(self, stage: str):
+        """Everything collected for one stage name across all its calls."""
+        self.stage = stage
+        self.calls = 0
+        self.seconds = 0.0
+        self.peak_bytes = 0
+        self.retained_bytes = 0
+        self.stats = None
+        self.sites = {}  # "file:line" -> [bytes, allocations]
+
+    def add(self, profile: cProfile.Profile, seconds: float, peak: int, retained: int, sites: list):
+        self.calls += 1
+        self.seconds += seconds
+        self.peak_bytes = max(self.peak_bytes, peak)
+        self.retained_bytes += retained
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+        for site, size, count in sites:
+            if site.startswith(IGNORED_FILES):
+                continue
+            entry = self.sites.setdefault(site, [0, 0])
+            entry[0] += size
+            entry[1] += count
+
+    def top_functions(self, limit: int = TOP_FUNCTIONS) -> list:
+        if self.stats is None:
+            return []
+        rows = sorted(self.stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+        return [{"function": f"{os.path.basename(file)}:{line}({name})", "calls": nc, "tottime": tt, "cumtime": ct}
+                for (file, line, name), (cc, nc, tt, ct, callers) in rows]
+
+    def top_sites(self, limit: int = TOP_SITES) -> list:
+        rows = sorted(self.sites.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+        return [{"site": site, "bytes": size, "allocations": count} for site, (size, count) in rows if size > 0]
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "peak_bytes": self.peak_bytes,
+            "retained_bytes": self.retained_bytes,
+            "top_functions": self.top_functions(),
+            "allocation_sites": self.top_sites(),
+        }
+
+
+class _Frame:
+    __slots__ = ("stage", "profile", "start", "snapshot", "peak")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.profile = cProfile.Profile()
+        self.start = None
+        self.snapshot = None
+        self.peak = 0
+
+
+class ProfiledSpan:
+    __slots__ = ("profiler", "stage", "inner", "frame")
+
+    def __init__(self, profiler, stage: str, inner):
+        """Profiles one stage run; inner is the metrics span it wraps (or the no-op span)."""
+        self.profiler = profiler
+        self.stage = stage
+        self.inner = inner
+        self.frame = None
+
+    def __enter__(self):
+        self.inner.__enter__()
+        self.frame = self.profiler._push(self.stage)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler._pop(self.frame)
+        return self.inner.__exit__(exc_type, exc, tb)
+
+
+class Profiler:
+    def __init__(self, out_dir: str, sites: bool = False):
+        """
+        Collects per-stage cProfile statistics and tracemalloc peaks; install() makes
+        metrics.span() and metrics.profile() use it.
+
+        Args:
+            out_dir (str): Directory the reports of this run are written to
+            sites (bool): Take tracemalloc snapshots around the first call of every stage to find allocation sites
+        """
+        self.out_dir = out_dir
+        self.sites = sites
+        self.stages = {}
+        self._sampled = set()
+        self.started = time.time()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def span(self, stage: str, inner):
+        return ProfiledSpan(self, stage, inner)
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _push(self, stage: str) -> _Frame:
+        stack = self._stack()
+        if stack:
+            parent = stack[-1]
+            parent.profile.disable()
+            parent.peak = max(parent.peak, tracemalloc.get_traced_memory()[1])
+        frame = _Frame(stage)
+        stack.append(frame)
+        if self.sites and stage not in self._sampled:
+            self._sampled.add(stage)
+            frame.snapshot = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        frame.start = (time.perf_counter(), tracemalloc.get_traced_memory()[0])
+        frame.profile.enable()
+        return frame
+
+    def _pop(self, frame: _Frame):
+        frame.profile.disable()
+        seconds = time.perf_counter() - frame.start[0]
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(frame.peak, peak)
+        sites = []
+        if frame.snapshot is not None:
+            after = tracemalloc.take_snapshot()
+            sites = [(f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}", stat.size_diff, stat.count_diff)
+                     for stat in after.compare_to(frame.snapshot, "lineno")[:TOP_SITES * 2] if stat.size_diff > 0]
+        stack = self._stack()
+        stack.pop()
+        with self._lock:
+            profile = self.stages.setdefault(frame.stage, StageProfile(frame.stage))
+            profile.add(frame.profile, seconds, peak - frame.start[1], current - frame.start[1], sites)
+        if stack:
+            parent = stack[-1]
+            parent.peak = max(parent.peak, peak)
+            parent.profile.enable()
+
+    def install(self):
+        import metrics
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+        metrics.set_profiler(self)
+        return self
+
+    def uninstall(self):
+        import metrics
+        metrics.set_profiler(None)
+        tracemalloc.stop()
+
+    def report(self) -> dict:
+        return {"started": self.started, "seconds": time.time() - self.started, "argv": sys.argv,
+                "stages": {stage: profile.to_dict() for stage, profile in sorted(self.stages.items())}}
+
+    def write(self) -> str:
+        """Writes the .prof, .txt and report.json files; returns the path of report.json."""
+        os.makedirs(self.out_dir, exist_ok=True)
+        for stage, profile in self.stages.items():
+            if profile.stats is None:
+                continue
+            profile.stats.dump_stats(os.path.join(self.out_dir, f"{stage}.prof"))
+            stream = io.StringIO()
+            pstats.Stats(os.path.join(self.out_dir, f"{stage}.prof"), stream=stream).sort_stats(
+                "cumulative").print_stats(TOP_FUNCTIONS * 2)
+            with open(os.path.join(self.out_dir, f"{stage}.txt"), "w") as f:
+                f.write(stream.getvalue())
+        report_path = os.path.join(self.out_dir, "report.json")
+        with open(report_path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        return report_path
+
+    def stop(self) -> str:
+        """Uninstalls the profiler and writes its reports."""
+        self.uninstall()
+        report_path = self.write()
+        log("info", f"Profile of {len(self.stages)} stages written to {self.out_dir}")
+        return report_path
+
+
+def start_profiler(run_name: str = None) -> Profiler:
+    """Installs a Profiler writing to RAG_PROFILE_DIR/<time>-<run_name>."""
+    run_id = time.strftime("%Y%m%d-%H%M%S") + (f"-{run_name}" if run_name else "")
+    return Profiler(os.path.join(get_profile_dir(), run_id), sites=profile_sites_enabled()).install()
+
+
+def diff_reports(old: dict, new: dict, top: int = 5) -> list:
+    """Per stage changes between two report.json files, slowest regression first."""
+    rows = []
+    for stage in sorted(set(old["stages"]) | set(new["stages"])):
+        before = old["stages"].get(stage)
+        after = new["stages"].get(stage)
+        if before is None or after is None:
+            rows.append({"stage": stage, "status": "added" if before is None else "removed"})
+            continue
+        # Per call, so runs over different amounts of data stay comparable
+        seconds_before = before["seconds"] / max(before["calls"], 1)
+        seconds_after = after["seconds"] / max(after["calls"], 1)
+        functions_before = {row["function"]: row["cumtime"] / max(before["calls"], 1) for row in before["top_functions"]}
+        function_changes = sorted(((row["cumtime"] / max(after["calls"], 1) - functions_before.get(row["function"], 0.0),
+                                    row["function"]) for row in after["top_functions"]), reverse=True)[:top]
+        rows.append({
+            "stage": stage,
+            "status": "changed",
+            "seconds_per_call": [seconds_before, seconds_after],
+            "seconds_change_pct": percent_change(seconds_before, seconds_after),
+            "peak_bytes": [before["peak_bytes"], after["peak_bytes"]],
+            "peak_change_pct": percent_change(before["peak_bytes"], after["peak_bytes"]),
+            "retained_bytes": [before["retained_bytes"], after["retained_bytes"]],
+            "slower_functions": [{"function": name, "seconds_per_call": change}
+                                 for change, name in function_changes if change > 0],
+        })
+    return sorted(rows, key=lambda row: -max(row.get("seconds_change_pct", 0), row.get("peak_change_pct", 0)))
+
+
+def percent_change(before: float, after: float) -> float:
+    if not before:
+        return 0.0 if not after else 100.0
+    return (after - before) / before * 100
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    diff_parser = subparsers.add_parser("diff", help="Compare two report.json files.")
+    diff_parser.add_argument("old")
+    diff_parser.add_argument("new")
+    diff_parser.add_argument("--fail-above", type=float, default=None,
+                             help="Exit with status 1 when a stage's time or peak memory grew by more than this percent.")
+    args = parser.parse_args()
+
+    with open(args.old, "r") as f:
+        old = json.load(f)
+    with open(args.new, "r") as f:
+        new = json.load(f)
+    regressions = 0
+    for row in diff_reports(old, new):
+        if row["status"] != "changed":
+            print(f"{row['stage']:<20} {row['status']}")
+            continue
+        before, after = row["seconds_per_call"]
+        peak_before, peak_after = row["peak_bytes"]
+        print(f"{row['stage']:<20} {before * 1000:10.2f} -> {after * 1000:10.2f} ms/call ({row['seconds_change_pct']:+.1f}%)  "
+              f"peak {peak_before / 2**20:8.1f} -> {peak_after / 2**20:8.1f} MiB ({row['peak_change_pct']:+.1f}%)")
+        for function in row["slower_functions"]:
+            print(f"    +{function['seconds_per_call'] * 1000:.2f} ms/call  {function['function']}")
+        if args.fail_above is not None and max(row["seconds_change_pct"], row["peak_change_pct"]) > args.fail_above:
+            regressions += 1
+    if regressions:
+        print(f"{regressions} stages regressed by more than {args.fail_above}%")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
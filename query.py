@@ -1,65 +1,55 @@
 import argparse
 import pprint
 # from dataclasses import dataclass
-from langchain_chroma import Chroma 
-from sentence_transformers import SentenceTransformer
-from langchain_openai import OpenAIEmbeddings
-from langchain_huggingface import HuggingFaceEmbeddings
-
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-from langchain.memory import ConversationBufferMemory
-from langchain.chains import ConversationChain
+
+from langchain_core.callbacks import BaseCallbackHandler
 # from langchain_core.runnables import RunnableWithMessageHistory
 
 from dotenv import load_dotenv
 load_dotenv()
 import os
 from util import *
+from rag_engine import RagEngine, CHROMA_PATH, PROMPT_TEMPLATE, NO_RESULTS_ANSWER, format_sources
+from session_store import get_session_store
+import metrics
 import json
-CHROMA_PATH = "chroma"
-
-PROMPT_TEMPLATE = """
-You are a friendly chatbot who answers questions based on the following context only. 
-If the context has an Episode Name, summarize the episode. Otherwise answer the question.
-If you are summarizing, limit the response to 250 words. Otherwise don't worry about word limit.
-Use a playful tone
-
-{context}
-
----
-
-Answer the question based on the above context: {question}
-"""
-embedding_model = get_rag_embedding()
-def load_sentence_transformer():
-    # You can choose any pre-trained model from Sentence-Transformers
-    return SentenceTransformer(embedding_model)  # or 'distilbert-base-nli-stsb-mean-tokens'
+import time
 
 
 def main():
     # Create CLI.
     parser = argparse.ArgumentParser()
-    parser.add_argument("query_text", type=str, help="The query text.")
-    if embedding_model != "OPENAI":
-        model = load_sentence_transformer()
-        embeddings = HuggingFaceEmbeddings(model_name=embedding_model)
+    parser.add_argument("--batch", type=str, help="File with one question per line; retrieve for all of them and exit.")
+    parser.add_argument("--out", type=str, help="Where to write the --batch results as JSON (default: stdout).")
+    parser.add_argument("--k", type=int, default=6, help="Chunks to retrieve per question.")
+    parser.add_argument("--batch-size", type=int, default=32, help="Embedding batch size for --batch.")
+    parser.add_argument("--no-stream", action="store_true", help="Print each answer only once it is complete.")
+    parser.add_argument("--session", default="cli",
+                        help="Session ID; with RAG_SESSION_SPILL_DIR set, a session is resumed across runs.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile CPU and memory per turn and stage into RAG_PROFILE_DIR (also RAG_PROFILE=on).")
+    args = parser.parse_args()
+    if args.profile or profile_enabled():
+        from profiling import start_profiler
+        profiler = start_profiler("query")
+        try:
+            run(args)
+        finally:
+            profiler.stop()
     else:
-        embeddings = OpenAIEmbeddings()
-    
-    db = Chroma(
-        embedding_function =embeddings,  # Pass HuggingFaceEmbeddings as 'embedding'
-        persist_directory=CHROMA_PATH
-    )
-    # setup memory
-    memory = ConversationBufferMemory(memory_key="history", return_messages=True)
-    model = ChatOpenAI(model_name="gpt-4", api_key=os.getenv("OPENAI_API_KEY"))
-
-    conversation_chain = ConversationChain (
-        llm=model,
-        memory=memory,
-        verbose=False  # Set to True to view logs for debugging
-    )
+        run(args)
+
+
+def run(args):
+    with metrics.profile("engine_load"):
+        engine = RagEngine(CHROMA_PATH)
+    if args.batch:
+        run_batch(engine, args.batch, args.out, args.k, args.batch_size)
+        return
+    # Memory, cited sources and recent answers live in the session, not in module globals
+    sessions = get_session_store(engine.llm)
+    session = sessions.get(args.session)
+    printer = StreamPrinter()
     while True:
         # Ask the user for a question
         query_text = input("You: ")
@@ -68,61 +58,124 @@ def main():
         if query_text.lower() == "quit":
             print("Goodbye!")
             break
-
-        # Search the DB.
-        results = db.similarity_search_with_relevance_scores(query_text, k=6)
-        
-        if len(results) == 0 or results[0][1] < 0.3:
-            print(f"Unable to find matching results.")
-            return
-        context_text = "\n\n---\n\n".join([doc.page_content for doc, _score in results])
-        prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
-
-        prompt = prompt_template.format(context=context_text, question=query_text)
-        
-        # response_text = llm.invoke(prompt)
-        sources = [doc.metadata.get("metadata", None) for doc, _score in results]
-        for s in results:
-            get_source_episode(s[0].metadata)
-        # llm_response = response_text.content
-        sources = ""
-        sources = "\n\n".join([
-            f"Podcast Name: {episode.podcast_name}\nEpisode Name: {episode.episode_name}\nEpisode Link: {episode.episode_link}"
-            for episode in source_episodes
-        ])
-        
-        # pprint.pprint(formatted_response)
-
-        # Get the model's response based on the conversation chain
-        response = conversation_chain.predict(input=prompt)
+        turn_start = time.perf_counter()
+        with metrics.trace("turn") as request_trace, metrics.profile("turn"):
+            answered = answer_turn(engine, session, query_text, args, printer, turn_start)
+        if not answered:
+            break
+        sessions.save(session)
+        if request_trace.summary():
+            log("info", f"Turn stages: {request_trace.summary()}")
+    if printer.turns:
+        log("info", f"Streaming over {len(printer.turns)} turns: {printer.summary()}")
+    if metrics.enabled() and get_metrics_path():
+        metrics.dump_json(get_metrics_path())
+    sessions.close()
+
+
+def answer_turn(engine: RagEngine, session, query_text: str, args, printer, turn_start: float) -> bool:
+    """Answers one REPL question and records it in the session; False when nothing matched."""
+    # This session's answers first, then the shared answer cache, then search the DB.
+    history = session.memory.render()
+    cached = session.get_answer(query_text, history)
+    if cached is None:
+        turn = engine.prepare_turn(query_text, k=args.k, recent_episodes=list(session.sources), history=history)
+        cached = turn["cached"]
+    if cached is not None:
+        session.record(query_text, cached["answer"])
+        print("Bot:", f"Response: {cached['answer']}\nSources: {cached['sources']}")
+        return True
+    hits = turn["hits"]
+
+    if not engine.has_results(hits):
+        print(NO_RESULTS_ANSWER)
+        return False
+    # Only this turn's retrieved context goes into the prompt; earlier turns come from memory
+    prompt = engine.build_prompt(query_text, hits, history=history)
+    sources = format_sources(hits)
+
+    if args.no_stream:
+        # Get the model's response
+        with metrics.span("llm"):
+            response = engine.llm.invoke(prompt).content
         formatted_response = f"Response: {response}\nSources: {sources}"
         # Print the response
         print("Bot:", formatted_response)
+    else:
+        # Sources are known before the LLM starts, so show them first and stream the answer after
+        print(f"Sources: {sources}\n")
+        print("Bot: ", end="", flush=True)
+        printer.start(turn_start)
+        # stream=True asks the chat model for its streaming API, so tokens reach the printer as they arrive
+        with metrics.span("llm"):
+            response = engine.llm.invoke(prompt, config={"callbacks": [printer]}, stream=True).content
+        print()
+        stats = printer.finish()
+        log("info", f"Time to first token {stats['ttft_s']:.3f}s, {stats['tokens']} tokens "
+                    f"at {stats['tokens_per_s']:.1f} tokens/s, total {stats['total_s']:.3f}s")
+    session.record(query_text, response, sources, hits, history)
+    engine.remember(turn, {"answer": response, "sources": sources})
+    return True
     
 
-class PodcastEpisode:
-    def __init__(self, episode_name: str, episode_link: str, podcast_name: str):
-        self.episode_name = episode_name
-        self.episode_link = episode_link
-        self.podcast_name = podcast_name 
-
-    def __repr__(self):
-        return f"PodcastEpisode(episode_name='{self.episode_name}', episode_link='{self.episode_link}', podcast_name='{self.podcast_name}')"
-
-source_episodes = []
-# Set to track unique episode names
-episode_names_set = set()
-def get_source_episode(metadata):
-    episode_name = metadata['episode_name']
-    if episode_name not in episode_names_set:
-        episode = PodcastEpisode(
-            episode_name=metadata['episode_name'],
-            episode_link=metadata['episode_link'],
-            podcast_name=metadata['podcast_name'],
-        )
-        source_episodes.append(episode)
-        episode_names_set.add(episode_name)  # Add the episode name to the set
-
+class StreamPrinter(BaseCallbackHandler):
+    """
+    Prints LLM tokens as they are generated and measures the turn: time to first token
+    (from when the question was entered, so it includes retrieval) and tokens per second
+    over the generation.
+    """
+
+    def __init__(self):
+        self.turns = []
+        self._start_time = None
+        self._first_token_time = None
+        self._tokens = 0
+
+    def start(self, start_time: float = None):
+        self._start_time = start_time or time.perf_counter()
+        self._first_token_time = None
+        self._tokens = 0
+
+    def on_llm_new_token(self, token: str, **kwargs):
+        if self._first_token_time is None:
+            self._first_token_time = time.perf_counter()
+        self._tokens += 1
+        print(token, end="", flush=True)
+
+    def finish(self) -> dict:
+        end_time = time.perf_counter()
+        first_token_time = self._first_token_time or end_time
+        generation_seconds = end_time - first_token_time
+        stats = {
+            "ttft_s": first_token_time - self._start_time,
+            "tokens": self._tokens,
+            "tokens_per_s": (self._tokens - 1) / generation_seconds if self._tokens > 1 and generation_seconds else 0.0,
+            "total_s": end_time - self._start_time,
+        }
+        self.turns.append(stats)
+        return stats
+
+    def summary(self) -> dict:
+        """Mean of every per-turn statistic."""
+        return {key: sum(turn[key] for turn in self.turns) / len(self.turns) for key in self.turns[0]}
+
+
+def run_batch(engine: RagEngine, questions_path: str, out_path: str = None, k: int = 6, batch_size: int = 32):
+    with open(questions_path, "r") as f:
+        questions = [line.strip() for line in f if line.strip()]
+    start_time = time.perf_counter()
+    results = engine.retrieve(questions, k, batch_size)
+    elapsed_time = time.perf_counter() - start_time
+    log("info", f"Retrieved {k} chunks for {len(questions)} questions. Took {elapsed_time} seconds")
+    output = [
+        {"question": question, "hits": [{key: hit[key] for key in hit if key != "metadata"} for hit in hits]}
+        for question, hits in zip(questions, results)
+    ]
+    if out_path:
+        with open(out_path, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,239 @@
+import argparse
+import asyncio
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from dotenv import load_dotenv
+load_dotenv()
+from util import *
+import metrics
+
+
+class QueryService:
+    def __init__(self, chroma_path: str, llm_name: str = None, workers: int = 4, snapshots: bool = False):
+        """
+        Resident query service. The RagEngine (embedding model, Chroma collection and chat
+        model) is loaded once in the background at startup; until it is ready /ready
+        answers 503. Embedding and vector search run on a worker pool so the event loop
+        keeps serving other requests, and LLM calls are awaited asynchronously. Requests
+        that carry a session_id get that conversation's memory and answers from a
+        SessionStore (see RAG_SESSION_*). With snapshots the index comes from the latest
+        published snapshot instead of chroma_path and is hot-swapped whenever a new one
+        is published (see index_snapshot and RAG_SNAPSHOT_*). With RAG_METRICS=on every
+        request is traced per stage and /metrics serves Prometheus text (/metrics.json
+        the same plus recent traces).
+
+        Args:
+            chroma_path (str): Chroma persist directory
+            llm_name (str): Chat model, "stub" for the offline stand-in (default: RAG_LLM)
+            workers (int): Size of the worker pool for CPU-bound retrieval
+            snapshots (bool): Serve and follow the published index snapshots
+        """
+        self.chroma_path = chroma_path
+        self.llm_name = llm_name
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rag-worker")
+        self.engine = None
+        self.sessions = None
+        self.sweeper = None
+        self.snapshots = snapshots
+        self.poller = None
+        self.load_error = None
+        self.started = time.time()
+
+    def load_engine(self):
+        # Imported here so the server answers /health while LangChain and the model load
+        from rag_engine import RagEngine, get_llm
+        from session_store import get_session_store
+        try:
+            if self.snapshots:
+                from index_snapshot import SnapshotPoller, get_snapshot_puller
+                puller = get_snapshot_puller()
+                # A restart serves the snapshot already on disk; only a new node waits for a download
+                pulled = puller.pull() if puller.current()[0] is None else None
+                self.chroma_path = pulled[0] if pulled else puller.current()[1]
+                if self.chroma_path is None:
+                    raise RuntimeError("No index snapshot has been published yet")
+            engine = RagEngine(self.chroma_path, llm=get_llm(self.llm_name))
+            if self.snapshots and pulled:
+                # Only live once the engine loaded it
+                puller.commit(pulled[1]["id"])
+            self.sessions = get_session_store(engine.llm)
+            self.engine = engine
+            if self.snapshots:
+                self.poller = SnapshotPoller(puller, engine.swap_index, get_snapshot_poll_seconds()).start()
+                # Catch up right away in case the snapshot on disk is stale
+                self.poller.poll()
+        except Exception as e:
+            self.load_error = str(e)
+            log("error", f"Query service failed to load: {e}")
+
+    async def on_startup(self, app):
+        asyncio.get_running_loop().run_in_executor(self.executor, self.load_engine)
+        self.sweeper = asyncio.create_task(self.sweep_sessions())
+
+    async def on_cleanup(self, app):
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+        if self.poller is not None:
+            self.poller.stop()
+        if self.sessions is not None:
+            self.sessions.close()
+        self.executor.shutdown(wait=False)
+
+    async def sweep_sessions(self, interval: float = 60):
+        # Evicts idle sessions even when no requests arrive to trigger it
+        while True:
+            await asyncio.sleep(interval)
+            if self.sessions is not None:
+                await self.run_in_pool(self.sessions.sweep)
+
+    async def run_in_pool(self, func, *args):
+        # run_in_executor does not carry context variables, so the request's trace would be lost
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, context.run, func, *args)
+
+    def require_engine(self):
+        if self.engine is None:
+            raise web.HTTPServiceUnavailable(text="engine not loaded")
+        return self.engine
+
+    async def health(self, request):
+        return web.json_response({"status": "ok", "uptime": time.time() - self.started,
+                                  "sessions": self.sessions.stats() if self.sessions is not None else None,
+                                  "snapshot": self.poller.stats() if self.poller is not None else None})
+
+    async def ready(self, request):
+        if self.engine is None:
+            return web.json_response({"ready": False, "error": self.load_error}, status=503)
+        return web.json_response({"ready": True})
+
+    async def retrieve(self, request):
+        engine = self.require_engine()
+        body = await read_body(request)
+        questions = require_questions(body["questions"] if "questions" in body else [body.get("question")])
+        k = require_k(body)
+        start_time = time.perf_counter()
+        with metrics.trace("retrieve") as request_trace:
+            hits = await self.run_in_pool(engine.retrieve, questions, k)
+        return web.json_response({
+            "results": [{"question": q, "hits": strip_metadata(h)} for q, h in zip(questions, hits)],
+            "elapsed": time.perf_counter() - start_time,
+            "trace": request_trace.to_dict(),
+        })
+
+    async def answer(self, request):
+        engine = self.require_engine()
+        body = await read_body(request)
+        question, = require_questions([body.get("question")])
+        k = require_k(body)
+        session_id = body.get("session_id")
+        if session_id is not None and not isinstance(session_id, str):
+            raise web.HTTPBadRequest(text='"session_id" must be a string')
+        start_time = time.perf_counter()
+        with metrics.trace("answer") as request_trace:
+            # A session evicted to the spill directory is read back from disk
+            session = await self.run_in_pool(self.sessions.get, session_id) if session_id else None
+            history = session.memory.render() if session else ""
+            result = session.get_answer(question, history) if session else None
+            if result is not None:
+                result = dict(result, hits=[], cache="session")
+                request_trace.set("served", "session")
+            else:
+                turn = await self.run_in_pool(engine.prepare_turn, question, k,
+                                              list(session.sources) if session else [], history)
+                result = await engine.aanswer_turn(turn, history)
+            if session:
+                # Memory may summarize with the LLM, so it is updated off the event loop
+                await self.run_in_pool(session.record, question, result["answer"], result["sources"],
+                                       result["hits"], history)
+                # Saving can spill other sessions to disk
+                await self.run_in_pool(self.sessions.save, session)
+        return web.json_response({
+            "question": question,
+            "session_id": session_id,
+            "answer": result["answer"],
+            "sources": result["sources"],
+            "cache": result["cache"],
+            "hits": strip_metadata(result["hits"]),
+            "elapsed": time.perf_counter() - start_time,
+            "trace": request_trace.to_dict(),
+        })
+
+    async def metrics_text(self, request):
+        return web.Response(body=metrics.to_prometheus().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def metrics_json(self, request):
+        return web.json_response(metrics.to_dict())
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        app.add_routes([
+            web.get("/health", self.health),
+            web.get("/ready", self.ready),
+            web.post("/retrieve", self.retrieve),
+            web.post("/answer", self.answer),
+            web.get("/metrics", self.metrics_text),
+            web.get("/metrics.json", self.metrics_json),
+        ])
+        return app
+
+
+async def read_body(request) -> dict:
+    """The request's JSON object body; 400 for anything else."""
+    try:
+        body = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="request body must be JSON")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="request body must be a JSON object")
+    return body
+
+
+def require_questions(questions) -> list:
+    if not isinstance(questions, list) or not questions or \
+            not all(isinstance(question, str) and question.strip() for question in questions):
+        raise web.HTTPBadRequest(text='"question" must be a non-empty string ("questions" a list of them)')
+    return questions
+
+
+def require_k(body: dict) -> int:
+    try:
+        k = int(body.get("k", 6))
+    except (TypeError, ValueError):
+        k = 0
+    if k < 1:
+        raise web.HTTPBadRequest(text='"k" must be a positive integer')
+    return k
+
+
+def strip_metadata(hits: list) -> list:
+    return [{key: value for key, value in hit.items() if key != "metadata"} for hit in hits]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--socket", help="Serve on this Unix socket path instead of host/port.")
+    parser.add_argument("--chroma-path", default="chroma")
+    parser.add_argument("--llm", help='Chat model name, or "stub" to run offline (default: RAG_LLM).')
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--snapshots", action="store_true",
+                        help="Serve the latest published index snapshot and hot-swap to new ones (RAG_SNAPSHOT_*).")
+    args = parser.parse_args()
+
+    service = QueryService(args.chroma_path, args.llm, args.workers, args.snapshots)
+    if args.socket:
+        web.run_app(service.make_app(), path=args.socket)
+    else:
+        web.run_app(service.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import atexit
+import os
+import re
+import zlib
+
+from langchain_core.embeddings import Embeddings
+
+from util import *
+
+# Where int8 ONNX exports are kept when the model repo does not ship a quantized file
+LOCAL_MODEL_DIR = "embedding_models"
+
+
+class SentenceTransformerBackend(Embeddings):
+    def __init__(self, model_name: str, backend: str = "torch", batch_size: int = 32, device: str = "cpu",
+                 num_threads: int = 0, processes: int = 1, quantization: str = "avx512_vnni"):
+        """
+        LangChain Embeddings on top of a SentenceTransformer, tuned for CPU-only boxes.
+
+        Texts are sorted by length before batching (and put back in order afterwards) so
+        each batch pads to similar lengths. Vectors are not normalized, matching the
+        HuggingFaceEmbeddings defaults the index was built with.
+
+        Args:
+            model_name (str): HuggingFace model name or local path
+            backend (str): "torch", "onnx" or "onnx-int8" (dynamically quantized ONNX)
+            batch_size (int): Texts per forward pass
+            device (str): Torch device, "cpu" on the ingestion boxes
+            num_threads (int): Intra-op threads for torch / ONNX Runtime (0 keeps the library default)
+            processes (int): Encode with this many worker processes (1 encodes in-process)
+            quantization (str): Quantization config for "onnx-int8": arm64, avx2, avx512 or avx512_vnni
+        """
+        self.model_name = model_name
+        self.backend = backend
+        self.batch_size = batch_size
+        self.processes = processes
+        self.model = load_sentence_transformer(model_name, backend, device, num_threads, quantization)
+        self._pool = None
+
+    def _encode(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        sorted_texts = [texts[i] for i in order]
+        if self.processes > 1 and len(texts) >= self.batch_size * self.processes:
+            if self._pool is None:
+                self._pool = self.model.start_multi_process_pool(["cpu"] * self.processes)
+                atexit.register(self.model.stop_multi_process_pool, self._pool)
+            vectors = self.model.encode_multi_process(sorted_texts, self._pool, batch_size=self.batch_size)
+        else:
+            vectors = self.model.encode(sorted_texts, batch_size=self.batch_size, convert_to_numpy=True)
+        result = [None] * len(texts)
+        for position, i in enumerate(order):
+            result[i] = vectors[position].tolist()
+        return result
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._encode(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._encode([text])[0]
+
+
+class HashingEmbeddings(Embeddings):
+    def __init__(self, dim: int = 256):
+        """
+        Deterministic, model-free embeddings (signed feature hashing of words and word pairs,
+        L2-normalized). Meant for offline benchmarks and tests, not for answer quality.
+        Selected with RAG_EMBEDDING=HASH.
+        """
+        self.dim = dim
+
+    def _embed(self, text: str) -> list[float]:
+        import numpy as np
+        words = re.findall(r"\w+", text.lower())
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in features:
+            h = zlib.crc32(feature.encode("utf-8"))
+            vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed(text)
+
+
+def load_sentence_transformer(model_name: str, backend: str = "torch", device: str = "cpu",
+                              num_threads: int = 0, quantization: str = "avx512_vnni"):
+    from sentence_transformers import SentenceTransformer
+    if backend == "torch":
+        if num_threads:
+            import torch
+            torch.set_num_threads(num_threads)
+        return SentenceTransformer(model_name, device=device)
+
+    model_kwargs = {"provider": "CPUExecutionProvider"}
+    if num_threads:
+        import onnxruntime as ort
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = num_threads
+        model_kwargs["session_options"] = session_options
+    if backend == "onnx":
+        return SentenceTransformer(model_name, backend="onnx", model_kwargs=model_kwargs)
+    if backend != "onnx-int8":
+        raise ValueError(f"Unsupported embedding backend: {backend}")
+
+    file_name = f"onnx/model_qint8_{quantization}.onnx"
+    try:
+        # Many sentence-transformers repos ship pre-quantized ONNX files
+        return SentenceTransformer(model_name, backend="onnx", model_kwargs={**model_kwargs, "file_name": file_name})
+    except Exception as e:
+        log("info", f"No {file_name} for {model_name} ({e}); quantizing locally")
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+    local_path = os.path.join(LOCAL_MODEL_DIR, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name))
+    if not os.path.exists(os.path.join(local_path, file_name)):
+        model = SentenceTransformer(model_name, backend="onnx", model_kwargs=model_kwargs)
+        model.save(local_path)
+        export_dynamic_quantized_onnx_model(model, quantization, local_path)
+    return SentenceTransformer(local_path, backend="onnx", model_kwargs={**model_kwargs, "file_name": file_name})
+
+
+def get_embedding_backend(embedding_model: str = None) -> SentenceTransformerBackend:
+    """SentenceTransformerBackend configured from the RAG_EMBED_* settings."""
+    return SentenceTransformerBackend(
+        embedding_model or get_rag_embedding(),
+        backend=get_embedding_backend_name(),
+        batch_size=get_embedding_batch_size(),
+        num_threads=get_embedding_threads(),
+        processes=get_embedding_processes(),
+        quantization=get_embedding_quantization(),
+    )
+
+
+def get_embeddings(embedding_model: str = None):
+    """
+    Builds the LangChain embeddings for RAG_EMBEDDING ("OPENAI", "HASH" or a HuggingFace model name),
+    wrapped in the on-disk embedding cache unless RAG_EMBED_CACHE is set to "off".
+    """
+    embedding_model = embedding_model or get_rag_embedding()
+    if embedding_model == "HASH":
+        # Cheaper to recompute than to look up
+        return HashingEmbeddings()
+    if embedding_model != "OPENAI":
+        embeddings = get_embedding_backend(embedding_model)
+        # int8 vectors differ slightly from the float ones, so they get their own cache
+        cache_name = embedding_model if embeddings.backend == "torch" else f"{embedding_model}-{embeddings.backend}"
+    else:
+        from langchain_openai import OpenAIEmbeddings
+        embeddings = OpenAIEmbeddings()
+        cache_name = f"openai-{embeddings.model}"
+
+    cache_dir = get_embedding_cache_dir()
+    if not cache_dir:
+        return embeddings
+    from embedding_cache import EmbeddingCache, CachedEmbeddings
+    cache = EmbeddingCache(cache_dir, cache_name, max_bytes=get_embedding_cache_max_mb() * 1024 * 1024)
+    return CachedEmbeddings(embeddings, cache)
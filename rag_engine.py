@@ -0,0 +1,300 @@
+from langchain_chroma import Chroma
+from langchain_openai import ChatOpenAI
+from langchain.prompts import ChatPromptTemplate
+from langchain_core.language_models.chat_models import SimpleChatModel
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+
+import os
+import json
+import time
+from util import *
+import metrics
+from rag_embeddings import get_embeddings
+from retrieval import get_searcher, batch_retrieve
+from context_builder import build_context
+from episode_summaries import EpisodeSummaryStore
+
+CHROMA_PATH = "chroma"
+# Coarse per-episode index written next to the Chroma files by generate_data_store
+EPISODE_INDEX_FILE = "episode_index.npz"
+# MmapVectorStore export for RAG_VECTOR_STORE=mmap, also next to the Chroma files
+VECTOR_STORE_DIR = "vector_store"
+# Episode summaries shipped inside an index snapshot (see index_snapshot)
+SNAPSHOT_SUMMARY_FILE = "episode_summaries.json"
+# Below this relevance the best hit is treated as "nothing found"
+MIN_RELEVANCE = 0.3
+
+PROMPT_TEMPLATE = """
+You are a friendly chatbot who answers questions based on the following context only.
+If the context has an Episode Name, summarize the episode. Otherwise answer the question.
+If you are summarizing, limit the response to 250 words. Otherwise don't worry about word limit.
+Use a playful tone
+
+{context}
+
+---
+
+Answer the question based on the above context: {question}
+"""
+# PROMPT_TEMPLATE with the earlier turns of a chat session (questions and answers only)
+CONVERSATION_PROMPT_TEMPLATE = PROMPT_TEMPLATE.replace("{context}", """Conversation so far:
+{history}
+
+---
+
+{context}""", 1)
+NO_RESULTS_ANSWER = "Unable to find matching results."
+
+
+class StubChatModel(SimpleChatModel):
+    """
+    Offline stand-in for the chat model: answers deterministically from the prompt, no network.
+    Streams word by word, sleeping token_delay seconds before each word to mimic a remote model.
+    """
+    token_delay: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs) -> str:
+        prompt = messages[-1].content
+        question = prompt.rsplit("Answer the question based on the above context:", 1)[-1].strip()
+        return f"Stub answer to '{question}' from {len(prompt.split())} prompt words."
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        words = self._call(messages, stop=stop, **kwargs).split(" ")
+        for i, word in enumerate(words):
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else " " + word))
+
+
+def get_llm(llm_name: str = None):
+    """Chat model named by RAG_LLM: "stub" for the offline stand-in, otherwise an OpenAI model name."""
+    llm_name = llm_name or get_rag_llm()
+    if llm_name == "stub":
+        return StubChatModel(token_delay=get_stub_token_delay())
+    return ChatOpenAI(model_name=llm_name, api_key=os.getenv("OPENAI_API_KEY"))
+
+
+def format_sources(hits: list) -> str:
+    """One block per distinct episode among the hits, in rank order."""
+    seen = set()
+    sources = []
+    for hit in hits:
+        if hit["episode_name"] in seen:
+            continue
+        seen.add(hit["episode_name"])
+        sources.append(f"Podcast Name: {hit['podcast_name']}\nEpisode Name: {hit['episode_name']}\nEpisode Link: {hit['episode_link']}")
+    return "\n\n".join(sources)
+
+
+def get_answer_cache():
+    """AnswerCache configured from RAG_ANSWER_CACHE_*, or None when RAG_ANSWER_CACHE is "off"."""
+    if not answer_cache_enabled():
+        return None
+    from answer_cache import AnswerCache
+    return AnswerCache(
+        threshold=get_answer_cache_threshold(),
+        ttl_seconds=get_answer_cache_ttl(),
+        max_entries=get_answer_cache_max_entries(),
+        path=get_answer_cache_path() or None,
+    )
+
+
+class RagEngine:
+    def __init__(self, chroma_path: str = CHROMA_PATH, embeddings=None, llm=None, answer_cache=None):
+        """
+        Embedding model, Chroma collection and chat model loaded once and shared by every request.
+
+        Args:
+            chroma_path (str): Chroma persist directory written by generate_data_store
+            embeddings: LangChain Embeddings (default: get_embeddings())
+            llm: LangChain chat model (default: get_llm())
+            answer_cache: AnswerCache for final answers (default: get_answer_cache())
+        """
+        start_time = time.perf_counter()
+        self.chroma_path = chroma_path
+        self.embeddings = embeddings or get_embeddings()
+        self.db = Chroma(embedding_function=self.embeddings, persist_directory=chroma_path)
+        self._llm = llm
+        self.answer_cache = answer_cache if answer_cache is not None else get_answer_cache()
+        self.summaries = EpisodeSummaryStore(summary_path(chroma_path))
+        self._index_version = (None, 0)
+        self.load_searcher()
+        self.prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
+        self.conversation_template = ChatPromptTemplate.from_template(CONVERSATION_PROMPT_TEMPLATE)
+        log("info", f"RAG engine loaded from {chroma_path}. Took {time.perf_counter() - start_time} seconds")
+
+    @property
+    def llm(self):
+        # Created on first use, so retrieval-only callers (e.g. query.py --batch) need no API key
+        if self._llm is None:
+            self._llm = get_llm()
+        return self._llm
+
+    def load_searcher(self):
+        """Searcher (RAG_VECTOR_STORE, RAG_RETRIEVAL) for the current index version."""
+        self._searcher_version = self.index_version()
+        self.searcher = get_searcher(self.db._collection, os.path.join(self.chroma_path, EPISODE_INDEX_FILE),
+                                     vector_store_path=os.path.join(self.chroma_path, VECTOR_STORE_DIR))
+
+    def swap_index(self, chroma_path: str, meta: dict = None):
+        """
+        Switches to the index in another directory, e.g. a snapshot just pulled by
+        index_snapshot.SnapshotPoller, without a restart. The new collection and searcher
+        are opened and warmed up first, then swapped in; requests already running keep
+        the ones they started with. meta is the snapshot's metadata, only logged.
+        """
+        start_time = time.perf_counter()
+        db = Chroma(embedding_function=self.embeddings, persist_directory=chroma_path)
+        searcher = get_searcher(db._collection, os.path.join(chroma_path, EPISODE_INDEX_FILE),
+                                vector_store_path=os.path.join(chroma_path, VECTOR_STORE_DIR))
+        searcher.search([self.embeddings.embed_query("warm up")], 1)
+        summaries = EpisodeSummaryStore(summary_path(chroma_path))
+        # Searcher before path and version: a request seeing the new version must never
+        # search the old index and cache its answer under the new version
+        self.searcher = searcher
+        self.db = db
+        self.summaries = summaries
+        self.chroma_path = chroma_path
+        self._index_version = (None, 0)
+        self._searcher_version = self.index_version()
+        log("info", f"Swapped to index {chroma_path} (version {self._searcher_version}"
+                    f"{', snapshot ' + meta['id'] if meta else ''}). Took {time.perf_counter() - start_time} seconds")
+
+    def retrieve(self, questions: list, k: int = 6, batch_size: int = 32) -> list:
+        """Ranked hits for every question (see retrieval.batch_retrieve)."""
+        return batch_retrieve(self.searcher, self.embeddings, questions, k=k, batch_size=batch_size)
+
+    def build_prompt(self, question: str, hits: list, history: str = "") -> str:
+        """
+        Prompt with the hits merged, de-duplicated and packed into RAG_CONTEXT_TOKENS (see
+        context_builder). history is the rendered ConversationMemory of a chat session.
+        """
+        with metrics.span("context_build"):
+            context = build_context(hits, token_budget=get_context_token_budget(),
+                                    max_chunks_per_episode=get_context_max_chunks_per_episode(),
+                                    model_name=get_rag_llm())
+        log("debug", f"Context: {len(hits)} hits -> {len(context['spans'])} spans, "
+                     f"{context['tokens']['retrieved']} -> {context['tokens']['context']} tokens")
+        if history:
+            return self.conversation_template.format(history=history, context=context["text"], question=question)
+        return self.prompt_template.format(context=context["text"], question=question)
+
+    def has_results(self, hits: list) -> bool:
+        return len(hits) > 0 and hits[0]["score"] >= MIN_RELEVANCE
+
+    def index_version(self):
+        """Version of the index from the ingestion manifest; re-read only when the manifest changes."""
+        manifest_path = os.path.join(self.chroma_path, "ingest_manifest.json")
+        try:
+            mtime = os.path.getmtime(manifest_path)
+        except OSError:
+            return 0
+        if self._index_version[0] != mtime:
+            with open(manifest_path, "r") as f:
+                self._index_version = (mtime, json.load(f).get("version", 0))
+        return self._index_version[1]
+
+    def prepare_turn(self, question: str, k: int = 6, recent_episodes: list = (), history: str = "") -> dict:
+        """
+        The CPU-bound half of answering one question: exact answer cache lookup, the
+        precomputed episode summaries for summary questions, semantic answer cache lookup,
+        query embedding and vector search. Returns a turn dict with "cached" set to the
+        cached result on a hit, otherwise with the retrieved "hits". recent_episodes are
+        the episode names a session cited, newest last, for "this episode" questions.
+
+        history is the session's rendered conversation memory. An answer built on it
+        ("tell me more") only makes sense in that conversation, so with history the answer
+        cache is neither read nor, in remember(), written.
+        """
+        turn = {"question": question, "index_version": self.index_version(), "vector": None,
+                "hits": [], "cached": None, "shared": self.answer_cache is not None and not history}
+        if turn["index_version"] != self._searcher_version:
+            # Re-ingested since the searcher was loaded: pick up the new episode index and vector store export
+            self.load_searcher()
+        if turn["shared"]:
+            entry = self.answer_cache.get_exact(question, turn["index_version"])
+            if entry is not None:
+                turn["cached"] = cached_result(entry, "exact")
+                return count_turn(turn)
+        self.summaries.reload()
+        summary = self.summaries.find(question, recent_episodes)
+        if summary is not None:
+            turn["cached"] = {"answer": summary["summary"], "sources": format_sources([summary]), "hits": [],
+                              "cache": "summary"}
+            return count_turn(turn)
+        with metrics.span("query_embed"):
+            turn["vector"] = self.embeddings.embed_query(question)
+        if turn["shared"]:
+            entry = self.answer_cache.get_similar(turn["vector"], turn["index_version"])
+            if entry is not None:
+                turn["cached"] = cached_result(entry, "semantic")
+                return count_turn(turn)
+        with metrics.span("vector_search"):
+            turn["hits"] = self.searcher.search([turn["vector"]], k)[0]
+        return count_turn(turn)
+
+    def remember(self, turn: dict, result: dict):
+        """Stores a freshly generated answer in the answer cache, unless it depends on a conversation's history."""
+        if turn["shared"] and self.has_results(turn["hits"]):
+            self.answer_cache.put(turn["question"], turn["vector"], result["answer"], result["sources"],
+                                  turn["index_version"])
+
+    def answer(self, question: str, k: int = 6) -> dict:
+        """Answers one question through the answer cache, retrieval and the chat model, without conversation memory."""
+        turn = self.prepare_turn(question, k)
+        if turn["cached"] is not None:
+            return turn["cached"]
+        result = self.answer_from_hits(question, turn["hits"])
+        self.remember(turn, result)
+        return result
+
+    async def aanswer_turn(self, turn: dict, history: str = "") -> dict:
+        """Async second half of answer(): awaits the chat model for a turn from prepare_turn."""
+        if turn["cached"] is not None:
+            return turn["cached"]
+        result = await self.aanswer_from_hits(turn["question"], turn["hits"], history)
+        self.remember(turn, result)
+        return result
+
+    def answer_from_hits(self, question: str, hits: list, history: str = "") -> dict:
+        if not self.has_results(hits):
+            return {"answer": NO_RESULTS_ANSWER, "sources": "", "hits": hits, "cache": None}
+        prompt = self.build_prompt(question, hits, history)
+        with metrics.span("llm"):
+            response = self.llm.invoke(prompt)
+        return {"answer": response.content, "sources": format_sources(hits), "hits": hits, "cache": None}
+
+    async def aanswer_from_hits(self, question: str, hits: list, history: str = "") -> dict:
+        """Async answer_from_hits, so a server can await the LLM without holding a worker thread."""
+        if not self.has_results(hits):
+            return {"answer": NO_RESULTS_ANSWER, "sources": "", "hits": hits, "cache": None}
+        prompt = self.build_prompt(question, hits, history)
+        with metrics.span("llm"):
+            response = await self.llm.ainvoke(prompt)
+        return {"answer": response.content, "sources": format_sources(hits), "hits": hits, "cache": None}
+
+
+def summary_path(chroma_path: str) -> str:
+    """Summaries shipped in a snapshot directory when present, else RAG_SUMMARY_PATH."""
+    path = os.path.join(chroma_path, SNAPSHOT_SUMMARY_FILE)
+    return path if os.path.exists(path) else get_summary_path()
+
+
+def count_turn(turn: dict) -> dict:
+    """Counts how the turn was served (answer cache level, summary, or retrieval) and returns it."""
+    if metrics.enabled():
+        served = turn["cached"]["cache"] if turn["cached"] is not None else "retrieval"
+        metrics.inc("rag_turns_total", served=served)
+        trace = metrics.current_trace()
+        if trace is not None:
+            trace.set("served", served)
+    return turn
+
+
+def cached_result(entry: dict, level: str) -> dict:
+    return {"answer": entry["answer"], "sources": entry["sources"], "hits": [], "cache": level}
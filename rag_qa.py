@@ -1,7 +1,11 @@
 import chromadb
-from sentence_transformers import SentenceTransformer
 import os
 
+import metrics
+
+from rag_embeddings import get_embedding_backend
+from retrieval import get_searcher, batch_retrieve
+
 # Configuration
 chroma_db_path = "chroma_db"
 collection_name = "podcast_transcripts"
@@ -11,23 +15,26 @@ client = chromadb.PersistentClient(path=chroma_db_path)
 
 # Load the Chroma collection
 collection = client.get_collection(name=collection_name)
+# Flat k-NN, or episode-then-chunk search with RAG_RETRIEVAL=two-stage (episode index cached next to the DB)
+# RAG_VECTOR_STORE=mmap searches the export written by `python vector_store.py --chroma-path chroma_db --collection podcast_transcripts`
+searcher = get_searcher(collection, os.path.join(chroma_db_path, "episode_index.npz"), key_field="episode_name",
+                        vector_store_path=os.path.join(chroma_db_path, "vector_store"))
 
-# Initialize Sentence Transformer model
-model = SentenceTransformer('all-mpnet-base-v2')
+# Initialize Sentence Transformer model (batch size, threads and ONNX/int8 variants come from RAG_EMBED_*)
+model = get_embedding_backend('all-mpnet-base-v2')
 
 def retrieve_relevant_chunks(query, top_k=3):
     """Retrieves the most relevant text chunks from ChromaDB for a given query."""
 
-    query_embedding = model.encode(query).tolist()
-
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=top_k
-    )
+    return [hit["text"] for hit in retrieve_relevant_chunks_batch([query], top_k)[0]]
 
-    return results['documents'][0]
+def retrieve_relevant_chunks_batch(queries, top_k=3, batch_size=32):
+    """
+    Retrieves the most relevant chunks for many queries with one encode call and one ChromaDB query.
 
-import os
+    Returns one ranked list per query; each hit carries text, score, distance and episode metadata.
+    """
+    return batch_retrieve(searcher, model, queries, k=top_k, batch_size=batch_size)
 
 def generate_answer(query, context_chunks):
     """Generates an answer to the query based on the context chunks."""
@@ -35,14 +42,18 @@ def generate_answer(query, context_chunks):
     answer = f"Query: {query}{os.linesep}Context:{os.linesep}{context}"
     return answer
 
-# QA loop
-while True:
-    query = input("Enter your question (or type 'exit' to quit): ")
-    if query.lower() == 'exit':
-        break
-
-    relevant_chunks = retrieve_relevant_chunks(query)
-    answer = generate_answer(query, relevant_chunks)
-
-    print(f"Answer: {answer}
-")
+if __name__ == "__main__":
+    # QA loop
+    while True:
+        query = input("Enter your question (or type 'exit' to quit): ")
+        if query.lower() == 'exit':
+            break
+
+        # RAG_METRICS=on prints where the time went (query_embed, vector_search)
+        with metrics.trace("qa") as request_trace:
+            relevant_chunks = retrieve_relevant_chunks(query)
+            answer = generate_answer(query, relevant_chunks)
+
+        print(f"Answer: {answer}\n")
+        if request_trace.summary():
+            print(f"Stages: {request_trace.summary()}")
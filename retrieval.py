@@ -0,0 +1,310 @@
+import math
+import os
+
+import numpy as np
+
+from util import *
+import metrics
+
+# Consecutive chunks summarized by one routing centroid of an EpisodeIndex
+CENTROID_CHUNKS = 32
+
+
+def relevance_score(distance: float, space: str = "l2") -> float:
+    """Turns a Chroma distance into a 0..1 relevance score, the same way langchain_chroma does."""
+    if space == "cosine":
+        return 1.0 - distance
+    if space == "ip":
+        return distance if distance > 0 else -distance
+    # l2 distance between unit vectors lies in [0, sqrt(2)]
+    return 1.0 - distance / math.sqrt(2)
+
+
+def embed_queries(encoder, questions: list[str], batch_size: int = 32) -> list[list[float]]:
+    """
+    Embeds all questions at once, in one call to the encoder.
+
+    Args:
+        encoder: A SentenceTransformer (one encode call) or any LangChain Embeddings,
+            which batch internally; rag_embeddings.SentenceTransformerBackend (also behind
+            CachedEmbeddings) sorts the whole list by length into its own batch_size batches
+        questions (list[str]): The questions to embed
+        batch_size (int): Forward-pass batch size for a SentenceTransformer
+    """
+    if hasattr(encoder, "encode"):
+        return encoder.encode(questions, batch_size=batch_size, convert_to_numpy=True).tolist()
+    return encoder.embed_documents(questions)
+
+
+class ChromaSearcher:
+    def __init__(self, collection):
+        """
+        Runs many query vectors against a Chroma collection in one round trip.
+
+        Args:
+            collection: A chromadb Collection (e.g. Chroma(...)._collection)
+        """
+        self.collection = collection
+        self.space = (collection.metadata or {}).get("hnsw:space", "l2")
+
+    def search(self, query_embeddings: list, k: int = 6, where: dict = None) -> list[list[dict]]:
+        """Returns, for every query vector, its k nearest chunks best first."""
+        if not query_embeddings:
+            return []
+        results = self.collection.query(
+            query_embeddings=query_embeddings,
+            n_results=k,
+            where=where,
+            include=["documents", "metadatas", "distances"],
+        )
+        hits = []
+        for ids, documents, metadatas, distances in zip(
+                results["ids"], results["documents"], results["metadatas"], results["distances"]):
+            hits.append([
+                make_hit(chunk_id, document, metadata or {}, distance, relevance_score(distance, self.space))
+                for chunk_id, document, metadata, distance in zip(ids, documents, metadatas, distances)
+            ])
+        return hits
+
+    def fetch(self, ids: list) -> dict:
+        """id -> (document, metadata) of the given chunks, in one round trip."""
+        if not ids:
+            return {}
+        page = self.collection.get(ids=list(dict.fromkeys(ids)), include=["documents", "metadatas"])
+        return {chunk_id: (document, metadata or {})
+                for chunk_id, document, metadata in zip(page["ids"], page["documents"], page["metadatas"])}
+
+
+class EpisodeIndex:
+    def __init__(self, keys: list, vectors: np.ndarray, key_field: str = "source", centroid_episodes=None,
+                 chunk_ids: list = None, chunk_vectors: np.ndarray = None, offsets=None):
+        """
+        Coarse per-episode index plus the chunk embeddings grouped by episode, so the
+        second stage of TwoStageSearcher is an in-memory scan of a few episodes' rows.
+
+        An episode is routed by its best matching centroid: the normalized mean of every
+        run of CENTROID_CHUNKS consecutive chunks, so a query matching one part of a long
+        episode still finds it.
+
+        Args:
+            keys (list): Value of key_field for each episode, as stored in the chunk metadata
+            vectors (np.ndarray): Routing centroids, grouped by episode
+            key_field (str): Chunk metadata field that identifies the episode
+            centroid_episodes (np.ndarray): Episode (row of keys) of each centroid (default: one centroid per episode)
+            chunk_ids (list): Chunk ids, grouped by episode
+            chunk_vectors (np.ndarray): Chunk embeddings in the same order
+            offsets (np.ndarray): Episode i owns chunk rows offsets[i]:offsets[i + 1]
+        """
+        self.keys = list(keys)
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        self.key_field = key_field
+        self.centroid_episodes = np.arange(len(self.keys)) if centroid_episodes is None \
+            else np.asarray(centroid_episodes, dtype=np.int64)
+        # Index of the first centroid of every episode, for the per-episode maximum
+        self.centroid_starts = np.searchsorted(self.centroid_episodes, np.arange(len(self.keys)))
+        self.chunk_ids = list(chunk_ids or [])
+        self.chunk_vectors = None if chunk_vectors is None else np.asarray(chunk_vectors, dtype=np.float32)
+        self.chunk_norms = None if chunk_vectors is None else np.sum(self.chunk_vectors ** 2, axis=1)
+        self.offsets = None if offsets is None else np.asarray(offsets, dtype=np.int64)
+
+    @property
+    def has_chunks(self) -> bool:
+        return self.chunk_vectors is not None and len(self.chunk_ids) > 0
+
+    @classmethod
+    def from_embeddings(cls, embeddings, keys: list, key_field: str = "source", ids: list = None,
+                        centroid_chunks: int = None) -> "EpisodeIndex":
+        """
+        Builds the index from chunk embeddings and the episode key of each chunk. Chunks
+        keep their relative order within an episode (transcript order when they come from
+        save_to_chroma). Without ids only the routing centroids are kept.
+        """
+        centroid_chunks = centroid_chunks or CENTROID_CHUNKS
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        order = sorted(set(keys))
+        rows = {key: i for i, key in enumerate(order)}
+        episode_of_chunk = np.asarray([rows[key] for key in keys], dtype=np.int64)
+        grouped = np.argsort(episode_of_chunk, kind="stable")
+        offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(episode_of_chunk, minlength=len(order)), out=offsets[1:])
+        vectors = embeddings[grouped]
+        starts = np.concatenate([np.arange(offsets[i], offsets[i + 1], centroid_chunks) for i in range(len(order))])
+        sums = np.add.reduceat(vectors, starts, axis=0) if len(starts) else np.zeros((0, embeddings.shape[1]))
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroid_episodes = np.searchsorted(offsets, starts, side="right") - 1
+        if ids is None:
+            return cls(order, sums / np.where(norms == 0, 1, norms), key_field, centroid_episodes)
+        return cls(order, sums / np.where(norms == 0, 1, norms), key_field, centroid_episodes,
+                   [ids[i] for i in grouped], vectors, offsets)
+
+    @classmethod
+    def from_collection(cls, collection, key_field: str = "source", page_size: int = 5000) -> "EpisodeIndex":
+        """Builds the index by paging every chunk embedding out of a Chroma collection."""
+        ids, embeddings, keys = [], [], []
+        offset = 0
+        while True:
+            page = collection.get(include=["embeddings", "metadatas"], limit=page_size, offset=offset)
+            if not len(page["ids"]):
+                break
+            for chunk_id, embedding, metadata in zip(page["ids"], page["embeddings"], page["metadatas"]):
+                # Chunks without the key cannot be routed to, so they are left out
+                if (metadata or {}).get(key_field):
+                    ids.append(chunk_id)
+                    embeddings.append(embedding)
+                    keys.append(metadata[key_field])
+            offset += len(page["ids"])
+        if not embeddings:
+            return cls([], np.zeros((0, 0), dtype=np.float32), key_field)
+        return cls.from_embeddings(embeddings, keys, key_field, ids)
+
+    def save(self, path: str):
+        tmp_path = path + ".tmp.npz"
+        arrays = {"vectors": self.vectors, "keys": np.asarray(self.keys, dtype=str),
+                  "key_field": np.asarray(self.key_field), "centroid_episodes": self.centroid_episodes}
+        if self.has_chunks:
+            arrays.update(chunk_ids=np.asarray(self.chunk_ids, dtype=str), chunk_vectors=self.chunk_vectors,
+                          offsets=self.offsets)
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "EpisodeIndex":
+        """Loads a saved index; files from before the chunk rows were kept only route."""
+        with np.load(path) as data:
+            return cls(data["keys"].tolist(), data["vectors"], str(data["key_field"]),
+                       data["centroid_episodes"] if "centroid_episodes" in data else None,
+                       data["chunk_ids"].tolist() if "chunk_ids" in data else None,
+                       data["chunk_vectors"] if "chunk_vectors" in data else None,
+                       data["offsets"] if "offsets" in data else None)
+
+    def top_episode_rows(self, query_embeddings, m: int) -> np.ndarray:
+        """Indices into keys of the m episodes best matching (cosine, best centroid) each query, best first."""
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        similarities = np.maximum.reduceat(queries @ self.vectors.T, self.centroid_starts, axis=1)
+        m = min(m, len(self.keys))
+        top = np.argpartition(-similarities, m - 1, axis=1)[:, :m]
+        order = np.take_along_axis(-similarities, top, axis=1).argsort(axis=1)
+        return np.take_along_axis(top, order, axis=1)
+
+    def top_episodes(self, query_embeddings: list, m: int) -> list[list[str]]:
+        """The m episodes most similar to each query."""
+        if not self.keys:
+            return [[] for _ in query_embeddings]
+        return [[self.keys[i] for i in row] for row in self.top_episode_rows(query_embeddings, m)]
+
+    def search(self, query_embeddings: list, k: int, m: int) -> list[list[tuple]]:
+        """
+        For every query, the k nearest chunks among the chunks of its m top episodes as
+        (chunk id, squared L2 distance) best first, Chroma's "l2" distance.
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        results = []
+        for query, episodes in zip(queries, self.top_episode_rows(queries, m)):
+            rows = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in episodes])
+            distances = self.chunk_norms[rows] - 2 * (self.chunk_vectors[rows] @ query) + query @ query
+            count = min(k, len(rows))
+            top = np.argpartition(distances, count - 1)[:count]
+            top = top[distances[top].argsort()]
+            results.append([(self.chunk_ids[rows[j]], float(distances[j])) for j in top])
+        return results
+
+
+class TwoStageSearcher:
+    def __init__(self, searcher, episode_index: EpisodeIndex, episodes: int = 8, fetcher: ChromaSearcher = None):
+        """
+        Episode-then-chunk search with the ChromaSearcher interface: each query picks its
+        top episodes from the EpisodeIndex centroids, then scans only those episodes'
+        chunk embeddings in memory. Only the texts and metadata of the final hits are
+        fetched from Chroma, by id.
+
+        Opt-in with RAG_RETRIEVAL=two-stage; flat search stays the default. On the bundled
+        corpus (45 episodes, hashing embedder) restricting the search to the top episodes
+        costs more recall than it saves time (bench_retrieval.py --episodes); the trade-off
+        is meant for corpora of thousands of episodes, measured there before switching.
+
+        Args:
+            searcher: Flat searcher (ChromaSearcher or MmapSearcher) for filtered queries
+                or an index saved without chunk rows
+            episode_index (EpisodeIndex): Per-episode centroids and chunk embeddings
+            episodes (int): Episodes searched per query (M, RAG_RETRIEVAL_EPISODES)
+            fetcher (ChromaSearcher): Fetches the hits' texts and metadata (default: searcher)
+        """
+        self.searcher = searcher
+        self.episode_index = episode_index
+        self.episodes = episodes
+        self.fetcher = fetcher or searcher
+        self.space = self.fetcher.space
+
+    def search(self, query_embeddings: list, k: int = 6, where: dict = None) -> list[list[dict]]:
+        if not len(query_embeddings):
+            return []
+        if where or not self.episode_index.has_chunks:
+            return self.searcher.search(query_embeddings, k, where)
+        matches = self.episode_index.search(query_embeddings, k, self.episodes)
+        found = self.fetcher.fetch([chunk_id for query_matches in matches for chunk_id, _ in query_matches])
+        return [[make_hit(chunk_id, *found[chunk_id], distance, relevance_score(distance, self.space))
+                 for chunk_id, distance in query_matches if chunk_id in found]
+                for query_matches in matches]
+
+
+def get_searcher(collection, episode_index_path: str = None, key_field: str = "source",
+                 vector_store_path: str = None):
+    """
+    Chunk searcher for the configured backend: Chroma, or with RAG_VECTOR_STORE=mmap the
+    exported MmapVectorStore at vector_store_path. For RAG_RETRIEVAL=two-stage it is
+    wrapped in a TwoStageSearcher; the episode index is loaded from episode_index_path,
+    or built from the collection (and saved there) when the file does not exist yet.
+    """
+    chroma_searcher = searcher = ChromaSearcher(collection)
+    if get_vector_store_name() == "mmap":
+        if vector_store_path and os.path.exists(vector_store_path):
+            from vector_store import MmapVectorStore, MmapSearcher
+            searcher = MmapSearcher(MmapVectorStore(vector_store_path), nprobe=get_vector_store_nprobe(),
+                                    rescore=get_vector_store_rescore())
+        else:
+            log("warning", f"No vector store at {vector_store_path}; searching Chroma instead")
+    if get_retrieval_mode() != "two-stage":
+        return searcher
+    if episode_index_path and os.path.exists(episode_index_path):
+        episode_index = EpisodeIndex.load(episode_index_path)
+    else:
+        episode_index = EpisodeIndex.from_collection(collection, key_field)
+        if episode_index_path:
+            episode_index.save(episode_index_path)
+    return TwoStageSearcher(searcher, episode_index, episodes=get_retrieval_episodes(), fetcher=chroma_searcher)
+
+
+def make_hit(chunk_id: str, text: str, metadata: dict, distance: float, score: float) -> dict:
+    return {
+        "id": chunk_id,
+        "text": text,
+        "score": score,
+        "distance": distance,
+        "episode_name": metadata.get("episode_name", ""),
+        "podcast_name": metadata.get("podcast_name", ""),
+        "episode_link": metadata.get("episode_link", ""),
+        "metadata": metadata,
+    }
+
+
+def batch_retrieve(searcher, encoder, questions: list[str], k: int = 6, batch_size: int = 32) -> list[list[dict]]:
+    """
+    Retrieves the top k chunks for every question with one embedding pass and one
+    vector store query.
+
+    Args:
+        searcher: Object with search(query_embeddings, k) such as ChromaSearcher
+        encoder: SentenceTransformer or LangChain Embeddings used to embed the questions
+        questions (list[str]): The questions
+        k (int): Chunks per question
+        batch_size (int): Embedding batch size
+
+    Returns:
+        One list of hits per question, ranked by score. Each hit has id, text, score,
+        distance, episode_name, podcast_name, episode_link and the raw metadata.
+    """
+    with metrics.span("query_embed"):
+        vectors = embed_queries(encoder, questions, batch_size)
+    with metrics.span("vector_search"):
+        return searcher.search(vectors, k)
@@ -1,25 +1,75 @@
 import boto3
 import json
-from botocore.exceptions import ClientError
+import random
+import time
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, BotoCoreError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 from pathlib import Path
 from datetime import date, datetime
-from typing import List, Dict, Optional 
+from typing import List, Dict, Optional, Iterator
+
+from util import get_s3_upload_workers, get_s3_multipart_mb, get_s3_max_retries
+
+# Errors that will not go away by retrying
+NON_RETRYABLE_ERRORS = {"AccessDenied", "NoSuchBucket", "NoSuchKey", "InvalidBucketName", "404", "403"}
+
+def error_code(error: Exception) -> str:
+    """S3 error code of a ClientError, also when wrapped by the transfer manager's S3UploadFailedError."""
+    while error is not None:
+        if isinstance(error, ClientError):
+            return error.response.get("Error", {}).get("Code", "")
+        error = error.__cause__ or error.__context__
+    return ""
 
 class S3Uploader:
-    def __init__(self, bucket_name: str, prefix: str = ""):
+    def __init__(self, bucket_name: str, prefix: str = "", s3_client=None, max_workers: int = None,
+                 max_retries: int = None, multipart_mb: int = None):
         """
         Initialize S3 uploader with bucket name and optional prefix
         
         Args:
             bucket_name (str): The S3 bucket name
             prefix (str): Optional prefix for all uploads (like a folder path)
+            s3_client: boto3 S3 client shared by all transfer threads (created if not given, e.g. a moto client in tests)
+            max_workers (int): Files transferred in parallel by upload_files/upload_folder (default: RAG_S3_UPLOAD_WORKERS)
+            max_retries (int): Retries with exponential backoff per file (default: RAG_S3_MAX_RETRIES)
+            multipart_mb (int): Multipart threshold and part size in MB (default: RAG_S3_MULTIPART_MB)
         """
-        self.s3_client = boto3.client('s3')
+        self.max_workers = max_workers or get_s3_upload_workers()
+        self.max_retries = get_s3_max_retries() if max_retries is None else max_retries
+        if s3_client is None:
+            # One connection per transfer thread; retries are handled per file by _with_retries
+            s3_client = boto3.client('s3', config=Config(max_pool_connections=self.max_workers * 2,
+                                                         retries={"max_attempts": 1, "mode": "standard"}))
+        self.s3_client = s3_client
+        part_size = (multipart_mb or get_s3_multipart_mb()) * 1024 * 1024
+        # Parts of one file are uploaded on a few threads; most parallelism comes from transferring many files
+        self.transfer_config = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size,
+                                              max_concurrency=4, use_threads=True)
         self.bucket_name = bucket_name
         # Remove leading/trailing slashes and ensure trailing slash if prefix exists
         self.prefix = prefix.strip('/') + '/' if prefix else ''
 
+    def _with_retries(self, func, *args, **kwargs):
+        """
+        Calls func, retrying transient S3 errors with exponential backoff and jitter.
+        Returns (result, attempts); once retries run out the last error is raised with
+        the number of attempts set as its attempts attribute.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return func(*args, **kwargs), attempt
+            except (ClientError, BotoCoreError, S3UploadFailedError) as e:
+                if error_code(e) in NON_RETRYABLE_ERRORS or attempt > self.max_retries:
+                    e.attempts = attempt
+                    raise
+                time.sleep(min(0.2 * 2 ** (attempt - 1), 5.0) * (0.5 + random.random()))
 
 
     def _get_full_key(self, key: str) -> str:
@@ -28,45 +78,46 @@ class S3Uploader:
         key = key.lstrip('/')
         return f"{self.prefix}{key}"
 
+    def iter_files(self, bucket_name: str = None, prefix: str = "", suffix: str = None,
+                   max_files: int = None) -> Iterator[dict]:
+        """
+        Yields every object under prefix, one page of 1000 keys at a time, so listing
+        thousands of files neither stops at the first page nor holds them all in memory.
+        """
+        prefix = prefix.strip('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        params = {
+            'Bucket': bucket_name or self.bucket_name,
+            'Prefix': prefix
+        }
+        count = 0
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**params):
+            for obj in page.get('Contents', []):
+                # Skip if it's a folder (ends with '/')
+                if obj['Key'].endswith('/'):
+                    continue
+
+                # Apply suffix filter if specified
+                if suffix and not obj['Key'].lower().endswith(suffix.lower()):
+                    continue
+
+                yield {
+                    'key': obj['Key'],
+                    'size': obj['Size'],
+                    'last_modified': obj['LastModified'],
+                    'name': obj['Key'].split('/')[-1]
+                }
+                count += 1
+
+                # Check if we've reached max_files
+                if max_files and count >= max_files:
+                    return
+
     def list_files_by_bucket(self, bucket_name, prefix, suffix: str=None, max_files: int=None) ->list:
         try:
-            prefix = prefix.strip('/')
-            if prefix and not prefix.endswith('/'):
-                prefix += '/'
-            params = {
-                'Bucket': bucket_name,
-                'Prefix': prefix
-            }
-            # print(params)
-            files = []
-            paginator = self.s3_client.get_paginator('list_objects_v2')
-        
-            for page in paginator.paginate(**params):
-                if 'Contents' not in page:
-                    continue
-                    
-                for obj in page['Contents']:
-                    # Skip if it's a folder (ends with '/')
-                    if obj['Key'].endswith('/'):
-                        continue
-                        
-                    # Apply suffix filter if specified
-                    if suffix and not obj['Key'].lower().endswith(suffix.lower()):
-                        continue
-                    
-                    file_info = {
-                        'key': obj['Key'],
-                        'size': obj['Size'],
-                        'last_modified': obj['LastModified'],
-                        'name': obj['Key'].split('/')[-1]
-                    }
-                    
-                    files.append(file_info)
-                    
-                    # Check if we've reached max_files
-                    if max_files and len(files) >= max_files:
-                        return files
-                return files
+            return list(self.iter_files(bucket_name, prefix, suffix, max_files))
         except ClientError as e:
             print(f"Error listing files: {e}")
             return []
@@ -91,22 +142,84 @@ class S3Uploader:
 
     def upload_file(self, file_path: str, key: str = None) -> bool:
         """Upload a file to S3 with prefix"""
+        # If no key is provided, use the filename
+        result = self.upload_file_timed(file_path, key)
+        if result["ok"]:
+            print(f"Successfully uploaded to s3://{self.bucket_name}/{result['key']}")
+        else:
+            print(f"Error uploading file to S3: {result['error']}")
+        return result["ok"]
+
+    def upload_file_timed(self, file_path: str, key: str = None) -> dict:
+        """
+        Uploads one file (multipart above the threshold) with retries and returns its
+        result: key, bytes, seconds, attempts, ok and error.
+        """
+        if key is None:
+            key = os.path.basename(file_path)
+        full_key = self._get_full_key(key)
+        result = {"path": file_path, "key": full_key, "bytes": 0, "seconds": 0.0, "attempts": 0, "ok": False,
+                  "error": None}
+        start_time = time.perf_counter()
         try:
-            # If no key is provided, use the filename
-            if key is None:
-                key = os.path.basename(file_path)
-            
-            full_key = self._get_full_key(key)
-            self.s3_client.upload_file(
-                Filename=file_path,
-                Bucket=self.bucket_name,
-                Key=full_key
-            )
-            print(f"Successfully uploaded to s3://{self.bucket_name}/{full_key}")
-            return True
+            result["bytes"] = os.path.getsize(file_path)
+            _, result["attempts"] = self._with_retries(
+                self.s3_client.upload_file, Filename=file_path, Bucket=self.bucket_name, Key=full_key,
+                Config=self.transfer_config)
+            result["ok"] = True
+        except (ClientError, BotoCoreError, S3UploadFailedError, OSError) as e:
+            result["attempts"] = getattr(e, "attempts", 1)
+            result["error"] = str(e)
+        result["seconds"] = time.perf_counter() - start_time
+        return result
+
+    def download_file(self, key: str, local_path: str) -> dict:
+        """
+        Downloads key (under the prefix) to local_path with retries, through a .part file
+        so readers never see a partial download. Returns the same result dict as
+        upload_file_timed.
+        """
+        full_key = self._get_full_key(key)
+        result = {"path": local_path, "key": full_key, "bytes": 0, "seconds": 0.0, "attempts": 0, "ok": False,
+                  "error": None}
+        start_time = time.perf_counter()
+        tmp_path = local_path + ".part"
+        try:
+            _, result["attempts"] = self._with_retries(
+                self.s3_client.download_file, Bucket=self.bucket_name, Key=full_key, Filename=tmp_path,
+                Config=self.transfer_config)
+            os.replace(tmp_path, local_path)
+            result["bytes"] = os.path.getsize(local_path)
+            result["ok"] = True
+        except (ClientError, BotoCoreError, OSError) as e:
+            result["attempts"] = getattr(e, "attempts", 1)
+            result["error"] = str(e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        result["seconds"] = time.perf_counter() - start_time
+        return result
+
+    def read_json(self, key: str) -> Optional[dict]:
+        """JSON object at key (under the prefix), or None when it does not exist."""
+        try:
+            response, _ = self._with_retries(self.s3_client.get_object, Bucket=self.bucket_name,
+                                             Key=self._get_full_key(key))
         except ClientError as e:
-            print(f"Error uploading file to S3: {e}")
-            return False
+            if error_code(e) in ("NoSuchKey", "404"):
+                return None
+            raise
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+    def upload_files(self, files: list, max_workers: int = None) -> Iterator[dict]:
+        """
+        Uploads (local path, key) pairs on a thread pool sharing this uploader's client,
+        yielding each file's result (see upload_file_timed) as it completes.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers,
+                                thread_name_prefix="s3-upload") as executor:
+            futures = [executor.submit(self.upload_file_timed, local_path, key) for local_path, key in files]
+            for future in as_completed(futures):
+                yield future.result()
 
     def upload_json(self, data: dict, key: str) -> bool:
         """Upload JSON data to S3 with prefix"""
@@ -124,21 +237,28 @@ class S3Uploader:
             print(f"Error uploading JSON to S3: {e}")
             return False
 
-    def upload_folder(self, local_folder: str, subfolder: str = "") -> dict:
+    def upload_folder(self, local_folder: str, subfolder: str = "", max_workers: int = None) -> dict:
         """
-        Upload an entire folder to S3 with prefix
+        Upload an entire folder to S3 with prefix, max_workers files at a time
         
         Args:
             local_folder (str): Path to local folder
             subfolder (str): Optional additional subfolder within the prefix
+            max_workers (int): Parallel transfers (default: the uploader's max_workers; 1 uploads serially)
+
+        Returns:
+            success/failed counts, errors, total bytes and seconds, and the per-file
+            results of upload_file_timed under "files"
         """
-        results = {"success": 0, "failed": 0, "errors": []}
+        results = {"success": 0, "failed": 0, "errors": [], "bytes": 0, "seconds": 0.0, "files": []}
+        start_time = time.perf_counter()
         
         try:
             folder_path = Path(local_folder)
             if not folder_path.exists():
                 raise ValueError(f"Folder not found: {local_folder}")
 
+            transfers = []
             for root, _, files in os.walk(folder_path):
                 for file in files:
                     local_path = os.path.join(root, file)
@@ -150,17 +270,22 @@ class S3Uploader:
                         s3_key = os.path.join(subfolder, relative_path)
                     else:
                         s3_key = relative_path
+                    transfers.append((local_path, s3_key))
 
-                    if self.upload_file(local_path, s3_key):
-                        results["success"] += 1
-                    else:
-                        results["failed"] += 1
-                        results["errors"].append(f"Failed to upload: {relative_path}")
+            for result in self.upload_files(transfers, max_workers):
+                results["files"].append(result)
+                if result["ok"]:
+                    results["success"] += 1
+                    results["bytes"] += result["bytes"]
+                else:
+                    results["failed"] += 1
+                    results["errors"].append(f"Failed to upload: {os.path.relpath(result['path'], local_folder)} ({result['error']})")
 
         except Exception as e:
             results["failed"] += 1
             results["errors"].append(str(e))
 
+        results["seconds"] = time.perf_counter() - start_time
         return results
 
     
@@ -210,29 +335,33 @@ class S3Uploader:
             print(f"Error reading file from S3: {e}")
             return None
 
-    def list_s3_folders1(bucket_name, prefix='', debug=True):
-        s3_client = boto3.client('s3')
+    @staticmethod
+    def iter_s3_folders(bucket_name, prefix='', s3_client=None) -> Iterator[str]:
+        """Yields the "folders" (common prefixes) directly under prefix across every page of results."""
+        s3_client = s3_client or boto3.client('s3')
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix.lstrip('/'), Delimiter='/'):
+            for obj in page.get('CommonPrefixes', []):
+                yield obj['Prefix']
+
+    @staticmethod
+    def list_s3_folders1(bucket_name, prefix='', debug=True, s3_client=None):
+        s3_client = s3_client or boto3.client('s3')
     
         # Remove leading slash from prefix
         prefix = prefix.lstrip('/')
         
         try:
-            # List objects directly
-            response = s3_client.list_objects_v2(
-                Bucket=bucket_name, 
-                Prefix=prefix,
-                Delimiter='/'
-            )
-            
-            # Extract folders and objects
-            folders = [
-                obj['Prefix'] for obj in response.get('CommonPrefixes', [])
-            ]
+            # Extract folders, following pagination past the first 1000 entries
+            folders = list(S3Uploader.iter_s3_folders(bucket_name, prefix, s3_client))
             
             # If no folders, list all objects under prefix
             if not folders:
+                paginator = s3_client.get_paginator('list_objects_v2')
                 objects = [
-                    obj['Key'] for obj in response.get('Contents', [])
+                    obj['Key']
+                    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+                    for obj in page.get('Contents', [])
                     if obj['Key'] != prefix
                 ]
                 return objects
@@ -244,6 +373,7 @@ class S3Uploader:
             return []
 
 
+    @staticmethod
     def list_s3_folders(bucket_name, prefix=''):
         # s3 = boto3.client('s3')
         s3 = boto3.resource('s3')
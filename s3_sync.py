@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import metrics
+from util import log
+
+
+def md5_file(path: str) -> str:
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def matches_etag(path: str, obj) -> bool:
+    """
+    Whether the local file has the object's content. Only a single-part ETag is the MD5
+    of the content; multipart ("<md5>-<parts>") ETags cannot be checked, so they never match.
+    """
+    etag = obj["ETag"].strip('"')
+    if "-" in etag or os.path.getsize(path) != obj["Size"]:
+        return False
+    return md5_file(path) == etag
+
+
+class S3Sync:
+    def __init__(self, bucket_name: str, local_dir: str, prefix: str = "", s3_client=None,
+                 max_workers: int = 8, manifest_name: str = ".s3_sync_manifest.json"):
+        """
+        Mirrors every object under an S3 prefix into one flat local folder.
+
+        Objects with the same file name in different sub-folders are flattened to the
+        most recently modified one. What is already on disk is tracked in a manifest
+        of ETag/LastModified per file, so only new or changed objects are downloaded.
+
+        Args:
+            bucket_name (str): The S3 bucket name
+            local_dir (str): Local folder the files are written to
+            prefix (str): Folder (prefix) inside the bucket to mirror
+            s3_client: boto3 S3 client shared by all download threads (created if not given)
+            max_workers (int): Number of concurrent downloads
+            manifest_name (str): Name of the manifest file kept inside local_dir
+        """
+        self.bucket_name = bucket_name
+        self.local_dir = local_dir
+        self.prefix = prefix
+        if s3_client is None:
+            import boto3
+            s3_client = boto3.client("s3")
+        self.s3_client = s3_client
+        self.max_workers = max_workers
+        self.manifest_path = os.path.join(local_dir, manifest_name)
+        self.manifest = None
+        self.stale = None
+
+    def load_manifest(self) -> dict:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, "r") as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest: dict):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def list_latest(self) -> dict:
+        """Returns {file name: latest object} for every object under the prefix."""
+        latest = {}
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                if obj["Key"].endswith("/"):
+                    continue
+                filename = os.path.basename(obj["Key"])
+                if filename not in latest or latest[filename]["LastModified"] < obj["LastModified"]:
+                    latest[filename] = obj
+        return latest
+
+    def plan(self, manifest: dict) -> dict:
+        """
+        Returns the objects that have to be downloaded. Files already on disk that the
+        manifest does not know yet are adopted when their MD5 matches a single-part ETag.
+        """
+        stale = {}
+        for filename, obj in self.list_latest().items():
+            entry = manifest.get(filename)
+            local_path = os.path.join(self.local_dir, filename)
+            if not os.path.exists(local_path):
+                stale[filename] = obj
+            elif entry is None:
+                if matches_etag(local_path, obj):
+                    manifest[filename] = self._manifest_entry(obj)
+                else:
+                    stale[filename] = obj
+            elif entry["etag"] != obj["ETag"] or entry["last_modified"] < obj["LastModified"].isoformat():
+                stale[filename] = obj
+        return stale
+
+    def _manifest_entry(self, obj) -> dict:
+        return {"key": obj["Key"], "etag": obj["ETag"], "last_modified": obj["LastModified"].isoformat(),
+                "size": obj["Size"]}
+
+    def _download(self, filename: str, obj) -> str:
+        local_path = os.path.join(self.local_dir, filename)
+        # Download next to the target and rename, so readers never see a partial file
+        tmp_path = local_path + ".part"
+        try:
+            self.s3_client.download_file(self.bucket_name, obj["Key"], tmp_path)
+            os.replace(tmp_path, local_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        metrics.inc("rag_s3_bytes_total", obj["Size"], direction="download")
+        return local_path
+
+    def prepare(self) -> dict:
+        """
+        Lists the prefix and works out what sync() will download, so callers know which
+        local files are about to be replaced. Returns {file name: object}.
+        """
+        os.makedirs(self.local_dir, exist_ok=True)
+        self.manifest = self.load_manifest()
+        self.stale = self.plan(self.manifest)
+        return self.stale
+
+    def sync(self):
+        """
+        Downloads every stale object (as planned by prepare(), which runs first if it was
+        not called) through a thread pool and yields the local path of each file as soon
+        as it is on disk, in completion order. The manifest is saved when the generator
+        finishes, including after a failure part way through.
+        """
+        if self.stale is None:
+            self.prepare()
+        manifest, stale = self.manifest, self.stale
+        log("info", f"Syncing {len(stale)} files from s3://{self.bucket_name}/{self.prefix}")
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(self._download, filename, obj): filename
+                           for filename, obj in stale.items()}
+                for future in as_completed(futures):
+                    filename = futures[future]
+                    try:
+                        local_path = future.result()
+                    except Exception as e:
+                        log("error", f"Error downloading {stale[filename]['Key']}: {e}")
+                        continue
+                    manifest[filename] = self._manifest_entry(stale[filename])
+                    yield local_path
+        finally:
+            self.save_manifest(manifest)
@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from util import *
+from answer_cache import normalize_question
+from conversation_memory import ConversationMemory
+
+
+def answer_key(question: str, history: str = "") -> str:
+    """
+    Per-session answer cache key. A follow-up like "tell me more" means something else
+    after every turn, so the conversation history the answer was given after is part of it.
+    """
+    key = normalize_question(question)
+    if history:
+        key += "\0" + hashlib.sha1(history.encode("utf-8")).hexdigest()[:16]
+    return key
+
+
+class Session:
+    __slots__ = ("session_id", "memory", "sources", "answers", "created", "last_used", "max_answers")
+
+    def __init__(self, session_id: str, memory: ConversationMemory, max_answers: int = 16):
+        """
+        Everything one conversation needs between turns: its bounded memory, the episodes
+        cited so far and a small cache of the answers it already got.
+
+        Args:
+            session_id (str): Key the session is looked up by
+            memory (ConversationMemory): Chat history of this session
+            max_answers (int): Answers kept in the per-session cache, least recently used dropped
+        """
+        self.session_id = session_id
+        self.memory = memory
+        self.sources = OrderedDict()  # episode name -> {"podcast_name", "episode_link"}, in citation order
+        self.answers = OrderedDict()  # answer_key(question, history) -> {"answer", "sources"}
+        self.created = time.time()
+        self.last_used = self.created
+        self.max_answers = max_answers
+
+    def add_sources(self, hits: list) -> list:
+        """Records the episodes behind hits; returns the ones this session had not cited before."""
+        new = []
+        for hit in hits:
+            if hit["episode_name"] in self.sources:
+                continue
+            self.sources[hit["episode_name"]] = {"podcast_name": hit["podcast_name"], "episode_link": hit["episode_link"]}
+            new.append(hit["episode_name"])
+        return new
+
+    def get_answer(self, question: str, history: str = ""):
+        """The answer this session already got for question with the same history before it, or None."""
+        key = answer_key(question, history)
+        result = self.answers.get(key)
+        if result is not None:
+            self.answers.move_to_end(key)
+        return result
+
+    def put_answer(self, question: str, answer: str, sources: str, history: str = ""):
+        key = answer_key(question, history)
+        self.answers[key] = {"answer": answer, "sources": sources}
+        self.answers.move_to_end(key)
+        while len(self.answers) > self.max_answers:
+            self.answers.popitem(last=False)
+
+    def record(self, question: str, answer: str, sources: str = "", hits: list = (), history: str = ""):
+        """
+        Adds a finished turn to the memory, the source list and the answer cache; history
+        is the memory rendered when the question was asked, which the answer depends on.
+        """
+        self.memory.add(question, answer)
+        self.add_sources(hits)
+        if sources:
+            self.put_answer(question, answer, sources, history)
+
+    def size(self) -> int:
+        """Approximate bytes of text held by the session."""
+        return (self.memory.size()
+                + sum(len(name) + len(source["episode_link"]) for name, source in self.sources.items())
+                + sum(len(key) + len(result["answer"]) + len(result["sources"]) for key, result in self.answers.items()))
+
+    def to_dict(self) -> dict:
+        return {
+            "session_id": self.session_id,
+            "memory": self.memory.to_dict(),
+            "sources": list(self.sources.items()),
+            "answers": list(self.answers.items()),
+            "created": self.created,
+            "last_used": self.last_used,
+        }
+
+    def load(self, state: dict):
+        self.memory.load(state["memory"])
+        self.sources = OrderedDict(state["sources"])
+        self.answers = OrderedDict(state["answers"])
+        self.created = state["created"]
+        self.last_used = state["last_used"]
+
+
+class SessionStore:
+    def __init__(self, memory_factory=ConversationMemory, max_sessions: int = 1000, idle_seconds: float = 1800,
+                 max_bytes: int = 64 * 1024 * 1024, spill_dir: str = None):
+        """
+        Sessions by ID for a process that serves many conversations.
+
+        Sessions idle for longer than idle_seconds are evicted, and beyond max_sessions or
+        max_bytes (estimated from the text they hold) the least recently used ones go
+        first. With spill_dir set, evicted sessions are written there as JSON and loaded
+        back transparently on their next request; without it they are dropped.
+
+        Args:
+            memory_factory: Callable returning a fresh ConversationMemory for a new session
+            max_sessions (int): Sessions kept in memory
+            idle_seconds (float): Idle time after which a session is evicted (0 disables)
+            max_bytes (int): Approximate cap on the text held by all sessions in memory
+            spill_dir (str): Optional directory for evicted sessions
+        """
+        self.memory_factory = memory_factory
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.evictions = 0
+        self.spilled = 0
+        self.restored = 0
+        self._sessions = OrderedDict()  # session id -> Session, least recently used first
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def _spill_path(self, session_id: str) -> str:
+        return os.path.join(self.spill_dir, hashlib.sha1(session_id.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, session_id: str) -> Session:
+        """The session for session_id, restored from the spill directory or created if unknown."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = Session(session_id, self.memory_factory())
+                if self.spill_dir and os.path.exists(self._spill_path(session_id)):
+                    with open(self._spill_path(session_id), "r") as f:
+                        session.load(json.load(f))
+                    os.remove(self._spill_path(session_id))
+                    self.restored += 1
+                self._sessions[session_id] = session
+                self._resize(session)
+            self._sessions.move_to_end(session_id)
+            session.last_used = time.time()
+            self._evict(keep=session_id)
+            return session
+
+    def save(self, session: Session):
+        """Call after a turn changed the session, so its size counts toward max_bytes."""
+        with self._lock:
+            if session.session_id in self._sessions:
+                self._resize(session)
+                self._evict(keep=session.session_id)
+
+    def _resize(self, session: Session):
+        size = session.size()
+        self._bytes += size - self._sizes.get(session.session_id, 0)
+        self._sizes[session.session_id] = size
+
+    def _evict(self, keep: str = None):
+        now = time.time()
+        for session_id in list(self._sessions):
+            session = self._sessions[session_id]
+            if session_id == keep:
+                continue
+            over_limit = len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes
+            idle = self.idle_seconds and now - session.last_used > self.idle_seconds
+            if not over_limit and not idle:
+                # Sessions are in LRU order, so the rest are neither idle nor needed to free space
+                break
+            self._remove(session)
+
+    def _remove(self, session: Session):
+        del self._sessions[session.session_id]
+        self._bytes -= self._sizes.pop(session.session_id, 0)
+        self.evictions += 1
+        if self.spill_dir:
+            self._write(session)
+
+    def _write(self, session: Session):
+        path = self._spill_path(session.session_id)
+        with open(path + ".tmp", "w") as f:
+            json.dump(session.to_dict(), f)
+        os.replace(path + ".tmp", path)
+        self.spilled += 1
+
+    def drop(self, session_id: str):
+        """Forgets a session, including its spilled copy."""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self._bytes -= self._sizes.pop(session_id, 0)
+        if self.spill_dir and os.path.exists(self._spill_path(session_id)):
+            os.remove(self._spill_path(session_id))
+
+    def sweep(self):
+        """Evicts idle sessions; servers call this periodically so idle sessions do not wait for the next request."""
+        with self._lock:
+            self._evict()
+
+    def close(self):
+        """Spills every session still in memory (no-op without a spill directory)."""
+        with self._lock:
+            if self.spill_dir:
+                for session in self._sessions.values():
+                    self._write(session)
+            self._sessions.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self._bytes,
+            "evictions": self.evictions,
+            "spilled": self.spilled,
+            "restored": self.restored,
+        }
+
+
+def get_session_store(llm=None) -> SessionStore:
+    """
+    SessionStore configured from RAG_SESSION_* whose sessions get a ConversationMemory
+    configured from RAG_MEMORY_* (llm summarizes old turns when RAG_MEMORY_SUMMARY is on).
+    """
+    def memory_factory():
+        return ConversationMemory(
+            token_budget=get_memory_token_budget(),
+            llm=llm if memory_summary_enabled() else None,
+            summary_tokens=get_memory_summary_tokens(),
+            model_name=get_rag_llm(),
+        )
+    return SessionStore(
+        memory_factory,
+        max_sessions=get_session_max_sessions(),
+        idle_seconds=get_session_idle_seconds(),
+        max_bytes=get_session_max_mb() * 1024 * 1024,
+        spill_dir=get_session_spill_dir() or None,
+    )
@@ -0,0 +1,86 @@
+"""
+EmbeddingCache shared between processes: two instances on one directory stand in for
+an ingestion and a query process (fcntl locks are per open file, so they exclude each
+other like separate processes would).
+
+    python -m pytest tests
+"""
+import multiprocessing
+
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from embedding_cache import EmbeddingCache
+
+DIM = 4
+# Room for four rows of DIM float32s
+MAX_BYTES = 4 * DIM * 4
+
+
+def vector(n: int) -> list:
+    return [float(n)] * DIM
+
+
+def test_reads_back_after_reopen(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model", MAX_BYTES)
+    cache.put(cache.key("a"), vector(1))
+    cache.flush()
+    reopened = EmbeddingCache(str(tmp_path), "model", MAX_BYTES)
+    assert reopened.get(reopened.key("a")) == vector(1)
+    assert reopened.get(reopened.key("b")) is None
+
+
+def test_row_evicted_by_another_process_is_a_miss(tmp_path):
+    writer = EmbeddingCache(str(tmp_path), "model", MAX_BYTES)
+    writer.put(writer.key("a"), vector(1))
+    writer.flush()
+    reader = EmbeddingCache(str(tmp_path), "model", MAX_BYTES)
+    assert reader.get(reader.key("a")) == vector(1)
+
+    # Fill the cache so "a" is evicted and its row reused
+    for n in range(2, 6):
+        writer.put(writer.key(f"text {n}"), vector(n))
+    assert writer.evictions == 1
+    assert writer.get(writer.key("a")) is None
+    assert reader.get(reader.key("a")) is None
+
+
+def test_writers_do_not_share_rows(tmp_path):
+    first = EmbeddingCache(str(tmp_path), "model", MAX_BYTES)
+    second = EmbeddingCache(str(tmp_path), "model", MAX_BYTES)
+    first.put(first.key("a"), vector(1))
+    second.put(second.key("b"), vector(2))
+    assert first.get(first.key("a")) == vector(1)
+    assert second.get(second.key("b")) == vector(2)
+    first.flush()
+    second.flush()
+    reopened = EmbeddingCache(str(tmp_path), "model", MAX_BYTES)
+    assert reopened.get(reopened.key("a")) == vector(1)
+    assert reopened.get(reopened.key("b")) == vector(2)
+
+
+def fill(cache_dir: str, start: int):
+    cache = EmbeddingCache(cache_dir, "model", 64 * DIM * 4)
+    for n in range(start, start + 200):
+        cache.put(cache.key(f"text {n}"), vector(n))
+        cache.flush()
+
+
+def test_concurrent_writers_never_serve_a_wrong_vector(tmp_path):
+    texts = [n for start in (0, 1000) for n in range(start, start + 200)]
+    processes = [multiprocessing.Process(target=fill, args=(str(tmp_path), start)) for start in (0, 1000)]
+    for process in processes:
+        process.start()
+    while any(process.is_alive() for process in processes):
+        # A reader opened mid-run keeps its view of the index while the writers evict rows
+        reader = EmbeddingCache(str(tmp_path), "model", 64 * DIM * 4)
+        for _ in range(3):
+            for n in texts:
+                assert reader.get(reader.key(f"text {n}")) in (None, vector(n))
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    reader = EmbeddingCache(str(tmp_path), "model", 64 * DIM * 4)
+    found = [n for n in texts if reader.get(reader.key(f"text {n}")) == vector(n)]
+    assert len(found) == 64
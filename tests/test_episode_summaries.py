@@ -0,0 +1,94 @@
+"""
+Episode summaries: summarize_transcripts only pays for new or changed transcripts and
+prunes removed ones, and find() serves whole-episode summary questions only.
+
+    python -m pytest tests
+"""
+import json
+
+from episode_summaries import EpisodeSummaryStore, StubSummarizer, summarize_transcripts
+
+EPISODES = {
+    "doula.txt": ("A Sweet Conversation About Dying With Death Doula Alua Arthur", "Alua talks about dying well."),
+    "yarvin.txt": ("Curtis Yarvin On Monarchy", "Curtis argues for monarchy."),
+}
+
+
+class CountingSummarizer(StubSummarizer):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def summarize(self, text: str, metadata: dict) -> str:
+        self.calls.append(metadata["episode_name"])
+        return super().summarize(text, metadata)
+
+
+def write_transcripts(tmp_path, episodes: dict) -> tuple:
+    """Writes transcript files; returns (file name -> path, file name -> hash) like generate_data_store."""
+    paths, hashes = {}, {}
+    for file_name, (episode_name, text) in episodes.items():
+        path = tmp_path / file_name
+        path.write_text(json.dumps({"Episode Name": episode_name, "Podcast Name": "Podcast", "text": text}))
+        paths[file_name] = str(path)
+        hashes[file_name] = f"{file_name}:{text}"
+    return paths, hashes
+
+
+def test_unchanged_transcripts_are_not_summarized_again(tmp_path):
+    store = EpisodeSummaryStore(str(tmp_path / "summaries.json"))
+    summarizer = CountingSummarizer()
+    paths, hashes = write_transcripts(tmp_path, EPISODES)
+    assert summarize_transcripts(store, summarizer, paths, hashes) == 2
+
+    reopened = EpisodeSummaryStore(str(tmp_path / "summaries.json"))
+    assert summarize_transcripts(reopened, summarizer, paths, hashes) == 0
+    assert len(summarizer.calls) == 2
+
+    changed = dict(EPISODES, **{"yarvin.txt": ("Curtis Yarvin On Monarchy", "Curtis argues for kings.")})
+    paths, hashes = write_transcripts(tmp_path, changed)
+    assert summarize_transcripts(reopened, summarizer, paths, hashes) == 1
+    assert summarizer.calls[-1] == "Curtis Yarvin On Monarchy"
+    assert len(reopened.entries) == 2
+
+
+def test_removed_transcripts_are_pruned(tmp_path):
+    store = EpisodeSummaryStore(str(tmp_path / "summaries.json"))
+    paths, hashes = write_transcripts(tmp_path, EPISODES)
+    summarize_transcripts(store, StubSummarizer(), paths, hashes)
+    del paths["yarvin.txt"], hashes["yarvin.txt"]
+    assert summarize_transcripts(store, StubSummarizer(), paths, hashes) == 0
+    assert list(store.entries) == [hashes["doula.txt"]]
+    assert store.find("summarize curtis yarvin on monarchy") is None
+    assert list(EpisodeSummaryStore(str(tmp_path / "summaries.json")).entries) == [hashes["doula.txt"]]
+
+
+def test_find_by_name_right_after_put(tmp_path):
+    store = EpisodeSummaryStore(str(tmp_path / "summaries.json"))
+    paths, hashes = write_transcripts(tmp_path, EPISODES)
+    summarize_transcripts(store, StubSummarizer(), paths, hashes)
+    # Found on the instance that wrote the summaries, without a reload
+    entry = store.find("Can you summarize the Curtis Yarvin on monarchy episode?")
+    assert entry["episode_name"] == "Curtis Yarvin On Monarchy"
+    entry = store.find("what was a sweet conversation about dying with death doula alua arthur about")
+    assert entry["episode_name"] == EPISODES["doula.txt"][0]
+
+
+def test_find_this_episode_uses_recent_episodes(tmp_path):
+    store = EpisodeSummaryStore(str(tmp_path / "summaries.json"))
+    paths, hashes = write_transcripts(tmp_path, EPISODES)
+    summarize_transcripts(store, StubSummarizer(), paths, hashes)
+    recent = [EPISODES["doula.txt"][0], EPISODES["yarvin.txt"][0]]
+    assert store.find("what is this episode about?", recent)["episode_name"] == "Curtis Yarvin On Monarchy"
+    assert store.find("give me a recap of the last episode", recent[:1])["episode_name"] == recent[0]
+    assert store.find("what is this episode about?") is None
+
+
+def test_find_rejects_questions_about_something_in_an_episode(tmp_path):
+    store = EpisodeSummaryStore(str(tmp_path / "summaries.json"))
+    paths, hashes = write_transcripts(tmp_path, EPISODES)
+    summarize_transcripts(store, StubSummarizer(), paths, hashes)
+    recent = [EPISODES["yarvin.txt"][0]]
+    assert store.find("what did they say about elections in curtis yarvin on monarchy", recent) is None
+    assert store.find("give me an overview of what the guest said about inflation in this episode", recent) is None
+    assert store.find("who is curtis yarvin", recent) is None
@@ -0,0 +1,97 @@
+"""
+Index snapshots against a moto-mocked bucket: publish, pull and commit, checksum
+verification, and a failed swap being retried on the next poll.
+
+    python -m pytest tests
+"""
+import json
+import os
+
+import pytest
+
+moto = pytest.importorskip("moto")
+boto3 = pytest.importorskip("boto3")
+
+from index_snapshot import ARCHIVE_NAME, SnapshotPoller, SnapshotPuller, publish_snapshot
+from s3Connect import S3Uploader
+
+BUCKET = "snapshots"
+PREFIX = "index-snapshots"
+
+
+@pytest.fixture
+def uploader(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield S3Uploader(BUCKET, prefix=PREFIX, s3_client=client, max_retries=0)
+
+
+def publish(uploader, root, version: int) -> dict:
+    """Publishes a stand-in index directory whose manifest has the given version."""
+    chroma_path = root / f"chroma-v{version}"
+    chroma_path.mkdir()
+    (chroma_path / "ingest_manifest.json").write_text(json.dumps({"version": version}))
+    (chroma_path / "chroma.sqlite3").write_text(f"index {version}")
+    return publish_snapshot(str(chroma_path), uploader)
+
+
+def test_publish_pull_commit(uploader, tmp_path):
+    meta = publish(uploader, tmp_path, 1)
+    puller = SnapshotPuller(str(tmp_path / "node"), uploader)
+    path, pulled_meta = puller.pull()
+    assert pulled_meta["id"] == meta["id"] and pulled_meta["version"] == 1
+    with open(os.path.join(path, "chroma.sqlite3")) as f:
+        assert f.read() == "index 1"
+    # Unpacked but not live until committed
+    assert puller.current() == (None, None)
+    puller.commit(meta["id"])
+    assert puller.current() == (meta["id"], path)
+    assert puller.pull() is None
+
+
+def test_checksum_mismatch_is_rejected(uploader, tmp_path):
+    meta = publish(uploader, tmp_path, 1)
+    uploader.s3_client.put_object(Bucket=BUCKET, Key=f"{PREFIX}/{meta['id']}/{ARCHIVE_NAME}", Body=b"tampered")
+    node = tmp_path / "node"
+    puller = SnapshotPuller(str(node), uploader)
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        puller.pull()
+    assert puller.current() == (None, None)
+    assert os.listdir(node) == []
+
+
+def test_failed_swap_is_retried(uploader, tmp_path):
+    meta = publish(uploader, tmp_path, 1)
+    puller = SnapshotPuller(str(tmp_path / "node"), uploader)
+    swapped = []
+
+    def on_ready(path, pulled_meta):
+        swapped.append(pulled_meta["id"])
+        if len(swapped) == 1:
+            raise RuntimeError("swap failed")
+
+    poller = SnapshotPoller(puller, on_ready, interval=3600)
+    assert poller.poll() is False
+    assert poller.stats() == {"current": None, "swaps": 0, "errors": 1}
+    assert poller.poll() is True
+    assert swapped == [meta["id"], meta["id"]]
+    assert poller.stats() == {"current": meta["id"], "swaps": 1, "errors": 1}
+    assert poller.poll() is False
+    assert len(swapped) == 2
+
+
+def test_old_snapshots_are_pruned_after_commit(uploader, tmp_path):
+    pytest.importorskip("chromadb")
+    node = tmp_path / "node"
+    puller = SnapshotPuller(str(node), uploader, keep=2)
+    poller = SnapshotPoller(puller, lambda path, meta: None, interval=3600)
+    ids = []
+    for version in (1, 2, 3):
+        ids.append(publish(uploader, tmp_path, version)["id"])
+        assert poller.poll() is True
+    assert puller.current()[0] == ids[-1]
+    assert sorted(name for name in os.listdir(node) if name != "CURRENT") == sorted(ids[1:])
@@ -0,0 +1,117 @@
+"""
+QueryService request handling against a stand-in engine: malformed bodies get 400, and
+session lookups run on the worker pool rather than the event loop.
+
+    python -m pytest tests
+"""
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("aiohttp")
+from aiohttp.test_utils import TestClient, TestServer
+
+from query_server import QueryService
+
+
+class FakeEngine:
+    def retrieve(self, questions, k):
+        return [[] for _ in questions]
+
+    def prepare_turn(self, question, k, recent_episodes, history):
+        return {"question": question}
+
+    async def aanswer_turn(self, turn, history):
+        return {"answer": f"answer to {turn['question']}", "sources": [], "hits": [], "cache": None}
+
+
+class FakeMemory:
+    def render(self):
+        return ""
+
+
+class FakeSession:
+    memory = FakeMemory()
+    sources = []
+
+    def get_answer(self, question, history):
+        return None
+
+    def record(self, *args):
+        pass
+
+
+class FakeSessions:
+    def __init__(self):
+        self.threads = []
+
+    def get(self, session_id):
+        self.threads.append(threading.current_thread().name)
+        return FakeSession()
+
+    def save(self, session):
+        self.threads.append(threading.current_thread().name)
+
+    def close(self):
+        pass
+
+
+def run(requests):
+    """Runs requests(client, service) against a QueryService serving FakeEngine."""
+    async def main():
+        service = QueryService("unused", workers=2)
+        service.engine = FakeEngine()
+        service.sessions = FakeSessions()
+        app = service.make_app()
+        # Skip loading the real engine
+        app.on_startup.clear()
+        async with TestClient(TestServer(app)) as client:
+            return await requests(client, service)
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("path,body", [
+    ("/answer", {}),
+    ("/answer", {"question": ""}),
+    ("/answer", {"question": 42}),
+    ("/answer", {"question": "q", "k": "many"}),
+    ("/answer", {"question": "q", "session_id": 7}),
+    ("/answer", ["question"]),
+    ("/retrieve", {}),
+    ("/retrieve", {"questions": []}),
+    ("/retrieve", {"questions": ["q", None]}),
+    ("/retrieve", {"question": "q", "k": 0}),
+])
+def test_malformed_body_is_400(path, body):
+    async def requests(client, service):
+        response = await client.post(path, json=body)
+        return response.status
+    assert run(requests) == 400
+
+
+def test_body_that_is_not_json_is_400():
+    async def requests(client, service):
+        response = await client.post("/answer", data="question=q")
+        return response.status
+    assert run(requests) == 400
+
+
+def test_answer_with_session_uses_worker_pool():
+    async def requests(client, service):
+        response = await client.post("/answer", json={"question": "q", "k": "3", "session_id": "s"})
+        return response.status, await response.json(), service.sessions.threads
+    status, body, threads = run(requests)
+    assert status == 200
+    assert body["answer"] == "answer to q"
+    assert threads and all(name.startswith("rag-worker") for name in threads)
+
+
+def test_retrieve_accepts_question_or_questions():
+    async def requests(client, service):
+        single = await (await client.post("/retrieve", json={"question": "q"})).json()
+        batch = await (await client.post("/retrieve", json={"questions": ["a", "b"]})).json()
+        return single, batch
+    single, batch = run(requests)
+    assert [result["question"] for result in single["results"]] == ["q"]
+    assert [result["question"] for result in batch["results"]] == ["a", "b"]
@@ -0,0 +1,91 @@
+"""
+query.answer_turn streaming through StubChatModel: the sources are printed before the
+first token, tokens reach the terminal one at a time, and StreamPrinter measures the turn.
+
+    python -m pytest tests
+"""
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("langchain_chroma")
+pytest.importorskip("langchain_openai")
+
+import query
+from conversation_memory import ConversationMemory
+from rag_engine import StubChatModel, format_sources
+from session_store import Session
+
+TOKEN_DELAY = 0.02
+HIT = {"chunk_id": "c1", "text": "Alua Arthur talks about dying well.", "score": 0.9,
+       "podcast_name": "Podcast", "episode_name": "Death Doula", "episode_link": "https://example.com/1",
+       "metadata": {"episode_name": "Death Doula"}}
+
+
+class FakeEngine:
+    """RagEngine stand-in with one hit per question and the stub chat model."""
+
+    def __init__(self):
+        self.llm = StubChatModel(token_delay=TOKEN_DELAY)
+        self.remembered = []
+
+    def prepare_turn(self, question, k, recent_episodes, history):
+        return {"question": question, "hits": [HIT], "cached": None}
+
+    def has_results(self, hits):
+        return bool(hits)
+
+    def build_prompt(self, question, hits, history=""):
+        return f"{hits[0]['text']}\n\nAnswer the question based on the above context: {question}"
+
+    def remember(self, turn, result):
+        self.remembered.append(result)
+
+
+class TimedStdout:
+    """Records every write to stdout with the time it happened."""
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, text):
+        if text:
+            self.writes.append((time.perf_counter(), text))
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def test_answer_streams_after_the_sources(monkeypatch):
+    engine = FakeEngine()
+    session = Session("s", ConversationMemory())
+    printer = query.StreamPrinter()
+    stdout = TimedStdout()
+    monkeypatch.setattr(sys, "stdout", stdout)
+    args = SimpleNamespace(k=6, no_stream=False)
+    assert query.answer_turn(engine, session, "what is a death doula?", args, printer, time.perf_counter())
+    monkeypatch.undo()
+
+    texts = [text for _, text in stdout.writes]
+    sources_at = texts.index(f"Sources: {format_sources([HIT])}\n")
+    bot_at = texts.index("Bot: ")
+    tokens = [(at, text) for at, text in stdout.writes[bot_at + 1:] if text != "\n"]
+    prompt_words = len(engine.build_prompt("what is a death doula?", [HIT]).split())
+    answer = f"Stub answer to 'what is a death doula?' from {prompt_words} prompt words."
+    assert sources_at < bot_at
+    assert "".join(text for _, text in tokens) == answer
+    # One write per word, each after its own delay rather than all at the end
+    assert len(tokens) == len(answer.split(" "))
+    gaps = [later - earlier for (earlier, _), (later, _) in zip(tokens, tokens[1:])]
+    assert min(gaps) >= TOKEN_DELAY * 0.5
+
+    stats = printer.turns[-1]
+    assert stats["ttft_s"] >= TOKEN_DELAY
+    assert stats["tokens"] == len(tokens)
+    assert 0 < stats["tokens_per_s"] <= 1 / (TOKEN_DELAY * 0.5)
+    assert stats["total_s"] > stats["ttft_s"]
+    assert engine.remembered == [{"answer": answer, "sources": format_sources([HIT])}]
+    assert session.get_answer("what is a death doula?")["answer"] == answer
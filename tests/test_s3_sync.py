@@ -0,0 +1,149 @@
+"""
+S3Sync against a moto-mocked bucket: stale detection by ETag, skipping unchanged files,
+adopting local files whose MD5 matches a single-part ETag, the .part download-then-rename,
+and chunking files as they arrive.
+
+    python -m pytest tests
+"""
+import json
+import os
+
+import pytest
+
+moto = pytest.importorskip("moto")
+boto3 = pytest.importorskip("boto3")
+
+from s3_sync import S3Sync
+
+BUCKET = "transcripts"
+PREFIX = "transcriptions/"
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def put(client, key: str, body: str):
+    client.put_object(Bucket=BUCKET, Key=PREFIX + key, Body=body.encode("utf-8"))
+
+
+def run_sync(client, local_dir) -> list:
+    return sorted(os.path.basename(path) for path in S3Sync(BUCKET, str(local_dir), PREFIX, s3_client=client,
+                                                             max_workers=2).sync())
+
+
+def test_first_sync_downloads_and_flattens(s3_client, tmp_path):
+    put(s3_client, "a.txt", "first")
+    put(s3_client, "2024/b.txt", "second")
+    assert run_sync(s3_client, tmp_path) == ["a.txt", "b.txt"]
+    assert (tmp_path / "a.txt").read_text() == "first"
+    assert (tmp_path / "b.txt").read_text() == "second"
+
+
+def test_unchanged_objects_are_skipped(s3_client, tmp_path):
+    put(s3_client, "a.txt", "first")
+    run_sync(s3_client, tmp_path)
+    assert run_sync(s3_client, tmp_path) == []
+
+
+def test_changed_etag_is_downloaded_again(s3_client, tmp_path):
+    put(s3_client, "a.txt", "first")
+    put(s3_client, "b.txt", "second")
+    run_sync(s3_client, tmp_path)
+    put(s3_client, "a.txt", "first, edited")
+    assert run_sync(s3_client, tmp_path) == ["a.txt"]
+    assert (tmp_path / "a.txt").read_text() == "first, edited"
+
+
+def test_local_file_of_matching_size_but_other_content_is_downloaded(s3_client, tmp_path):
+    put(s3_client, "a.txt", "first")
+    (tmp_path / "a.txt").write_text("FIRST")
+    assert run_sync(s3_client, tmp_path) == ["a.txt"]
+    assert (tmp_path / "a.txt").read_text() == "first"
+
+
+def test_local_file_matching_the_etag_is_adopted(s3_client, tmp_path):
+    put(s3_client, "a.txt", "first")
+    (tmp_path / "a.txt").write_text("first")
+    sync = S3Sync(BUCKET, str(tmp_path), PREFIX, s3_client=s3_client)
+    assert sync.prepare() == {}
+    assert list(sync.sync()) == []
+    # Adopted into the manifest, so a later change of the object is still noticed
+    put(s3_client, "a.txt", "first, edited")
+    assert run_sync(s3_client, tmp_path) == ["a.txt"]
+
+
+def test_local_file_is_not_adopted_against_a_multipart_etag(s3_client, tmp_path):
+    put(s3_client, "a.txt", "first")
+    (tmp_path / "a.txt").write_text("first")
+    sync = S3Sync(BUCKET, str(tmp_path), PREFIX, s3_client=s3_client)
+    listed = sync.list_latest()
+    listed["a.txt"]["ETag"] = '"' + "0" * 32 + '-2"'
+    sync.list_latest = lambda: listed
+    assert list(sync.prepare()) == ["a.txt"]
+
+
+def test_downloads_go_through_part_file(s3_client, tmp_path):
+    put(s3_client, "a.txt", "first")
+    targets = []
+    download_file = s3_client.download_file
+
+    def recording_download(bucket, key, filename, *args, **kwargs):
+        targets.append(filename)
+        # The final name must not exist before the download is complete
+        assert not os.path.exists(str(tmp_path / "a.txt"))
+        return download_file(bucket, key, filename, *args, **kwargs)
+
+    s3_client.download_file = recording_download
+    assert run_sync(s3_client, tmp_path) == ["a.txt"]
+    assert targets == [str(tmp_path / "a.txt.part")]
+    assert sorted(os.listdir(tmp_path)) == [".s3_sync_manifest.json", "a.txt"]
+
+
+def test_failed_download_keeps_old_file_and_is_retried(s3_client, tmp_path):
+    put(s3_client, "a.txt", "first")
+    put(s3_client, "b.txt", "second")
+    run_sync(s3_client, tmp_path)
+    put(s3_client, "a.txt", "first, edited")
+    put(s3_client, "b.txt", "second, edited")
+    download_file = s3_client.download_file
+
+    def failing_download(bucket, key, filename, *args, **kwargs):
+        if key.endswith("a.txt"):
+            with open(filename, "w") as f:
+                f.write("partial")
+            raise IOError("connection reset")
+        return download_file(bucket, key, filename, *args, **kwargs)
+
+    s3_client.download_file = failing_download
+    assert run_sync(s3_client, tmp_path) == ["b.txt"]
+    assert (tmp_path / "a.txt").read_text() == "first"
+    assert not (tmp_path / "a.txt.part").exists()
+    s3_client.download_file = download_file
+    assert run_sync(s3_client, tmp_path) == ["a.txt"]
+    assert (tmp_path / "a.txt").read_text() == "first, edited"
+
+
+def test_synced_files_are_chunked_as_they_arrive(s3_client, tmp_path):
+    pytest.importorskip("langchain")
+    from ingest_pipeline import iter_chunk_batches
+    for i in range(3):
+        put(s3_client, f"episode_{i}.txt", json.dumps({"Episode Name": f"Episode {i}", "text": f"Words of episode {i}."}))
+    events = []
+
+    def arriving():
+        for path in S3Sync(BUCKET, str(tmp_path), PREFIX, s3_client=s3_client, max_workers=1).sync():
+            events.append("downloaded")
+            yield path
+
+    settings = {"chunker": "RecursiveCharacterTextSplitter", "chunk_size": 300, "chunk_overlap": 100}
+    for batch in iter_chunk_batches(arriving(), settings, batch_size=1, workers=1):
+        events.append("chunked")
+    assert events == ["downloaded", "chunked"] * 3
@@ -0,0 +1,127 @@
+"""
+S3Uploader against a moto-mocked bucket: listing past the first page of 1000 keys,
+per-file upload_folder results, and which errors _with_retries retries.
+
+    python -m pytest tests
+"""
+import pytest
+
+moto = pytest.importorskip("moto")
+boto3 = pytest.importorskip("boto3")
+
+from botocore.exceptions import ClientError
+
+import s3Connect
+from s3Connect import S3Uploader
+
+BUCKET = "uploads"
+# More than one page of list_objects_v2 results
+MANY = 1005
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    # No backoff between retries
+    monkeypatch.setattr(s3Connect.time, "sleep", lambda seconds: None)
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def client_error(code: str) -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": code}}, "PutObject")
+
+
+def test_iter_files_pages_past_1000_keys(s3_client):
+    for i in range(MANY):
+        s3_client.put_object(Bucket=BUCKET, Key=f"transcripts/{i:04d}.txt", Body=b"x")
+    s3_client.put_object(Bucket=BUCKET, Key="transcripts/notes.json", Body=b"{}")
+    uploader = S3Uploader(BUCKET, s3_client=s3_client)
+    names = [entry["name"] for entry in uploader.iter_files(prefix="transcripts")]
+    assert len(names) == MANY + 1
+    files = uploader.list_files_by_bucket(BUCKET, "transcripts", suffix=".txt")
+    assert sorted(entry["name"] for entry in files) == [f"{i:04d}.txt" for i in range(MANY)]
+    assert len(uploader.list_files_by_bucket(BUCKET, "transcripts", max_files=1001)) == 1001
+
+
+def test_list_s3_folders1_pages_past_1000_folders(s3_client):
+    for i in range(MANY):
+        s3_client.put_object(Bucket=BUCKET, Key=f"episodes/{i:04d}/transcript.txt", Body=b"x")
+    folders = S3Uploader.list_s3_folders1(BUCKET, "/episodes/", s3_client=s3_client)
+    assert folders == [f"episodes/{i:04d}/" for i in range(MANY)]
+
+
+def test_list_s3_folders1_lists_objects_without_folders(s3_client):
+    for name in ("a.txt", "b.txt"):
+        s3_client.put_object(Bucket=BUCKET, Key=f"flat/{name}", Body=b"x")
+    assert S3Uploader.list_s3_folders1(BUCKET, "flat/", s3_client=s3_client) == ["flat/a.txt", "flat/b.txt"]
+
+
+def test_upload_folder_reports_each_file(s3_client, tmp_path):
+    (tmp_path / "nested").mkdir()
+    (tmp_path / "a.txt").write_text("aaa")
+    (tmp_path / "nested" / "b.txt").write_text("bb")
+    (tmp_path / "bad.txt").write_text("b")
+    upload_file = s3_client.upload_file
+
+    def failing_upload(Filename, Bucket, Key, **kwargs):
+        if Filename.endswith("bad.txt"):
+            raise client_error("InternalError")
+        return upload_file(Filename=Filename, Bucket=Bucket, Key=Key, **kwargs)
+
+    s3_client.upload_file = failing_upload
+    uploader = S3Uploader(BUCKET, prefix="/runs/", s3_client=s3_client, max_workers=2, max_retries=1)
+    results = uploader.upload_folder(str(tmp_path), subfolder="today")
+    assert (results["success"], results["failed"], results["bytes"]) == (2, 1, 5)
+    files = {result["key"]: result for result in results["files"]}
+    assert sorted(files) == ["runs/today/a.txt", "runs/today/bad.txt", "runs/today/nested/b.txt"]
+    assert files["runs/today/nested/b.txt"]["ok"] and files["runs/today/nested/b.txt"]["bytes"] == 2
+    assert not files["runs/today/bad.txt"]["ok"] and files["runs/today/bad.txt"]["attempts"] == 2
+    assert "InternalError" in files["runs/today/bad.txt"]["error"]
+    assert len(results["errors"]) == 1 and "bad.txt" in results["errors"][0]
+    body = s3_client.get_object(Bucket=BUCKET, Key="runs/today/a.txt")["Body"].read()
+    assert body == b"aaa"
+
+
+def test_upload_folder_missing_folder_fails(s3_client, tmp_path):
+    results = S3Uploader(BUCKET, s3_client=s3_client).upload_folder(str(tmp_path / "missing"))
+    assert results["failed"] == 1 and results["files"] == []
+    assert "Folder not found" in results["errors"][0]
+
+
+def test_transient_errors_are_retried(s3_client):
+    uploader = S3Uploader(BUCKET, s3_client=s3_client, max_retries=3)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise client_error("SlowDown")
+        return "done"
+
+    assert uploader._with_retries(flaky) == ("done", 3)
+
+
+def test_retries_run_out(s3_client):
+    uploader = S3Uploader(BUCKET, s3_client=s3_client, max_retries=2)
+
+    def failing():
+        raise client_error("InternalError")
+
+    with pytest.raises(ClientError) as raised:
+        uploader._with_retries(failing)
+    assert raised.value.attempts == 3
+
+
+def test_no_such_bucket_is_not_retried(s3_client, tmp_path):
+    uploader = S3Uploader("missing-bucket", s3_client=s3_client, max_retries=3)
+    with pytest.raises(ClientError) as raised:
+        uploader._with_retries(s3_client.put_object, Bucket="missing-bucket", Key="a.txt", Body=b"x")
+    assert raised.value.attempts == 1
+    (tmp_path / "a.txt").write_text("a")
+    result = uploader.upload_file_timed(str(tmp_path / "a.txt"))
+    assert not result["ok"] and result["attempts"] == 1
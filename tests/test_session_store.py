@@ -0,0 +1,58 @@
+"""
+Session answer cache: answers are only replayed for the same question after the same
+conversation, so follow-ups like "tell me more" are answered again every time.
+
+    python -m pytest tests
+"""
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from conversation_memory import ConversationMemory
+from session_store import Session, SessionStore
+
+
+def ask(session: Session, question: str, answers: list) -> str:
+    """One turn the way query.answer_turn runs it: session cache first, else a fresh answer."""
+    history = session.memory.render()
+    cached = session.get_answer(question, history)
+    if cached is not None:
+        session.record(question, cached["answer"])
+        return cached["answer"]
+    answer = f"answer {len(answers)} to {question}"
+    answers.append(answer)
+    session.record(question, answer, "sources", [], history)
+    return answer
+
+
+def test_follow_up_is_not_replayed_after_a_different_conversation():
+    session = Session("s", ConversationMemory())
+    answers = []
+    ask(session, "what is a death doula?", answers)
+    first_more = ask(session, "tell me more", answers)
+    ask(session, "who is curtis yarvin?", answers)
+    second_more = ask(session, "tell me more", answers)
+    assert second_more != first_more
+    assert len(answers) == 4
+
+
+def test_answer_is_replayed_for_the_same_question_and_history():
+    session = Session("s", ConversationMemory())
+    session.put_answer("What is a death doula?", "cached answer", "sources")
+    assert session.get_answer("what is a death doula")["answer"] == "cached answer"
+    assert session.get_answer("what is a death doula", history="User: hi\nAssistant: hello") is None
+
+    session.put_answer("tell me more", "more about doulas", "sources", history="doulas so far")
+    assert session.get_answer("Tell me more!", history="doulas so far")["answer"] == "more about doulas"
+    assert session.get_answer("tell me more", history="yarvin so far") is None
+
+
+def test_history_keyed_answers_survive_a_spill(tmp_path):
+    store = SessionStore(spill_dir=str(tmp_path), max_sessions=1)
+    session = store.get("a")
+    session.put_answer("tell me more", "more about doulas", "sources", history="doulas so far")
+    store.save(session)
+    store.get("b")  # evicts and spills "a"
+    restored = store.get("a")
+    assert restored.get_answer("tell me more", history="doulas so far")["answer"] == "more about doulas"
+    assert restored.get_answer("tell me more") is None
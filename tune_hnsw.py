@@ -0,0 +1,182 @@
+"""
+Finds the cheapest HNSW configuration for the chunks already in the Chroma index that
+still reaches a recall target.
+
+Every combination of M and ef_construction is built once with hnswlib (the library
+behind Chroma's index) over the stored chunk embeddings, and every ef_search is
+measured against it: recall@k against exact brute-force search and p95 single-query
+latency. The fastest configuration meeting --recall (fewer links and a cheaper build
+break ties) is reported and, with --apply, written to hnsw_config.json, which
+generate_data_store uses as the collection metadata of the index it builds.
+
+    python tune_hnsw.py --recall 0.95
+    python tune_hnsw.py --recall 0.98 --apply      # then: python generate_data_store.py
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from util import *
+from bench_retrieval import brute_force_topk, percentiles, RESULTS_DIR
+
+DEFAULT_M = "8,16,32"
+DEFAULT_EF_CONSTRUCTION = "64,100,200"
+DEFAULT_EF_SEARCH = "10,20,40,80,160"
+
+
+def load_vectors(chroma_path: str, page_size: int = 5000) -> tuple:
+    """Every chunk embedding of the LangChain collection in chroma_path, and the collection's distance space."""
+    import chromadb
+    from langchain_chroma import Chroma
+    collection = chromadb.PersistentClient(path=chroma_path).get_collection(Chroma._LANGCHAIN_DEFAULT_COLLECTION_NAME)
+    vectors = []
+    offset = 0
+    while True:
+        page = collection.get(include=["embeddings"], limit=page_size, offset=offset)
+        if not len(page["ids"]):
+            break
+        vectors.extend(page["embeddings"])
+        offset += len(page["ids"])
+    return np.asarray(vectors, dtype=np.float32), (collection.metadata or {}).get("hnsw:space", "l2")
+
+
+def sample_queries(vectors: np.ndarray, count: int, seed: int = 0) -> np.ndarray:
+    """
+    Midpoints of random pairs of chunks. A stored chunk would trivially find itself;
+    a midpoint lands between neighbourhoods the way real questions do.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, len(vectors), count)
+    b = rng.integers(0, len(vectors), count)
+    return (vectors[a] + vectors[b]) / 2
+
+
+def exact_topk(vectors: np.ndarray, queries: np.ndarray, k: int, space: str) -> np.ndarray:
+    if space == "l2":
+        return brute_force_topk(vectors, queries, k)
+    if space == "cosine":
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    similarities = queries @ vectors.T
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(-similarities, top, axis=1).argsort(axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def tune(vectors: np.ndarray, queries: np.ndarray, space: str, k: int, m_values: list,
+         ef_construction_values: list, ef_search_values: list, threads: int = 0) -> list:
+    """Measures every configuration; returns one result dict per (M, ef_construction, ef_search)."""
+    import hnswlib
+    truth = exact_topk(vectors, queries, k, space)
+    results = []
+    for m in m_values:
+        for ef_construction in ef_construction_values:
+            index = hnswlib.Index(space=space, dim=vectors.shape[1])
+            index.init_index(max_elements=len(vectors), M=m, ef_construction=ef_construction)
+            if threads:
+                index.set_num_threads(threads)
+            start_time = time.perf_counter()
+            index.add_items(vectors, np.arange(len(vectors)))
+            build_seconds = time.perf_counter() - start_time
+            # Queries are timed one by one on one thread, like a single request
+            index.set_num_threads(1)
+            for ef_search in ef_search_values:
+                index.set_ef(max(ef_search, k))
+                latencies, found = [], []
+                for query in queries:
+                    start_time = time.perf_counter()
+                    labels, _ = index.knn_query(query, k=k)
+                    latencies.append((time.perf_counter() - start_time) * 1000)
+                    found.append(labels[0])
+                recall = float(np.mean([len(set(ann.tolist()) & set(exact.tolist())) / k
+                                        for ann, exact in zip(found, truth)]))
+                results.append({
+                    "M": m,
+                    "ef_construction": ef_construction,
+                    "ef_search": ef_search,
+                    f"recall_at_{k}": recall,
+                    "latency_ms": percentiles(latencies),
+                    "build_seconds": build_seconds,
+                    # Vectors plus level-0 links, the bulk of an hnswlib index
+                    "index_bytes_estimate": len(vectors) * (vectors.shape[1] * 4 + m * 2 * 4),
+                })
+    return results
+
+
+def pick(results: list, k: int, target: float):
+    """Fastest p95 among the configurations meeting the target; smaller M, then cheaper builds, win ties."""
+    passing = [result for result in results if result[f"recall_at_{k}"] >= target]
+    if not passing:
+        return None
+    return min(passing, key=lambda result: (round(result["latency_ms"]["p95"], 3), result["M"],
+                                           result["ef_construction"], result["ef_search"]))
+
+
+def hnsw_metadata(config: dict, space: str) -> dict:
+    """Chroma collection metadata for a tuned configuration."""
+    return {
+        "hnsw:space": space,
+        "hnsw:M": config["M"],
+        "hnsw:construction_ef": config["ef_construction"],
+        "hnsw:search_ef": config["ef_search"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chroma-path", default="chroma")
+    parser.add_argument("--recall", type=float, default=0.95, help="recall@k the chosen configuration must reach.")
+    parser.add_argument("--k", type=int, default=6)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--m", default=DEFAULT_M, help="Comma separated M values.")
+    parser.add_argument("--ef-construction", default=DEFAULT_EF_CONSTRUCTION)
+    parser.add_argument("--ef-search", default=DEFAULT_EF_SEARCH)
+    parser.add_argument("--threads", type=int, default=0, help="Build threads (0: all cores).")
+    parser.add_argument("--apply", action="store_true",
+                        help=f"Write the chosen configuration to {get_hnsw_config_path()} for the next ingestion.")
+    parser.add_argument("--out", help="Result file (default: bench_results/hnsw-<time>.json).")
+    args = parser.parse_args()
+
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+    vectors, space = load_vectors(args.chroma_path)
+    if not len(vectors):
+        log("error", f"No chunks in {args.chroma_path}; run generate_data_store.py first")
+        return
+    queries = sample_queries(vectors, args.queries)
+    log("info", f"Tuning HNSW over {len(vectors)} chunks ({space}), {len(queries)} queries, k={args.k}")
+    results = tune(vectors, queries, space, args.k,
+                   [int(value) for value in args.m.split(",")],
+                   [int(value) for value in args.ef_construction.split(",")],
+                   [int(value) for value in args.ef_search.split(",")],
+                   args.threads)
+    for result in results:
+        print(f"M={result['M']:<3} ef_construction={result['ef_construction']:<4} ef_search={result['ef_search']:<4} "
+              f"recall@{args.k} {result[f'recall_at_{args.k}']:.3f}  p95 {result['latency_ms']['p95']:.3f} ms  "
+              f"build {result['build_seconds']:.1f}s")
+
+    best = pick(results, args.k, args.recall)
+    out_path = args.out or os.path.join(RESULTS_DIR, f"hnsw-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    with open(out_path, "w") as f:
+        json.dump({"chunks": len(vectors), "space": space, "k": args.k, "target": args.recall,
+                   "results": results, "best": best}, f, indent=2)
+    print(f"Results written to {out_path}")
+    if best is None:
+        log("error", f"No configuration reached recall@{args.k} {args.recall}; try larger --ef-search or --m values")
+        return
+    log("info", f"Cheapest configuration for recall@{args.k} >= {args.recall}: M={best['M']} "
+                f"ef_construction={best['ef_construction']} ef_search={best['ef_search']} "
+                f"(recall {best[f'recall_at_{args.k}']:.3f}, p95 {best['latency_ms']['p95']:.3f} ms)")
+    if args.apply:
+        config = hnsw_metadata(best, space)
+        config_path = get_hnsw_config_path()
+        with open(config_path, "w") as f:
+            json.dump(config, f, indent=2)
+        log("info", f"Wrote {config_path}; the next generate_data_store run rebuilds the index with it")
+
+
+if __name__ == "__main__":
+    main()
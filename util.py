@@ -11,17 +11,21 @@ import glob
 import sys
 from datetime import datetime, timedelta
 from datetime import date, datetime
-from s3Connect import S3Uploader
 
 from util_logging import S3LogHandler
 from util_logging import *
 
-# logger = setup_logger()
-# logger.info("Starting data processing")
-# logger = setup_logger()
-logger = setup_logger()
+# The S3 logger (and its boto3 client) is created on the first log() call, not at import
+logger = None
+
+def get_logger():
+   global logger
+   if logger is None:
+      logger = setup_logger()
+   return logger
 
 def log(level, message):
+   logger = get_logger()
    level_map = {
        'debug': logger.debug,
        'info': logger.info,
@@ -185,57 +189,163 @@ def stop_program_if_condition(condition):
 def download_s3_bucket_flat( local_dir, prefix="", aws_region="us-east-1"):
     """
     Downloads all files from an S3 bucket, flattens the structure, and overwrites duplicates with the latest version.
+    Only objects whose ETag/LastModified changed since the last sync are fetched.
 
-    :param bucket_name: Name of the S3 bucket.
     :param local_dir: Local directory to save files.
     :param prefix: Folder (prefix) inside the bucket to download (e.g., "transcriptions/").
     :param aws_region: AWS region (optional).
     """
-    s3 = boto3.client("s3", region_name=aws_region) if aws_region else boto3.client("s3")
-    bucket_name = get_bucket_name()
-    # Ensure the local directory exists
-    os.makedirs(local_dir, exist_ok=True)
-    print (f"{get_local_rag_path()}/**/*.txt")
-    existing_files = glob.glob(f"{get_local_rag_path()}/**/*.txt", recursive=True)  # Get all .txt files in subdirectories
-    
-    for i in range(len(existing_files)):
-      existing_files[i] = strip_before_last_slash(existing_files[i])
-
-    # print(existing_files)
-    # Dictionary to track latest file versions
-    latest_files = {}
-
-    # List all objects under the specified prefix
-    paginator = s3.get_paginator("list_objects_v2")
-    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-        if "Contents" in page:
-            for obj in page["Contents"]:
-                key = obj["Key"]
-                filename = os.path.basename(key)  # Extract just the filename (flatten structure)
-                if filename not in existing_files:
-                  last_modified = obj["LastModified"]
-
-                  # If file exists, only keep the latest version
-                  if filename not in latest_files or latest_files[filename]["LastModified"] < last_modified:
-                      latest_files[filename] = {"Key": key, "LastModified": last_modified}
-
-    # Download the latest versions of files
-    for filename, file_info in latest_files.items():
-        s3_key = file_info["Key"]
-        local_file_path = os.path.join(local_dir, filename)
-
-        print(f"Downloading {s3_key} as {local_file_path} (latest version)...")
-        s3.download_file(bucket_name, s3_key, local_file_path)
-
+    import metrics
+    with metrics.span("s3_sync"):
+        for _ in sync_s3_bucket_flat(local_dir, prefix, aws_region):
+            pass
     print("Download complete.")
 
+def sync_s3_bucket_flat(local_dir, prefix="", aws_region="us-east-1", s3_client=None):
+    """
+    Same as download_s3_bucket_flat, but yields the local path of every downloaded file as soon as
+    it is written, so callers can start processing before the whole sync is done.
+
+    :param s3_client: boto3 S3 client to use (optional, e.g. a moto client in tests).
+    """
+    yield from make_s3_sync(local_dir, prefix, aws_region, s3_client).sync()
+
+def make_s3_sync(local_dir, prefix="", aws_region="us-east-1", s3_client=None):
+    """
+    The s3_sync.S3Sync behind sync_s3_bucket_flat, for callers that need its plan (S3Sync.prepare)
+    before the downloads start.
+    """
+    import boto3
+    from s3_sync import S3Sync
+    if s3_client is None:
+        s3_client = boto3.client("s3", region_name=aws_region) if aws_region else boto3.client("s3")
+    return S3Sync(get_bucket_name(), local_dir, prefix, s3_client=s3_client, max_workers=get_s3_sync_workers())
+
 def get_bucket_name() ->str:
    return os.getenv("S3_BUCKET")
 def get_local_rag_path() -> str:
    return os.getenv("RAG_LOCAL_DATA_PATH")
+def get_s3_sync_workers() -> int:
+   return int(os.getenv("RAG_S3_SYNC_WORKERS", "8"))
 def get_rag_embedding() -> str:
    return os.getenv("RAG_EMBEDDING")
+def get_s3_upload_workers() -> int:
+   return int(os.getenv("RAG_S3_UPLOAD_WORKERS", "16"))
+def get_s3_multipart_mb() -> int:
+   return int(os.getenv("RAG_S3_MULTIPART_MB", "16"))
+def get_s3_max_retries() -> int:
+   return int(os.getenv("RAG_S3_MAX_RETRIES", "3"))
+def get_snapshot_prefix() -> str:
+   return os.getenv("RAG_SNAPSHOT_PREFIX", "index-snapshots")
+def get_snapshot_dir() -> str:
+   return os.getenv("RAG_SNAPSHOT_DIR", "snapshots")
+def get_snapshot_poll_seconds() -> float:
+   return float(os.getenv("RAG_SNAPSHOT_POLL_SECONDS", "60"))
+def get_snapshot_keep() -> int:
+   return int(os.getenv("RAG_SNAPSHOT_KEEP", "2"))
+def metrics_enabled() -> bool:
+   return os.getenv("RAG_METRICS", "off").lower() == "on"
+def get_metrics_path() -> str:
+   return os.getenv("RAG_METRICS_PATH", "")
+def get_metrics_trace_keep() -> int:
+   return int(os.getenv("RAG_METRICS_TRACE_KEEP", "100"))
+def profile_enabled() -> bool:
+   return os.getenv("RAG_PROFILE", "off").lower() == "on"
+def get_profile_dir() -> str:
+   return os.getenv("RAG_PROFILE_DIR", "profiles")
+def profile_sites_enabled() -> bool:
+   return os.getenv("RAG_PROFILE_SITES", "off").lower() == "on"
+def dedup_enabled() -> bool:
+   return os.getenv("RAG_DEDUP", "off").lower() == "on"
+def get_dedup_threshold() -> float:
+   return float(os.getenv("RAG_DEDUP_THRESHOLD", "0.8"))
+def get_dedup_episode_threshold() -> float:
+   return float(os.getenv("RAG_DEDUP_EPISODE_THRESHOLD", "0.9"))
+def get_dedup_boilerplate_min() -> int:
+   return int(os.getenv("RAG_DEDUP_BOILERPLATE_MIN", "3"))
+def get_chunker() -> str:
+   return os.getenv("RAG_CHUNKER", "recursive").lower()
+def get_chunk_tokens() -> int:
+   return int(os.getenv("RAG_CHUNK_TOKENS", "256"))
+def get_chunk_overlap_tokens() -> int:
+   return int(os.getenv("RAG_CHUNK_OVERLAP_TOKENS", "32"))
+def get_ingest_workers() -> int:
+   return int(os.getenv("RAG_INGEST_WORKERS", str(os.cpu_count() or 1)))
+def get_ingest_batch_size() -> int:
+   return int(os.getenv("RAG_INGEST_BATCH_SIZE", "512"))
+def get_rag_llm() -> str:
+   return os.getenv("RAG_LLM", "gpt-4")
+def get_embedding_backend_name() -> str:
+   return os.getenv("RAG_EMBED_BACKEND", "torch")
+def get_embedding_batch_size() -> int:
+   return int(os.getenv("RAG_EMBED_BATCH_SIZE", "32"))
+def get_embedding_threads() -> int:
+   return int(os.getenv("RAG_EMBED_THREADS", "0"))
+def get_embedding_processes() -> int:
+   return int(os.getenv("RAG_EMBED_PROCESSES", "1"))
+def get_embedding_quantization() -> str:
+   return os.getenv("RAG_EMBED_QUANTIZATION", "avx512_vnni")
+def get_stub_token_delay() -> float:
+   return float(os.getenv("RAG_STUB_TOKEN_DELAY", "0"))
+def get_memory_token_budget() -> int:
+   return int(os.getenv("RAG_MEMORY_TOKENS", "1000"))
+def memory_summary_enabled() -> bool:
+   return os.getenv("RAG_MEMORY_SUMMARY", "off").lower() == "on"
+def get_memory_summary_tokens() -> int:
+   return int(os.getenv("RAG_MEMORY_SUMMARY_TOKENS", "200"))
+def get_session_max_sessions() -> int:
+   return int(os.getenv("RAG_SESSION_MAX", "1000"))
+def get_session_idle_seconds() -> float:
+   return float(os.getenv("RAG_SESSION_IDLE_SECONDS", "1800"))
+def get_session_max_mb() -> int:
+   return int(os.getenv("RAG_SESSION_MAX_MB", "64"))
+def get_session_spill_dir() -> str:
+   return os.getenv("RAG_SESSION_SPILL_DIR", "")
+def get_summarizer_name() -> str:
+   return os.getenv("RAG_SUMMARIZER", "off")
+def get_summary_path() -> str:
+   return os.getenv("RAG_SUMMARY_PATH", "episode_summaries.json")
+def get_summary_max_words() -> int:
+   return int(os.getenv("RAG_SUMMARY_MAX_WORDS", "250"))
+def get_summary_input_tokens() -> int:
+   return int(os.getenv("RAG_SUMMARY_INPUT_TOKENS", "6000"))
+def get_retrieval_mode() -> str:
+   return os.getenv("RAG_RETRIEVAL", "flat")
+def get_retrieval_episodes() -> int:
+   return int(os.getenv("RAG_RETRIEVAL_EPISODES", "8"))
+def get_hnsw_config_path() -> str:
+   return os.getenv("RAG_HNSW_CONFIG", "hnsw_config.json")
+def get_vector_store_name() -> str:
+   return os.getenv("RAG_VECTOR_STORE", "chroma")
+def get_vector_store_dtype() -> str:
+   return os.getenv("RAG_VECTOR_DTYPE", "int8")
+def get_vector_store_index() -> str:
+   return os.getenv("RAG_VECTOR_INDEX", "brute")
+def get_vector_store_nprobe() -> int:
+   return int(os.getenv("RAG_VECTOR_NPROBE", "8"))
+def get_vector_store_rescore() -> int:
+   return int(os.getenv("RAG_VECTOR_RESCORE", "4"))
+def get_context_token_budget() -> int:
+   return int(os.getenv("RAG_CONTEXT_TOKENS", "1500"))
+def get_context_max_chunks_per_episode() -> int:
+   return int(os.getenv("RAG_CONTEXT_MAX_PER_EPISODE", "3"))
+def answer_cache_enabled() -> bool:
+   return os.getenv("RAG_ANSWER_CACHE", "on").lower() != "off"
+def get_answer_cache_threshold() -> float:
+   return float(os.getenv("RAG_ANSWER_CACHE_THRESHOLD", "0.95"))
+def get_answer_cache_ttl() -> float:
+   return float(os.getenv("RAG_ANSWER_CACHE_TTL", "86400"))
+def get_answer_cache_max_entries() -> int:
+   return int(os.getenv("RAG_ANSWER_CACHE_MAX", "1000"))
+def get_answer_cache_path() -> str:
+   return os.getenv("RAG_ANSWER_CACHE_PATH", "")
+def get_embedding_cache_dir() -> str:
+   cache_dir = os.getenv("RAG_EMBED_CACHE", "embedding_cache")
+   return "" if cache_dir.lower() == "off" else cache_dir
+def get_embedding_cache_max_mb() -> int:
+   return int(os.getenv("RAG_EMBED_CACHE_MAX_MB", "512"))
 def read_s3_file(  key) ->str:
+  from s3Connect import S3Uploader
   formatted_date = get_now()  
 
   uploader = S3Uploader(
@@ -244,6 +354,7 @@ def read_s3_file(  key) ->str:
     )
   return uploader.read_s3_file(key)
 def get_s3_folders(type):
+  from s3Connect import S3Uploader
   folders = []
   for f in S3Uploader.list_s3_folders1(f"{get_bucket_name()}", f"{type}"):
      folders.append (f.split('/')[-2])    
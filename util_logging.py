@@ -1,6 +1,8 @@
 import logging
-import boto3
 import io
+import queue
+import threading
+import time
 from datetime import datetime
 import os
 from dotenv import load_dotenv
@@ -13,42 +15,150 @@ def get_now() ->str:
   return formatted_date
 def get_rag_log_location() ->str:
     return os.getenv("RAG_LOG")
+def get_log_batch_size() -> int:
+    return int(os.getenv("RAG_LOG_BATCH_SIZE", "500"))
+def get_log_flush_seconds() -> float:
+    return float(os.getenv("RAG_LOG_FLUSH_SECONDS", "5"))
+def get_log_queue_size() -> int:
+    return int(os.getenv("RAG_LOG_QUEUE_SIZE", "10000"))
+def get_log_spill_dir() -> str:
+    return os.getenv("RAG_LOG_SPILL_DIR", "log_spill")
 class S3LogHandler(logging.Handler):
-   def __init__(self, bucket='podcast.monitor', prefix=get_rag_log_location()):
+   def __init__(self, bucket='podcast.monitor', prefix=get_rag_log_location(), s3_client=None,
+                batch_size=None, flush_interval=None, max_queue=None, spill_dir=None):
+       """
+       Ships log records to S3 from a background thread.
+
+       emit() only formats the record and puts it on a bounded queue. The shipper thread
+       drains the queue and writes each batch as a new part object under
+       <prefix><date>/current_rag_log/, once batch_size records are waiting or every
+       flush_interval seconds. When the queue is full, or an upload fails, lines are
+       appended to a local spill file that is shipped with the next batch; with no
+       spill_dir they are dropped and counted. Pending records are flushed on close().
+       """
        super().__init__()
-       self.s3_client = boto3.client('s3')
+       if s3_client is None:
+           import boto3
+           s3_client = boto3.client('s3')
+       self.s3_client = s3_client
        self.bucket = bucket
-       self.prefix = prefix + f"{get_now()}"
-       self.log_buffer = io.StringIO()
+       self.base_prefix = prefix or ''
+       self.batch_size = batch_size or get_log_batch_size()
+       self.flush_interval = flush_interval or get_log_flush_seconds()
+       self.spill_dir = spill_dir if spill_dir is not None else get_log_spill_dir()
+       self.dropped = 0
+       self.shipped = 0
+       self._queue = queue.Queue(maxsize=max_queue or get_log_queue_size())
+       self._spill_lock = threading.Lock()
+       self._seq = 0
+       self._stop = threading.Event()
+       self._thread = threading.Thread(target=self._run, name='S3LogShipper', daemon=True)
+       self._thread.start()
+
+   @property
+   def prefix(self):
+       return self.base_prefix + f"{get_now()}"
 
    def emit(self, record):
        try:
-           # Format log message
            msg = self.format(record)
-           # Append to existing log file or create new one
-           log_key = f"{self.prefix}/current_rag_log.log"
-        #    print(get_now())
-           
-        #    log_key = f"{self.prefix}{formatted_date}.log"
+       except Exception:
+           self.handleError(record)
+           return
+       try:
+           self._queue.put_nowait(msg)
+       except queue.Full:
+           self._spill([msg])
+
+   def _spill(self, lines):
+       if not self.spill_dir:
+           self.dropped += len(lines)
+           return
+       try:
+           with self._spill_lock:
+               os.makedirs(self.spill_dir, exist_ok=True)
+               with open(os.path.join(self.spill_dir, 'rag_log.spill'), 'a') as f:
+                   f.write(''.join(line + '\n' for line in lines))
+       except OSError as e:
+           self.dropped += len(lines)
+           print(f"S3 Log Spill Failed: {e}")
+
+   def _take_spill(self):
+       """Returns the spilled lines and removes the spill file."""
+       if not self.spill_dir:
+           return []
+       spill_path = os.path.join(self.spill_dir, 'rag_log.spill')
+       with self._spill_lock:
+           if not os.path.exists(spill_path):
+               return []
+           with open(spill_path, 'r') as f:
+               lines = f.read().splitlines()
+           os.remove(spill_path)
+       return lines
+
+   def _run(self):
+       batch = []
+       flush_waiters = []
+       deadline = time.monotonic() + self.flush_interval
+       while True:
+           timeout = max(0.0, deadline - time.monotonic())
            try:
-               # Try to get existing log content
-               existing_log = self.s3_client.get_object(Bucket=self.bucket, Key=log_key)
-               existing_content = existing_log['Body'].read().decode('utf-8')
-               print (existing_content)
-           except self.s3_client.exceptions.NoSuchKey:
-               existing_content = ''
+               item = self._queue.get(timeout=timeout)
+               if isinstance(item, threading.Event):
+                   flush_waiters.append(item)
+               else:
+                   batch.append(item)
+           except queue.Empty:
+               pass
+           stopping = self._stop.is_set() and self._queue.empty()
+           if len(batch) >= self.batch_size or flush_waiters or stopping or time.monotonic() >= deadline:
+               self._ship(batch)
+               batch = []
+               deadline = time.monotonic() + self.flush_interval
+               for waiter in flush_waiters:
+                   waiter.set()
+               flush_waiters = []
+           if stopping:
+               return
 
-           # Append new log message
-           updated_content = existing_content + msg + '\n'
-           
-           # Upload updated content
+   def _ship(self, batch):
+       lines = self._take_spill() + batch
+       if not lines:
+           return
+       self._seq += 1
+       log_key = f"{self.prefix}/current_rag_log/{int(time.time() * 1000)}-{os.getpid()}-{self._seq:06d}.log"
+       try:
            self.s3_client.put_object(
-               Bucket=self.bucket, 
-               Key=log_key, 
-               Body=updated_content.encode('utf-8')
+               Bucket=self.bucket,
+               Key=log_key,
+               Body=''.join(line + '\n' for line in lines).encode('utf-8')
            )
+           self.shipped += len(lines)
        except Exception as e:
            print(f"S3 Log Upload Failed: {e}")
+           self._spill(lines)
+
+   def flush(self, timeout=10.0):
+       """Blocks until everything queued so far has been shipped (or timeout seconds pass)."""
+       if not self._thread.is_alive():
+           return
+       done = threading.Event()
+       try:
+           self._queue.put(done, timeout=timeout)
+       except queue.Full:
+           return
+       done.wait(timeout)
+
+   def close(self):
+       if self._thread.is_alive():
+           self._stop.set()
+           try:
+               # Wake the shipper so it flushes and exits without waiting out flush_interval
+               self._queue.put_nowait(threading.Event())
+           except queue.Full:
+               pass
+           self._thread.join(timeout=30)
+       super().close()
 
 
 def setup_logger(bucket='podcast.monitor', prefix=get_rag_log_location()):
@@ -67,7 +177,9 @@ def setup_logger(bucket='podcast.monitor', prefix=get_rag_log_location()):
         logger.setLevel(logging.DEBUG)
     
     # print (logger.level)
-    # S3 Handler
+    # S3 Handler, added once even if setup_logger is called again
+    if any(isinstance(handler, S3LogHandler) for handler in logger.handlers):
+        return logger
     s3_handler = S3LogHandler(bucket, prefix)
     s3_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
     logger.addHandler(s3_handler)
@@ -0,0 +1,376 @@
+"""
+In-process vector store over memory-mapped NumPy files, selectable with
+RAG_VECTOR_STORE=mmap as an alternative to querying Chroma.
+
+The store is an export of the chunks save_to_chroma wrote (ids, texts, metadata and
+embeddings), laid out for search:
+
+    vectors.q.npy       float16 or int8 (per-row scale in scales.npy) matrix; int8 is
+                        scanned per query
+    vectors.f32.npy     full-precision vectors: the top candidates' rows are re-ranked with
+                        them, and float16 stores scan them directly (numpy upcasts float16
+                        roughly 15x slower than it multiplies float32)
+    norms.npy           squared L2 norm of every full-precision row
+    texts.bin/.idx.npy  chunk texts as one UTF-8 blob plus offsets (ids.bin likewise)
+    columns.json        metadata, one column per key: integers as arrays, everything
+                        else dictionary-encoded into col_<n>.npy codes; also the dtype,
+                        index and the ingest manifest version the store was exported from
+    ivf_*.npy           optional coarse clustering (IVF) to scan only nprobe clusters
+
+Everything is opened with mmap, so loading is near-instant and the resident set is the
+scanned matrix plus whatever rows were touched.
+
+    python vector_store.py --chroma-path chroma                     # export (int8, brute force)
+    python vector_store.py --chroma-path chroma_db --collection podcast_transcripts --index ivf
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from util import *
+from retrieval import make_hit, relevance_score
+
+# Rows per block when scanning, bounds the distance matrix held for a block
+SCAN_BLOCK = 65536
+# Rows of int8 vectors upcast to float32 at a time, into one reused buffer (stays in cache)
+SCORE_BLOCK = 1024
+
+
+def write_strings(path: str, values: list):
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    with open(path, "wb") as f:
+        for value in encoded:
+            f.write(value)
+    np.save(path + ".idx.npy", offsets)
+
+
+class StringColumn:
+    def __init__(self, path: str):
+        """Read side of write_strings: values are decoded from the mmapped blob on access."""
+        self.offsets = np.load(path + ".idx.npy", mmap_mode="r")
+        self.blob = np.memmap(path, dtype=np.uint8, mode="r") if self.offsets[-1] else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row: int) -> str:
+        return self.blob[self.offsets[row]:self.offsets[row + 1]].tobytes().decode("utf-8")
+
+
+def quantize(vectors: np.ndarray, dtype: str) -> tuple:
+    """(quantized matrix, per-row scales or None). int8 is symmetric per row."""
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    if dtype != "int8":
+        raise ValueError(f"Unsupported vector dtype: {dtype}")
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+def kmeans(vectors: np.ndarray, clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """Plain Lloyd's k-means on a sample of at most 256 rows per cluster; returns the centroids."""
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), clusters * 256), replace=False)]
+    centroids = sample[rng.choice(len(sample), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroids(sample, centroids)
+        for cluster in range(clusters):
+            members = sample[assignment == cluster]
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+    return centroids
+
+
+def centroid_distances(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    return (np.sum(vectors ** 2, axis=1)[:, None] - 2 * vectors @ centroids.T
+            + np.sum(centroids ** 2, axis=1)[None, :])
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    return centroid_distances(vectors, centroids).argmin(axis=1)
+
+
+def top_centroids(vectors: np.ndarray, centroids: np.ndarray, count: int) -> np.ndarray:
+    """The count nearest centroids of every vector (unordered), one row per vector."""
+    count = min(count, len(centroids))
+    return np.argpartition(centroid_distances(vectors, centroids), count - 1, axis=1)[:, :count]
+
+
+def read_layout(path: str):
+    """columns.json of the store at path (dtype, index, version), or None when there is none."""
+    try:
+        with open(os.path.join(path, "columns.json"), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class MmapVectorStore:
+    def __init__(self, path: str):
+        """
+        Opens a store written by MmapVectorStore.build. Distances are squared L2, the
+        same as Chroma's default "l2" space, so scores and thresholds carry over.
+        """
+        start_time = time.perf_counter()
+        self.path = path
+        self.layout = read_layout(path)
+        if self.layout is None:
+            raise FileNotFoundError(f"No vector store at {path}")
+        self.quantized = np.load(os.path.join(path, "vectors.q.npy"), mmap_mode="r")
+        self.full = np.load(os.path.join(path, "vectors.f32.npy"), mmap_mode="r")
+        self.norms = np.load(os.path.join(path, "norms.npy"))
+        scales_path = os.path.join(path, "scales.npy")
+        self.scales = np.load(scales_path) if os.path.exists(scales_path) else None
+        self.ids = StringColumn(os.path.join(path, "ids.bin"))
+        self.texts = StringColumn(os.path.join(path, "texts.bin"))
+        self.columns = {}
+        for key, column in self.layout["columns"].items():
+            values = np.load(os.path.join(path, column["file"]), mmap_mode="r")
+            self.columns[key] = (column, values)
+        self.ivf = None
+        if self.layout.get("index") == "ivf":
+            self.ivf = (np.load(os.path.join(path, "ivf_centroids.npy")),
+                        np.load(os.path.join(path, "ivf_order.npy"), mmap_mode="r"),
+                        np.load(os.path.join(path, "ivf_offsets.npy")))
+        log("info", f"Vector store {path} opened ({len(self)} chunks, {self.layout['dtype']}, "
+                    f"{self.layout.get('index', 'brute')}). Took {time.perf_counter() - start_time} seconds")
+
+    def __len__(self):
+        return self.quantized.shape[0]
+
+    @staticmethod
+    def build(path: str, ids: list, embeddings, texts: list, metadatas: list, dtype: str = "int8",
+              index: str = "brute", clusters: int = 0, version: int = None):
+        """
+        Writes a store to path (replacing any previous one atomically).
+
+        Args:
+            path (str): Store directory
+            ids, embeddings, texts, metadatas: The chunks as stored in Chroma
+            dtype (str): "int8" or "float16" for the quantized matrix
+            index (str): "brute" to scan every row, "ivf" for a clustered index
+            clusters (int): IVF clusters (default: about sqrt of the chunk count)
+            version (int): Ingest manifest version of the index being exported, see read_layout
+        """
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        quantized, scales = quantize(vectors, dtype)
+        np.save(os.path.join(tmp_path, "vectors.q.npy"), quantized)
+        np.save(os.path.join(tmp_path, "vectors.f32.npy"), vectors)
+        np.save(os.path.join(tmp_path, "norms.npy"), np.sum(vectors ** 2, axis=1))
+        if scales is not None:
+            np.save(os.path.join(tmp_path, "scales.npy"), scales)
+        write_strings(os.path.join(tmp_path, "ids.bin"), [str(chunk_id) for chunk_id in ids])
+        write_strings(os.path.join(tmp_path, "texts.bin"), [text or "" for text in texts])
+
+        keys = sorted({key for metadata in metadatas for key in (metadata or {})})
+        columns = {}
+        for n, key in enumerate(keys):
+            values = [(metadata or {}).get(key) for metadata in metadatas]
+            file_name = f"col_{n}.npy"
+            if all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+                np.save(os.path.join(tmp_path, file_name), np.asarray(values, dtype=np.int64))
+                columns[key] = {"type": "int", "file": file_name}
+            else:
+                uniques = {}
+                codes = np.asarray([uniques.setdefault(value, len(uniques)) for value in values], dtype=np.int32)
+                np.save(os.path.join(tmp_path, file_name), codes)
+                columns[key] = {"type": "dict", "file": file_name, "values": list(uniques)}
+
+        layout = {"dtype": dtype, "index": index, "dim": int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+                  "columns": columns, "version": version}
+        if index == "ivf" and len(vectors):
+            clusters = clusters or max(1, int(np.sqrt(len(vectors))))
+            centroids = kmeans(vectors, clusters)
+            assignment = np.concatenate([nearest_centroids(vectors[i:i + SCAN_BLOCK], centroids)
+                                         for i in range(0, len(vectors), SCAN_BLOCK)])
+            order = np.argsort(assignment, kind="stable")
+            offsets = np.zeros(clusters + 1, dtype=np.int64)
+            np.cumsum(np.bincount(assignment, minlength=clusters), out=offsets[1:])
+            np.save(os.path.join(tmp_path, "ivf_centroids.npy"), centroids)
+            np.save(os.path.join(tmp_path, "ivf_order.npy"), order)
+            np.save(os.path.join(tmp_path, "ivf_offsets.npy"), offsets)
+            layout["clusters"] = clusters
+        elif index != "brute":
+            layout["index"] = "brute"
+        with open(os.path.join(tmp_path, "columns.json"), "w") as f:
+            json.dump(layout, f)
+
+        if os.path.exists(path):
+            old_path = path + ".old"
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.replace(path, old_path)
+            os.replace(tmp_path, path)
+            shutil.rmtree(old_path, ignore_errors=True)
+        else:
+            os.replace(tmp_path, path)
+
+    @staticmethod
+    def build_from_collection(path: str, collection, page_size: int = 5000, **kwargs):
+        """Exports every chunk of a Chroma collection into a store at path (see build)."""
+        ids, embeddings, texts, metadatas = [], [], [], []
+        offset = 0
+        while True:
+            page = collection.get(include=["embeddings", "documents", "metadatas"], limit=page_size, offset=offset)
+            if not len(page["ids"]):
+                break
+            ids.extend(page["ids"])
+            embeddings.extend(page["embeddings"])
+            texts.extend(page["documents"])
+            metadatas.extend(page["metadatas"])
+            offset += len(page["ids"])
+        MmapVectorStore.build(path, ids, embeddings, texts, metadatas, **kwargs)
+
+    def metadata(self, row: int) -> dict:
+        metadata = {}
+        for key, (column, values) in self.columns.items():
+            value = int(values[row]) if column["type"] == "int" else column["values"][values[row]]
+            if value is not None:
+                metadata[key] = value
+        return metadata
+
+    def mask(self, where: dict):
+        """Boolean row mask for a Chroma-style where filter (equality, $eq, $ne, $in, $nin, $and, $or)."""
+        if not where:
+            return None
+        if "$and" in where:
+            masks = [self.mask(clause) for clause in where["$and"]]
+            return np.logical_and.reduce(masks)
+        if "$or" in where:
+            masks = [self.mask(clause) for clause in where["$or"]]
+            return np.logical_or.reduce(masks)
+        (key, condition), = where.items()
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        (operator, operand), = condition.items()
+        if key not in self.columns:
+            matches = np.zeros(len(self), dtype=bool)
+            return ~matches if operator in ("$ne", "$nin") else matches
+        column, values = self.columns[key]
+        wanted = operand if operator in ("$in", "$nin") else [operand]
+        if column["type"] == "dict":
+            codes = {value: code for code, value in enumerate(column["values"])}
+            wanted = [codes[value] for value in wanted if value in codes]
+        matches = np.isin(values, wanted)
+        if operator in ("$eq", "$in"):
+            return matches
+        if operator in ("$ne", "$nin"):
+            return ~matches
+        raise ValueError(f"Unsupported filter operator for the mmap vector store: {operator}")
+
+    def _approximate(self, rows, queries: np.ndarray) -> np.ndarray:
+        """
+        Squared L2 |x|^2 - 2 q.x + |q|^2, rows x queries. int8 rows are upcast SCORE_BLOCK
+        at a time into one buffer instead of copying the whole block to float32; float16
+        stores use the float32 rows, which are exact and cheaper to multiply than to upcast.
+        """
+        if self.scales is None:
+            dots = np.asarray(self.full[rows]) @ queries.T
+        else:
+            selected = self.quantized[rows]
+            dots = np.empty((len(selected), len(queries)), dtype=np.float32)
+            buffer = np.empty((min(SCORE_BLOCK, len(selected)), selected.shape[1]), dtype=np.float32)
+            for start in range(0, len(selected), SCORE_BLOCK):
+                block = buffer[:len(selected[start:start + SCORE_BLOCK])]
+                block[...] = selected[start:start + SCORE_BLOCK]
+                np.matmul(block, queries.T, out=dots[start:start + len(block)])
+            dots *= self.scales[rows][:, None]
+        return self.norms[rows][:, None] - 2 * dots + np.sum(queries ** 2, axis=1)[None, :]
+
+    def search(self, query_embeddings, k: int = 6, where: dict = None, nprobe: int = 8,
+               rescore: int = 4) -> list:
+        """
+        For every query, the k nearest rows as (row, squared L2 distance) best first.
+        The int8 matrix, or the float32 one for float16 stores (or nprobe IVF clusters
+        of it), is scanned for k * rescore candidates, which are then re-ranked with
+        their float32 vectors.
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        mask = self.mask(where)
+        if self.ivf is None:
+            approximate = np.concatenate([self._approximate(slice(i, i + SCAN_BLOCK), queries)
+                                          for i in range(0, len(self), SCAN_BLOCK)]) if len(self) else \
+                np.zeros((0, len(queries)), dtype=np.float32)
+            candidate_rows = [np.arange(len(self))] * len(queries)
+            candidate_distances = [approximate[:, i] for i in range(len(queries))]
+        else:
+            centroids, order, offsets = self.ivf
+            candidate_rows, candidate_distances = [], []
+            for i, clusters in enumerate(top_centroids(queries, centroids, nprobe)):
+                rows = np.sort(np.concatenate([order[offsets[c]:offsets[c + 1]] for c in clusters]))
+                candidate_rows.append(rows)
+                candidate_distances.append(self._approximate(rows, queries[i:i + 1])[:, 0])
+
+        results = []
+        for query, rows, distances in zip(queries, candidate_rows, candidate_distances):
+            if mask is not None:
+                keep = mask[rows]
+                rows, distances = rows[keep], distances[keep]
+            if not len(rows):
+                results.append([])
+                continue
+            count = min(k * rescore, len(rows))
+            top = np.argpartition(distances, count - 1)[:count]
+            candidates = np.sort(rows[top])
+            exact = np.sum((np.asarray(self.full[candidates], dtype=np.float32) - query) ** 2, axis=1)
+            best = exact.argsort()[:k]
+            results.append([(int(candidates[j]), float(exact[j])) for j in best])
+        return results
+
+
+class MmapSearcher:
+    def __init__(self, store: MmapVectorStore, nprobe: int = 8, rescore: int = 4):
+        """ChromaSearcher interface over an MmapVectorStore, returning the same hit dicts."""
+        self.store = store
+        self.space = "l2"
+        self.nprobe = nprobe
+        self.rescore = rescore
+
+    def search(self, query_embeddings: list, k: int = 6, where: dict = None) -> list[list[dict]]:
+        if not len(query_embeddings):
+            return []
+        hits = []
+        for matches in self.store.search(query_embeddings, k, where, self.nprobe, self.rescore):
+            hits.append([
+                make_hit(self.store.ids[row], self.store.texts[row], self.store.metadata(row), distance,
+                         relevance_score(distance, self.space))
+                for row, distance in matches
+            ])
+        return hits
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chroma-path", default="chroma")
+    parser.add_argument("--collection", help="Chroma collection (default: LangChain's).")
+    parser.add_argument("--out", help="Store directory (default: <chroma-path>/vector_store).")
+    parser.add_argument("--dtype", default=get_vector_store_dtype(), choices=["int8", "float16"])
+    parser.add_argument("--index", default=get_vector_store_index(), choices=["brute", "ivf"])
+    parser.add_argument("--clusters", type=int, default=0, help="IVF clusters (default: sqrt of the chunk count).")
+    args = parser.parse_args()
+
+    import chromadb
+    from langchain_chroma import Chroma
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+    collection = chromadb.PersistentClient(path=args.chroma_path).get_collection(
+        args.collection or Chroma._LANGCHAIN_DEFAULT_COLLECTION_NAME)
+    out_path = args.out or os.path.join(args.chroma_path, "vector_store")
+    start_time = time.perf_counter()
+    MmapVectorStore.build_from_collection(out_path, collection, dtype=args.dtype, index=args.index,
+                                          clusters=args.clusters)
+    log("info", f"Exported {collection.count()} chunks to {out_path}. Took {time.perf_counter() - start_time} seconds")
+
+
+if __name__ == "__main__":
+    main()